@@ -65,7 +65,7 @@ reg = gm.plot_major_cities(reg,
                            offset=0.08,
                            size=0.75,
                            color='yellow',
-                           hor_offset_multiplier=2)
+                           projection='M-158/56.5/12c')
 """
 
 reg.show()
@@ -10,12 +10,12 @@ import pygmt
 
 import obspy
 from obspy import UTCDateTime
-from obspy.clients.fdsn import Client
 
 from scripts import general_mapping as gm
 from scripts import mapping_events as me
 from scripts import colormap_utils as cu
 from scripts import mapping_stations as ms
+from scripts import inventory_cache as ic
 
 
 color = ['lightseagreen','darkslategray1','orange']
@@ -34,15 +34,15 @@ fig = gm.plot_base_map(region=bounds,
                        scalebar_height=10,
                        colorbar_tick=500)
 
-c = Client('IRIS')
+c = 'IRIS'
 
-inv = c.get_stations(starttime=UTCDateTime('2000-01-01'),
-                     endtime=UTCDateTime('2025-04-01'),
-                     minlatitude=bounds[2],
-                     maxlatitude=bounds[3],
-                     minlongitude=bounds[0],
-                     maxlongitude=bounds[1],
-                     network='AK,NP')
+inv = ic.get_stations(c,starttime=UTCDateTime('2000-01-01'),
+                      endtime=UTCDateTime('2025-04-01'),
+                      minlatitude=bounds[2],
+                      maxlatitude=bounds[3],
+                      minlongitude=bounds[0],
+                      maxlongitude=bounds[1],
+                      network='AK,NP')
 
 for i, net in enumerate(inv):
     lons = []
@@ -66,26 +66,29 @@ fig.show()
 
 #=============================AK Only Velocity================================
 bounds = [-150.5, -148.8, 60.8, 61.65]
-fig = gm.plot_base_map(region=bounds,
-                       projection='M-150.2/61.3/12c',
-                       resolution='15s',
-                       data_source='gebco',
-                       cmap=cmap,
-                       bathymetry=True,margin=0.02,
-                       map_scale="n0.2/0.96+w25k+f+u",
-                       scalebar_height=10,
-                       colorbar_tick=500)
-
-c = Client('IRIS')
 
-inv = c.get_stations(starttime=UTCDateTime('2000-01-01'),
-                     endtime=UTCDateTime('2025-04-01'),
-                     minlatitude=bounds[2],
-                     maxlatitude=bounds[3],
-                     minlongitude=bounds[0],
-                     maxlongitude=bounds[1],
-                     network='AK',
-                     channel='*HZ')
+# Every local map shares the same base layer, so it's only prepared once
+local_template = gm.BaseMapTemplate(region=bounds,
+                                    projection='M-150.2/61.3/12c',
+                                    resolution='15s',
+                                    data_source='gebco',
+                                    cmap=cmap,
+                                    bathymetry=True,margin=0.02,
+                                    map_scale="n0.2/0.96+w25k+f+u",
+                                    scalebar_height=10,
+                                    colorbar_tick=500)
+fig = local_template.clone()
+
+c = 'IRIS'
+
+inv = ic.get_stations(c,starttime=UTCDateTime('2000-01-01'),
+                      endtime=UTCDateTime('2025-04-01'),
+                      minlatitude=bounds[2],
+                      maxlatitude=bounds[3],
+                      minlongitude=bounds[0],
+                      maxlongitude=bounds[1],
+                      network='AK',
+                      channel='*HZ')
 
 for i, net in enumerate(inv):
     lons = []
@@ -108,25 +111,17 @@ fig.show()
 
 #=============================AK Overview================================
 bounds = [-150.5, -148.8, 60.8, 61.65]
-fig = gm.plot_base_map(region=bounds,
-                       projection='M-150.2/61.3/12c',
-                       resolution='15s',
-                       data_source='gebco',
-                       cmap=cmap,
-                       bathymetry=True,margin=0.02,
-                       map_scale="n0.2/0.96+w25k+f+u",
-                       scalebar_height=10,
-                       colorbar_tick=500)
+fig = local_template.clone()
 
-c = Client('IRIS')
+c = 'IRIS'
 
-inv = c.get_stations(starttime=UTCDateTime('2000-01-01'),
-                     endtime=UTCDateTime('2025-04-01'),
-                     minlatitude=bounds[2],
-                     maxlatitude=bounds[3],
-                     minlongitude=bounds[0],
-                     maxlongitude=bounds[1],
-                     network='AK')
+inv = ic.get_stations(c,starttime=UTCDateTime('2000-01-01'),
+                      endtime=UTCDateTime('2025-04-01'),
+                      minlatitude=bounds[2],
+                      maxlatitude=bounds[3],
+                      minlongitude=bounds[0],
+                      maxlongitude=bounds[1],
+                      network='AK')
 
 for i, net in enumerate(inv):
     lons = []
@@ -149,25 +144,17 @@ fig.show()
 
 #=============================NP Overview================================
 bounds = [-150.5, -148.8, 60.8, 61.65]
-fig = gm.plot_base_map(region=bounds,
-                       projection='M-150.2/61.3/12c',
-                       resolution='15s',
-                       data_source='gebco',
-                       cmap=cmap,
-                       bathymetry=True,margin=0.02,
-                       map_scale="n0.2/0.96+w25k+f+u",
-                       scalebar_height=10,
-                       colorbar_tick=500)
+fig = local_template.clone()
 
-c = Client('IRIS')
+c = 'IRIS'
 
-inv = c.get_stations(starttime=UTCDateTime('2000-01-01'),
-                     endtime=UTCDateTime('2025-04-01'),
-                     minlatitude=bounds[2],
-                     maxlatitude=bounds[3],
-                     minlongitude=bounds[0],
-                     maxlongitude=bounds[1],
-                     network='NP')
+inv = ic.get_stations(c,starttime=UTCDateTime('2000-01-01'),
+                      endtime=UTCDateTime('2025-04-01'),
+                      minlatitude=bounds[2],
+                      maxlatitude=bounds[3],
+                      minlongitude=bounds[0],
+                      maxlongitude=bounds[1],
+                      network='NP')
 
 for i, net in enumerate(inv):
     lons = []
@@ -190,25 +177,17 @@ fig.show()
 
 #=============================Raspberry Shake Overview================================
 bounds = [-150.5, -148.8, 60.8, 61.65]
-fig = gm.plot_base_map(region=bounds,
-                       projection='M-150.2/61.3/12c',
-                       resolution='15s',
-                       data_source='gebco',
-                       cmap=cmap,
-                       bathymetry=True,margin=0.02,
-                       map_scale="n0.2/0.96+w25k+f+u",
-                       scalebar_height=10,
-                       colorbar_tick=500)
+fig = local_template.clone()
 
-c = Client('RASPISHAKE')
+c = 'RASPISHAKE'
 
-inv2 = c.get_stations(starttime=UTCDateTime('2023-01-01'),
-                     endtime=UTCDateTime('2025-04-01'),
-                     minlatitude=bounds[2],
-                     maxlatitude=bounds[3],
-                     minlongitude=bounds[0],
-                     maxlongitude=bounds[1],
-                     network='AM')
+inv2 = ic.get_stations(c,starttime=UTCDateTime('2023-01-01'),
+                      endtime=UTCDateTime('2025-04-01'),
+                      minlatitude=bounds[2],
+                      maxlatitude=bounds[3],
+                      minlongitude=bounds[0],
+                      maxlongitude=bounds[1],
+                      network='AM')
 
 for i, net in enumerate(inv2):
     lons = []
@@ -230,29 +209,21 @@ gm.save_fig(fig,'AnchorageRaspShake',dpi=960)
 fig.show()
 
 #================All Stations===================================
-c = Client('IRIS')
+c = 'IRIS'
 
-inv = c.get_stations(starttime=UTCDateTime('2000-01-01'),
-                     endtime=UTCDateTime('2025-04-01'),
-                     minlatitude=bounds[2],
-                     maxlatitude=bounds[3],
-                     minlongitude=bounds[0],
-                     maxlongitude=bounds[1],
-                     network='AK,NP')
+inv = ic.get_stations(c,starttime=UTCDateTime('2000-01-01'),
+                      endtime=UTCDateTime('2025-04-01'),
+                      minlatitude=bounds[2],
+                      maxlatitude=bounds[3],
+                      minlongitude=bounds[0],
+                      maxlongitude=bounds[1],
+                      network='AK,NP')
 
 inv = inv + inv2
 
 bounds = [-150.5, -148.8, 60.8, 61.65]
 
-fig = gm.plot_base_map(region=bounds,
-                       projection='M-150.2/61.3/12c',
-                       resolution='15s',
-                       data_source='gebco',
-                       cmap=cmap,
-                       bathymetry=True,margin=0.02,
-                       map_scale="n0.2/0.96+w25k+f+u",
-                       scalebar_height=10,
-                       colorbar_tick=500)
+fig = local_template.clone()
 
 for i, net in enumerate(inv):
     lons = []
@@ -50,7 +50,7 @@ pnw_regional_fig = ms.plot_stations(station_inv,
 
 pnw_regional_fig = gm.plot_major_cities(pnw_regional_fig,minpopulation=200000,
                                         close_threshhold=0.01,offset=0.03,
-                                        dotsize=0.25,hor_offset_multiplier=3.5)
+                                        dotsize=0.25,projection='Q15c+du')
 pnw_regional_fig.show()
 
 gm.save_fig(pnw_regional_fig,"PNW Regional Overview")
@@ -5,4 +5,6 @@ Created on Tue Nov  7 15:05:14 2023
 @author: tlee
 """
 
-__all__ = ['mapping_stations','general_mapping','mapping_stations','station_utils','colormap_utils','mapping_gps']
\ No newline at end of file
+__all__ = ['mapping_stations','general_mapping','mapping_stations','station_utils','colormap_utils','mapping_gps',
+           'relief_cache','batch_rendering','inventory_cache',
+           'event_cache']
\ No newline at end of file
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 13:40:05 2026
+
+@author: tlee
+
+
+Renders many figures in parallel. Each figure is described by a plain dict:
+
+    {'name' : 'AnchorageAK',                   # output file name, no extension
+     'region' : [-150.5, -148.8, 60.8, 61.65],
+     'projection' : 'M-150.2/61.3/12c',         # optional
+     'dpi' : 960,                               # optional, default 720
+     'ftype' : 'png',                           # optional
+     'base_map' : {'resolution' : '15s', ...},  # optional plot_base_map kwargs
+     'layers' : [('stations', {'inventory' : inv}),
+                 ('volcanoes', {'size' : 0.5})]}
+
+Layers are (function, kwargs) pairs, where function is either a callable or a
+name from layer_functions. Every layer function is called as
+function(fig=fig, **kwargs) and must return the figure.
+
+Each worker is its own process with its own GMT session, and all of them share
+the on-disk relief cache. Scripts using this need the usual
+if __name__ == '__main__': guard, since workers re-import the main script.
+
+Nothing that imports pygmt is imported at module level here, because a worker
+has to name its GMT session before pygmt starts it.
+"""
+
+import os
+import queue
+import inspect
+import importlib
+import traceback
+import multiprocessing
+
+layer_functions = {'stations' : 'scripts.mapping_stations.plot_stations',
+                   'events' : 'scripts.mapping_events.plot_events',
+                   'volcanoes' : 'scripts.general_mapping.plot_holocene_volcanoes',
+                   'cities' : 'scripts.general_mapping.plot_major_cities',
+                   'curve' : 'scripts.general_mapping.plot_curve',
+                   'outline' : 'scripts.general_mapping.plot_outline',
+                   'rectangle' : 'scripts.general_mapping.draw_rectangle',
+                   'text' : 'scripts.general_mapping.plot_text',
+                   'label' : 'scripts.general_mapping.plot_label',
+                   'gps_stations' : 'scripts.mapping_gps.plot_gps_stations'}
+
+def _resolve_layer_function(function):
+    if callable(function):
+        return function
+    path = layer_functions.get(function,function)
+    if '.' not in path:
+        raise ValueError(f'Unknown layer function {function}')
+    module_name, function_name = path.rsplit('.',1)
+    return getattr(importlib.import_module(module_name),function_name)
+
+def check_spec(spec):
+    """
+    Parameters
+    ----------
+    spec : dict
+        Figure specification, see the module docstring.
+
+    Raises
+    ------
+    ValueError
+        If a required key is missing or the region is malformed.
+    """
+    if type(spec) != dict:
+        raise TypeError('Figure specifications must be dicts')
+    for key in ['name','region']:
+        if key not in spec:
+            raise ValueError(f'Figure specification is missing {key}')
+    if len(spec['region']) != 4:
+        raise ValueError(f"Expected 4 items in region, got {len(spec['region'])}")
+    for layer in spec.get('layers',[]):
+        if len(layer) != 2:
+            raise ValueError('Layers must be (function, kwargs) pairs')
+
+def render_figure(spec):
+    """
+    Renders and saves a single figure in the current process.
+
+    Parameters
+    ----------
+    spec : dict
+        Figure specification, see the module docstring.
+
+    Returns
+    -------
+    fname : str
+        Path of the saved figure.
+    """
+    import scripts.general_mapping as gm
+
+    check_spec(spec)
+    base_map_kwargs = dict(spec.get('base_map',{}))
+    if 'projection' in spec:
+        base_map_kwargs['projection'] = spec['projection']
+
+    fig = gm.plot_base_map(spec['region'],**base_map_kwargs)
+    projection = base_map_kwargs.get('projection',
+                                     inspect.signature(gm.plot_base_map).parameters['projection'].default)
+    for function, kwargs in spec.get('layers',[]):
+        layer_function = _resolve_layer_function(function)
+        # City labels are laid out with the projection the map was drawn with
+        if layer_function is gm.plot_major_cities and 'projection' not in kwargs:
+            kwargs = dict(kwargs,projection=projection)
+        fig = layer_function(fig=fig,**kwargs)
+
+    dpi = spec.get('dpi',720)
+    ftype = spec.get('ftype','png')
+    gm.save_fig(fig,spec['name'],dpi=dpi,ftype=ftype)
+
+    return spec['name'] + '.' + ftype
+
+def _prefetch_relief(specs):
+    """
+    Loads the relief for every distinct base map once in this process, so the
+    workers find it in the shared cache instead of all downloading it at once.
+    """
+    import scripts.general_mapping as gm
+    import scripts.relief_cache as rc
+
+    seen = set()
+    for spec in specs:
+        base_map_kwargs = spec.get('base_map',{})
+        resolution = base_map_kwargs.get('resolution','01m')
+        data_source = base_map_kwargs.get('data_source','igpp')
+        bounds = gm.get_margin_from_bounds(spec['region'],margin=base_map_kwargs.get('margin',0.1))
+        snapped = tuple(rc.snap_region(bounds,resolution))
+        if (resolution, data_source, snapped) in seen:
+            continue
+        seen.add((resolution, data_source, snapped))
+        rc.load_relief(resolution=resolution,region=bounds,data_source=data_source)
+
+def _worker_loop(task_queue, result_queue, cache_folder, max_cache_bytes):
+    import scripts.relief_cache as rc
+    rc.set_cache_options(folder=cache_folder,max_bytes=max_cache_bytes)
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        index, spec = task
+        try:
+            result_queue.put((index, render_figure(spec), None))
+        except Exception:
+            result_queue.put((index, None, traceback.format_exc()))
+
+def render_batch(specs, n_workers: int=None, prefetch: bool=True,
+                 raise_errors: bool=True):
+    """
+    Renders a list of figures across a pool of worker processes.
+
+    Parameters
+    ----------
+    specs : list of dicts
+        Figure specifications, see the module docstring.
+    n_workers : int, optional
+        Number of worker processes. The default is the number of CPUs. With
+        1 worker, figures are rendered one after another in this process.
+    prefetch : bool, optional
+        If True, the relief for each distinct base map is loaded into the cache
+        before the workers start. The default is True.
+    raise_errors : bool, optional
+        If True, raises a RuntimeError after the batch finishes if any figure
+        failed. Otherwise failed figures are reported and given None in the
+        output. The default is True.
+
+    Returns
+    -------
+    fnames : list of str
+        Saved file for each spec, in the same order as specs.
+    """
+    for spec in specs:
+        check_spec(spec)
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = max(1,min(n_workers,len(specs)))
+
+    print(f'======RENDERING {len(specs)} FIGURES======')
+    if prefetch:
+        print('Prefetching relief grids...')
+        _prefetch_relief(specs)
+
+    fnames = [None] * len(specs)
+    errors = {}
+
+    if n_workers == 1:
+        for index, spec in enumerate(specs):
+            try:
+                fnames[index] = render_figure(spec)
+            except Exception:
+                errors[index] = traceback.format_exc()
+    else:
+        import scripts.cache_utils as cu
+        import scripts.relief_cache as rc
+
+        ctx = multiprocessing.get_context('spawn')
+        task_queue = ctx.Queue()
+        result_queue = ctx.Queue()
+        for task in enumerate(specs):
+            task_queue.put(task)
+        for i in range(n_workers):
+            task_queue.put(None)
+
+        # GMT names sessions after the parent process id, so workers started
+        # from the same parent would share a session directory unless each is
+        # given its own name before it starts.
+        old_session_name = os.environ.get('GMT_SESSION_NAME')
+        workers = []
+        try:
+            for i in range(n_workers):
+                os.environ['GMT_SESSION_NAME'] = f'batch_{os.getpid()}_{i}'
+                worker = ctx.Process(target=_worker_loop,
+                                     args=(task_queue,result_queue,
+                                           cu.cache_folder,rc.max_cache_bytes))
+                worker.start()
+                workers.append(worker)
+        finally:
+            if old_session_name is None:
+                os.environ.pop('GMT_SESSION_NAME',None)
+            else:
+                os.environ['GMT_SESSION_NAME'] = old_session_name
+
+        print(f'Started {n_workers} workers')
+        finished = set()
+        while len(finished) < len(specs):
+            try:
+                index, fname, error = result_queue.get(timeout=5)
+            except queue.Empty:
+                # A worker killed inside GMT never reports back
+                if not any(worker.is_alive() for worker in workers):
+                    break
+                continue
+            finished.add(index)
+            fnames[index] = fname
+            if error:
+                errors[index] = error
+            print(f'Finished {len(finished)}/{len(specs)}: {specs[index]["name"]}')
+
+        for index in range(len(specs)):
+            if index not in finished:
+                errors[index] = 'Worker process exited before finishing this figure'
+
+        for worker in workers:
+            worker.join()
+
+    for index, error in errors.items():
+        print(f'FAILED TO RENDER {specs[index]["name"]}')
+        print(error)
+
+    if errors and raise_errors:
+        failed = [specs[index]['name'] for index in errors]
+        raise RuntimeError(f'{len(errors)} figures failed to render: {failed}')
+
+    print('======RENDERING FINISHED======')
+
+    return fnames
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 20:05:12 2026
+
+@author: tlee
+
+
+Settings and file helpers shared by the on-disk caches (relief tiles,
+StationXML, event catalogs, binary resources and GPS stores). Only uses the standard library, so the caches
+that don't need GMT can be imported without it.
+"""
+
+import os
+import json
+
+cache_folder = os.environ.get('MAPPING_RESOURCES_CACHE',
+                              os.path.join(os.path.expanduser('~'),'.cache','mapping_resources'))
+
+def set_cache_folder(folder):
+    """
+    Parameters
+    ----------
+    folder : str
+        Folder every cache keeps its files under. The default is
+        ~/.cache/mapping_resources, or the MAPPING_RESOURCES_CACHE environment
+        variable if it is set.
+    """
+    global cache_folder
+    cache_folder = os.path.expanduser(folder)
+
+def get_cache_folder(*subfolders):
+    """Returns a folder inside the cache folder, creating it if needed"""
+    folder = os.path.join(cache_folder,*subfolders)
+    os.makedirs(folder,exist_ok=True)
+    return folder
+
+def atomic_write(path, write, mode: str=None):
+    """
+    Writes a cache file under a temporary name and moves it into place, so
+    other processes sharing the cache never read a partly written file.
+
+    Parameters
+    ----------
+    path : str
+        Final path of the file.
+    write : callable
+        Called with the temporary path, or with the open file if mode is given.
+    mode : str, optional
+        Mode to open the temporary file with, ex. 'wb'. The default is None,
+        which leaves opening it to write.
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        if mode is None:
+            write(tmp_path)
+        else:
+            with open(tmp_path,mode) as f:
+                write(f)
+        os.replace(tmp_path,path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def atomic_write_json(path, data):
+    """Writes data as JSON with atomic_write"""
+    atomic_write(path,lambda f: json.dump(data,f),mode='w')
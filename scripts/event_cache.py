@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 16:20:48 2026
+
+@author: tlee
+
+
+Local SQLite store for earthquake catalogs. Besides the events themselves it
+records which (client, bounds, magnitude, time) ranges have already been
+fetched, so a repeated query only has to request the time slices it hasn't
+seen before. Events are stored with only the columns the maps use.
+"""
+
+import os
+import sqlite3
+import urllib.parse
+import numpy as np
+
+import scripts.cache_utils as cu
+
+event_columns = ['event_id','time','longitude','latitude','depth','magnitude']
+
+def normalize_event_id(event_id):
+    """
+    Parameters
+    ----------
+    event_id : str or obspy.core.event.ResourceIdentifier
+        Event id as given by the text format (ex. 'us7000abcd') or a QuakeML
+        resource id (ex. 'quakeml:earthquake.usgs.gov/fdsnws/event/1/query?eventid=us7000abcd&format=quakeml').
+
+    Returns
+    -------
+    event_id : str
+        The eventid parameter of the resource id if it has one, otherwise its
+        last path segment, so both formats store an event under the same id.
+    """
+    event_id = str(event_id).strip()
+    params = urllib.parse.parse_qs(urllib.parse.urlparse(event_id).query)
+    if 'eventid' in params:
+        return params['eventid'][0]
+    return event_id.split('?')[0].rstrip('/').rsplit('/',1)[-1]
+
+def get_database_path():
+    """Returns the path of the event database, creating its folder if needed"""
+    event_folder = cu.get_cache_folder('events')
+    return os.path.join(event_folder,'catalog.sqlite')
+
+def connect(path: str=None):
+    """
+    Parameters
+    ----------
+    path : str, optional
+        Path of the database. The default is catalog.sqlite in the cache folder.
+
+    Returns
+    -------
+    conn : sqlite3.Connection
+        Connection to the event store, with the tables created if needed.
+    """
+    if path is None:
+        path = get_database_path()
+    conn = sqlite3.connect(path,timeout=60)
+    conn.execute('''CREATE TABLE IF NOT EXISTS events (
+                        client TEXT NOT NULL,
+                        event_id TEXT NOT NULL,
+                        time INTEGER NOT NULL,
+                        longitude REAL NOT NULL,
+                        latitude REAL NOT NULL,
+                        depth REAL,
+                        magnitude REAL NOT NULL,
+                        PRIMARY KEY (client, event_id))''')
+    conn.execute('CREATE INDEX IF NOT EXISTS events_time ON events (client, time)')
+    conn.execute('''CREATE TABLE IF NOT EXISTS fetched (
+                        client TEXT NOT NULL,
+                        minlon REAL NOT NULL,
+                        maxlon REAL NOT NULL,
+                        minlat REAL NOT NULL,
+                        maxlat REAL NOT NULL,
+                        minmag REAL NOT NULL,
+                        starttime INTEGER NOT NULL,
+                        endtime INTEGER NOT NULL)''')
+    return conn
+
+def _merge_intervals(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1],end)
+        else:
+            merged.append([start,end])
+    return merged
+
+def missing_windows(conn, client, bounds, minmag, starttime, endtime):
+    """
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection from connect.
+    client : str
+        Name of the event service.
+    bounds : list of ints or floats
+        [min_lon, max_lon, min_lat, max_lat]
+    minmag : float
+        Minimum magnitude.
+    starttime : int
+        Start of the query window, in ns since the epoch.
+    endtime : int
+        End of the query window, in ns since the epoch.
+
+    Returns
+    -------
+    windows : list of [int, int]
+        Time windows, in ns, that no fetched range with a box at least as big
+        and a magnitude at least as low covers yet.
+    """
+    rows = conn.execute('''SELECT starttime, endtime FROM fetched
+                           WHERE client = ? AND minlon <= ? AND maxlon >= ?
+                           AND minlat <= ? AND maxlat >= ? AND minmag <= ?
+                           AND endtime > ? AND starttime < ?''',
+                        (client, bounds[0], bounds[1], bounds[2], bounds[3], minmag,
+                         starttime, endtime)).fetchall()
+    covered = _merge_intervals(rows)
+
+    windows = []
+    cursor = starttime
+    for start, end in covered:
+        if start > cursor:
+            windows.append([cursor, min(start,endtime)])
+        cursor = max(cursor,end)
+        if cursor >= endtime:
+            break
+    if cursor < endtime:
+        windows.append([cursor, endtime])
+
+    return windows
+
+def store_events(conn, client, columns, bounds, minmag, starttime, endtime):
+    """
+    Adds events to the store and records the range they were fetched for.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection from connect.
+    client : str
+        Name of the event service.
+    columns : dict of numpy.ndarray
+        Event columns, with the keys in event_columns. Time is ns since the
+        epoch.
+    bounds : list of ints or floats
+        [min_lon, max_lon, min_lat, max_lat] the events were requested for.
+    minmag : float
+        Minimum magnitude the events were requested for.
+    starttime : int
+        Start of the fetched window, in ns since the epoch.
+    endtime : int
+        End of the fetched window, in ns since the epoch.
+    """
+    rows = zip([client] * len(columns['event_id']),
+               [normalize_event_id(event_id) for event_id in columns['event_id']],
+               columns['time'].tolist(),
+               columns['longitude'].tolist(),
+               columns['latitude'].tolist(),
+               columns['depth'].tolist(),
+               columns['magnitude'].tolist())
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?, ?, ?)',rows)
+        conn.execute('INSERT INTO fetched VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                     (client, bounds[0], bounds[1], bounds[2], bounds[3], minmag,
+                      starttime, endtime))
+
+def query_events(conn, client, bounds, minmag, starttime, endtime):
+    """
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection from connect.
+    client : str
+        Name of the event service.
+    bounds : list of ints or floats
+        [min_lon, max_lon, min_lat, max_lat]
+    minmag : float
+        Minimum magnitude.
+    starttime : int
+        Start of the query window, in ns since the epoch.
+    endtime : int
+        End of the query window, in ns since the epoch.
+
+    Returns
+    -------
+    columns : dict of numpy.ndarray
+        Event columns with the keys in event_columns, sorted by time.
+    """
+    rows = conn.execute('''SELECT event_id, time, longitude, latitude, depth, magnitude
+                           FROM events
+                           WHERE client = ? AND time >= ? AND time <= ?
+                           AND longitude >= ? AND longitude <= ?
+                           AND latitude >= ? AND latitude <= ?
+                           AND magnitude >= ?
+                           ORDER BY time''',
+                        (client, starttime, endtime, bounds[0], bounds[1],
+                         bounds[2], bounds[3], minmag)).fetchall()
+
+    # Stores written before ids were normalized can hold an event twice
+    seen = set()
+    unique_rows = []
+    for row in rows:
+        event_id = normalize_event_id(row[0])
+        if event_id not in seen:
+            seen.add(event_id)
+            unique_rows.append((event_id,) + tuple(row[1:]))
+    rows = unique_rows
+
+    if rows:
+        event_ids, times, lons, lats, depths, mags = zip(*rows)
+    else:
+        event_ids, times, lons, lats, depths, mags = [], [], [], [], [], []
+
+    columns = {'event_id' : np.array(event_ids,dtype=object),
+               'time' : np.array(times,dtype=np.int64),
+               'longitude' : np.array(lons,dtype=np.float64),
+               'latitude' : np.array(lats,dtype=np.float64),
+               'depth' : np.array([np.nan if d is None else d for d in depths],dtype=np.float64),
+               'magnitude' : np.array(mags,dtype=np.float64)}
+    return columns
+
+def clear_cache(path: str=None):
+    """Removes every stored event and fetched range"""
+    conn = connect(path)
+    with conn:
+        conn.execute('DELETE FROM events')
+        conn.execute('DELETE FROM fetched')
+    conn.close()
@@ -10,11 +10,21 @@ specific mapping scripts.
 """
 
 import os
+import json
+import colorsys
+import hashlib
+import tempfile
+import weakref
 import pandas as pd
 import pygmt
 import numpy as np
 from scipy import ndimage
+from scipy.spatial import cKDTree
 import math
+import warnings
+import scripts.relief_cache as rc
+import scripts.cache_utils as cu
+from scripts.geo_utils import haversine_distances, azimuthal_directions
 
 resource_folder = os.path.join(os.path.dirname(__file__),'../resources')
 
@@ -182,6 +192,120 @@ def find_elevation_range(grid):
 
     return min_elev, max_elev
 
+class BaseMapTemplate:
+    """
+    A base map (relief, hillshade, colormap, coastlines, colorbar, box and scale
+    bar) that is prepared once and can then be drawn into as many independent
+    figures as needed, e.g. one per station network. Loading the relief grid,
+    computing the hillshade and building the colormap only happen here, so each
+    clone only pays for the GMT drawing calls.
+
+    Takes the same arguments as plot_base_map.
+    """
+    def __init__(self,region,projection="Q15c+du",figure_name: str=None, resolution='01m',
+                 cmap="./Resources/colormaps/cpt-city/colombia.cpt", frame: bool=True,
+                 box_bounds=None,margin=0.1,bathymetry=False,
+                 watercolor=None,colorbar_tick=2000,data_source: str='igpp',
+                 map_scale: str=None,scalebar_height: float=10,
+                 min_elev: float=0, max_elev: float=6000,
+                 show_colorbar: bool=True):
+        if box_bounds is not None:
+            if len(box_bounds) != 4:
+                raise ValueError(f'Expected 4 items in box_bounds, got {len(box_bounds)}')
+
+        self.projection = projection
+        self.figure_name = figure_name
+        self.frame = frame
+        self.box_bounds = box_bounds
+        self.bathymetry = bathymetry
+        self.watercolor = watercolor if watercolor else "skyblue"
+        self.colorbar_tick = colorbar_tick
+        self.map_scale = map_scale
+        self.scalebar_height = scalebar_height
+        self.show_colorbar = show_colorbar
+
+        self.bounds = get_margin_from_bounds(region,margin=margin)
+        self.grid = rc.load_relief(resolution=resolution, region=self.bounds,data_source=data_source)
+        self.shade = rc.load_shade(self.grid, azimuth='0/90', normalize='t1')
+
+        # Colormaps are written to a file rather than left as the session's
+        # current CPT so that every clone gets exactly the same one
+        if cmap is not None:
+            if '/' not in cmap:
+                self.cpt = self._make_cpt_file(cmap=cmap, series=[min_elev, max_elev, 10])
+            else:
+                self.cpt = cmap
+            self.image_grid = self.grid
+        else: # If cmap is none, only plot the hillshade
+            self.cpt = self._make_cpt_file(cmap="gray", series=[-1, 1, 0.01])
+            self.image_grid = self.shade
+        self.shaded = cmap is not None
+        # Named colormaps used to be made with makecpt as the session's
+        # current CPT, which later calls like fig.colorbar() rely on
+        self.sets_current_cpt = cmap is None or '/' not in cmap
+
+    def _make_cpt_file(self, **kwargs):
+        fd, cpt_file = tempfile.mkstemp(suffix='.cpt')
+        os.close(fd)
+        pygmt.makecpt(output=cpt_file, **kwargs)
+        weakref.finalize(self, _remove_file, cpt_file)
+        return cpt_file
+
+    def clone(self):
+        """
+        Returns
+        -------
+        fig : pygmt.Figure
+            New, independent PyGMT figure with the base map drawn on it.
+        """
+        projection = self.projection
+        fig = pygmt.Figure()
+        if self.frame:
+            fig.basemap(region=self.bounds,
+                        projection=projection,
+                        frame=self.frame)
+        grdimage_kwargs = {
+            'grid': self.image_grid,
+            'projection': projection,
+            'frame': ["a", f"+t{self.figure_name}"] if self.figure_name and self.frame else (["a"] if self.frame else ["f"]),
+            'cmap': self.cpt
+        }
+        if self.shaded:
+            grdimage_kwargs['shading'] = self.shade
+        fig.grdimage(**grdimage_kwargs, region=self.bounds)
+        if self.sets_current_cpt:
+            # GMT keeps its own copy, so this outlives the temporary file
+            pygmt.makecpt(cmap=self.cpt)
+        if self.bathymetry and self.show_colorbar:
+            fig.colorbar(cmap=self.cpt,
+                         frame=[f"a{self.colorbar_tick}", "x+lElevation (m)", "y+lm"])
+        if not self.bathymetry:
+            fig.coast(shorelines="4/0.5p,black",
+                      projection=projection,
+                      borders="a/1.2p,black",
+                      water=self.watercolor,
+                      resolution="f")
+        if self.box_bounds is not None:
+            bminlon = self.box_bounds[0]
+            bmaxlon = self.box_bounds[1]
+            bminlat = self.box_bounds[2]
+            bmaxlat = self.box_bounds[3]
+            blats = [bminlat, bmaxlat, bmaxlat, bminlat, bminlat]
+            blons = [bminlon, bminlon, bmaxlon, bmaxlon, bminlon]
+            fig.plot(x=blons,
+                     y=blats,
+                     pen="1p")
+        if self.map_scale is not None:
+            with pygmt.config(MAP_SCALE_HEIGHT=f"{self.scalebar_height}p"):
+                fig.basemap(map_scale=self.map_scale)
+        return fig
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
 def plot_base_map(region,projection="Q15c+du",figure_name: str=None, resolution='01m',
                   cmap="./Resources/colormaps/cpt-city/colombia.cpt", frame: bool=True,
                   box_bounds=None,margin=0.1,bathymetry=False,
@@ -221,61 +345,21 @@ def plot_base_map(region,projection="Q15c+du",figure_name: str=None, resolution=
     -------
     fig : pygmt.Figure
         PyGMT figure to use as basemap
+
+    If several figures share the same base map, create a BaseMapTemplate once
+    and call its clone method for each figure instead.
+
+    When cmap is a colormap name or None, the colormap is left as the figure's
+    current CPT, so fig.colorbar() without a cmap still shows it.
     """
-    if not watercolor:
-        watercolor = "skyblue"
-    bounds = get_margin_from_bounds(region,margin=margin)
-    grid = pygmt.datasets.load_earth_relief(resolution=resolution, region=bounds,data_source=data_source)
-    shade = pygmt.grdgradient(grid=grid, azimuth='0/90', normalize='t1')
-    fig = pygmt.Figure()
-    if cmap is not None:
-        if '/' not in cmap:
-            _cmap = True
-            pygmt.makecpt(cmap=cmap, series=[min_elev, max_elev, 10])
-        else:
-            _cmap = cmap
-        _grid = grid
-    else: # If cmap is none, only plot the hillshade
-        _grid = shade
-        _cmap = True
-        pygmt.makecpt(cmap="gray", series=[-1, 1, 0.01])
-    if frame:
-        fig.basemap(region=bounds,
-                    projection=projection,
-                    frame=frame)
-    grdimage_kwargs = {
-        'grid': _grid,
-        'projection': projection,
-        'frame': ["a", f"+t{figure_name}"] if figure_name and frame else (["a"] if frame else ["f"]),
-        'cmap': _cmap
-    }
-    if cmap is not None:
-        grdimage_kwargs['shading'] = shade
-    fig.grdimage(**grdimage_kwargs, region=bounds)
-    if bathymetry and show_colorbar:
-        fig.colorbar(frame=[f"a{colorbar_tick}", "x+lElevation (m)", "y+lm"])
-    if not bathymetry:
-        fig.coast(shorelines="4/0.5p,black",
-                  projection=projection,
-                  borders="a/1.2p,black",
-                  water=watercolor,
-                  resolution="f")
-    if box_bounds != None:
-        if len(bounds) != 4:
-            raise ValueError(f'Expected 4 items in box_bounds, got {len(box_bounds)}')
-        bminlon = box_bounds[0]
-        bmaxlon = box_bounds[1]
-        bminlat = box_bounds[2]
-        bmaxlat = box_bounds[3]
-        blats = [bminlat, bmaxlat, bmaxlat, bminlat, bminlat]
-        blons = [bminlon, bminlon, bmaxlon, bmaxlon, bminlon]
-        fig.plot(x=blons,
-                 y=blats,
-                 pen="1p")
-    if map_scale != None:
-        with pygmt.config(MAP_SCALE_HEIGHT=f"{scalebar_height}p"):
-            fig.basemap(map_scale=map_scale)
-    return fig
+    template = BaseMapTemplate(region,projection=projection,figure_name=figure_name,
+                               resolution=resolution,cmap=cmap,frame=frame,
+                               box_bounds=box_bounds,margin=margin,bathymetry=bathymetry,
+                               watercolor=watercolor,colorbar_tick=colorbar_tick,
+                               data_source=data_source,map_scale=map_scale,
+                               scalebar_height=scalebar_height,min_elev=min_elev,
+                               max_elev=max_elev,show_colorbar=show_colorbar)
+    return template.clone()
 
 def plot_base_map3d(region, max_depth: -6000, max_elev: 6200, projection="Q15c+du",
                     figure_name: str=None, resolution='01m', perspective = [180, 30],
@@ -320,8 +404,8 @@ def plot_base_map3d(region, max_depth: -6000, max_elev: 6200, projection="Q15c+d
 
     bounds = get_margin_from_bounds(region,margin=margin)
 
-    grid = pygmt.datasets.load_earth_relief(resolution=resolution, region=bounds,data_source=data_source)
-    shade = pygmt.grdgradient(grid=grid, azimuth='90/50', normalize='t1')
+    grid = rc.load_relief(resolution=resolution, region=bounds,data_source=data_source)
+    shade = rc.load_shade(grid, azimuth='90/50', normalize='t1')
 
     fig = pygmt.Figure()
     if figure_name is not None:
@@ -415,8 +499,174 @@ def plot_label(fig,lat,lon,style='b0.35c',fill='black',label=None,
     return fig
 
 
+def get_category_colors(num_categories, palette=None):
+    """
+    Parameters
+    ----------
+    num_categories : int
+        Number of categories to color.
+    palette : list of str, optional
+        GMT colors to use first. The default is None, for generated colors only.
+
+    Returns
+    -------
+    colors : list of str
+        GMT colors, starting with palette and continuing with evenly spread
+        hues when there are more categories than palette colors.
+    """
+    colors = list(palette[:num_categories]) if palette else []
+    for i in range(len(colors), num_categories):
+        hue = (i * 0.618033988749895) % 1
+        r, g, b = colorsys.hsv_to_rgb(hue, 0.7, 0.95)
+        colors.append(f'{round(r*255)}/{round(g*255)}/{round(b*255)}')
+    return colors
+
+def write_category_cpt(labels, colors):
+    """
+    Writes a categorical CPT mapping 0, 1, 2... to colors, so points can be
+    colored by a category index in a single plot call. The caller removes the
+    file when done.
+    """
+    fd, cpt_file = tempfile.mkstemp(suffix='.cpt')
+    with os.fdopen(fd,'w') as f:
+        for i, (label, color) in enumerate(zip(labels,colors)):
+            f.write(f'{i}\t{color}\t;{label}\n')
+    return cpt_file
+
+def write_category_legend(labels, colors, symbol='t', size='0.4c', pen='0.2p'):
+    """Writes a GMT legend spec with one symbol entry per category. The caller removes the file when done."""
+    fd, legend_file = tempfile.mkstemp(suffix='.txt')
+    with os.fdopen(fd,'w') as f:
+        for label, color in zip(labels,colors):
+            f.write(f'S 0.25c {symbol} {size} {color} {pen} 0.6c {label}\n')
+    return legend_file
+
+def lon_in_range(lons, min_lon, max_lon):
+    """
+    Dateline aware longitude test. Regions may cross the dateline either as
+    min_lon > max_lon (e.g. [170, -170]) or in 0-360 form (e.g. [170, 190]).
+
+    Parameters
+    ----------
+    lons : numpy.ndarray
+        Longitudes to test.
+    min_lon : int or float
+        Western edge.
+    max_lon : int or float
+        Eastern edge.
+
+    Returns
+    -------
+    in_range : numpy.ndarray
+        Boolean mask of the longitudes inside the range.
+    shifted_lons : numpy.ndarray
+        Longitudes wrapped into the same 360 degrees as the region, for plotting.
+    """
+    lons = np.asarray(lons,dtype=np.float64)
+    span = max_lon - min_lon
+    if span <= 0:
+        span += 360
+    relative = (lons - min_lon) % 360
+    in_range = relative <= span if span < 360 else np.ones(len(lons),dtype=bool)
+    return in_range, min_lon + relative
+
+def _eruption_years(last_eruptions):
+    """Converts 'Last Known Eruption' strings ('1980 CE', '4040 BCE', 'Unknown') to signed years, NaN if unknown"""
+    years = np.full(len(last_eruptions),np.nan)
+    for i, value in enumerate(last_eruptions):
+        parts = str(value).split()
+        if len(parts) == 2 and parts[0].isdigit():
+            years[i] = -int(parts[0]) if parts[1] == 'BCE' else int(parts[0])
+    return years
+
+class VolcanoTable:
+    """
+    Holocene volcano list (GVP_Volcano_List_Holocene.csv) sorted by latitude,
+    so a region only looks at the rows in its latitude band, with the last
+    eruption parsed into signed years (BCE negative) once.
+    """
+    def __init__(self, columns):
+        order = np.argsort(np.asarray(columns['Latitude'],dtype=np.float64),kind='stable')
+        self.lats = np.asarray(columns['Latitude'],dtype=np.float64)[order]
+        self.lons = np.asarray(columns['Longitude'],dtype=np.float64)[order]
+        self.names = np.asarray(columns['Volcano Name'])[order]
+        self.types = np.asarray(columns['Primary Volcano Type'])[order]
+        self.settings = np.asarray(columns['Tectonic Setting'])[order]
+        self.last_eruptions = _eruption_years(np.asarray(columns['Last Known Eruption'])[order])
+
+    def __len__(self):
+        return len(self.lats)
+
+    @staticmethod
+    def _matches(values, patterns):
+        """Case insensitive substring match against one pattern or a list of them"""
+        if type(patterns) == str:
+            patterns = [patterns]
+        lowered = np.char.lower(values.astype(str))
+        keep = np.zeros(len(values),dtype=bool)
+        for pattern in patterns:
+            keep |= np.char.find(lowered,pattern.lower()) >= 0
+        return keep
+
+    def select(self, bounds=None, volcano_type=None, erupted_since=None,
+               tectonic_setting=None):
+        """
+        Parameters
+        ----------
+        bounds : list of ints or floats, optional
+            [min_lon, max_lon, min_lat, max_lat], see lon_in_range for regions
+            crossing the dateline. The default is None, for everywhere.
+        volcano_type : str or list of str, optional
+            Keep volcanoes whose primary type contains one of these, e.g.
+            'Stratovolcano' or ['Caldera','Shield']. The default is None.
+        erupted_since : int, optional
+            Keep volcanoes whose last known eruption is in or after this year,
+            negative for BCE. Unknown eruptions are dropped. The default is None.
+        tectonic_setting : str or list of str, optional
+            Keep volcanoes whose tectonic setting contains one of these, e.g.
+            'Subduction zone'. The default is None.
+
+        Returns
+        -------
+        indices : numpy.ndarray
+            Indices of the selected volcanoes.
+        lons : numpy.ndarray
+            Their longitudes, wrapped to the region for plotting.
+        """
+        if bounds is None:
+            first, last = 0, len(self.lats)
+            keep = np.ones(last,dtype=bool)
+            lons = self.lons
+        else:
+            min_lon, max_lon, min_lat, max_lat = bounds
+            first = np.searchsorted(self.lats,min_lat,side='left')
+            last = np.searchsorted(self.lats,max_lat,side='right')
+            keep, lons = lon_in_range(self.lons[first:last],min_lon,max_lon)
+
+        if volcano_type is not None:
+            keep &= self._matches(self.types[first:last],volcano_type)
+        if tectonic_setting is not None:
+            keep &= self._matches(self.settings[first:last],tectonic_setting)
+        if erupted_since is not None:
+            keep &= self.last_eruptions[first:last] >= erupted_since
+
+        return np.flatnonzero(keep) + first, lons[keep]
+
+# Loaded volcano table and the columns it was built from
+_volcano_table = [None, None]
+
+def get_volcano_table():
+    """Returns the VolcanoTable, built once per process and again only if the CSV changes"""
+    columns = load_resource('GVP_Volcano_List_Holocene.csv')
+    if _volcano_table[0] is not columns:
+        _volcano_table[:] = [columns, VolcanoTable(columns)]
+    return _volcano_table[1]
+
 def plot_holocene_volcanoes(fig,size: float=0.35,
-                            style: str='t', fill: str='red'):
+                            style: str='t', fill: str='red', bounds=None,
+                            volcano_type=None, erupted_since: int=None,
+                            tectonic_setting=None, color_by: str=None,
+                            cmap: str='hot', legend: bool=False):
     """
     Parameters
     ----------
@@ -425,6 +675,28 @@ def plot_holocene_volcanoes(fig,size: float=0.35,
         to create initial figure.
     size : float
         Size of markers.
+    style : str, optional
+        GMT symbol. The default is 't'.
+    fill : str, optional
+        Marker color when color_by is None. The default is 'red'.
+    bounds : list of ints or floats, optional
+        [min_lon, max_lon, min_lat, max_lat] to plot volcanoes in. The default
+        is the figure region, or everywhere if the figure has none yet.
+    volcano_type : str or list of str, optional
+        Only plot these volcano types, see VolcanoTable.select.
+    erupted_since : int, optional
+        Only plot volcanoes that last erupted in or after this year, negative
+        for BCE.
+    tectonic_setting : str or list of str, optional
+        Only plot these tectonic settings, see VolcanoTable.select.
+    color_by : str, optional
+        'type' or 'setting' to color by category, or 'eruption' to color by
+        the year of the last known eruption. The default is None, for fill.
+    cmap : str, optional
+        Colormap for color_by='eruption'. The default is 'hot'.
+    legend : bool, optional
+        If True and coloring by category, adds a legend of the categories.
+        The default is False.
 
     Returns
     -------
@@ -432,15 +704,72 @@ def plot_holocene_volcanoes(fig,size: float=0.35,
         Figure with added volcanoes.
 
     """
-    vol_file = os.path.join(resource_folder,'GVP_Volcano_List_Holocene.csv')
-    holo_volc_df = pd.read_csv(vol_file)
-    holocene_vol_lon_list = holo_volc_df['Longitude'].tolist()
-    holocene_vol_lat_list = holo_volc_df['Latitude'].tolist()
-
-    fig.plot(x=holocene_vol_lon_list,
-             y=holocene_vol_lat_list,
-             style=f'{style}/{size}c',
-             fill=fill)
+    if color_by not in [None, 'type', 'setting', 'eruption']:
+        raise ValueError(f"color_by must be None, 'type', 'setting' or 'eruption', got {color_by}")
+
+    if bounds is None:
+        try:
+            bounds = get_bounds_from_figure(fig)
+        except Exception:
+            bounds = None
+
+    table = get_volcano_table()
+    if color_by == 'eruption' and erupted_since is None:
+        # Volcanoes with unknown eruptions have no color
+        erupted_since = -np.inf
+    indices, lons = table.select(bounds=bounds,
+                                 volcano_type=volcano_type,
+                                 erupted_since=erupted_since,
+                                 tectonic_setting=tectonic_setting)
+    if len(indices) == 0:
+        print('No volcanoes match the region and filters')
+        return fig
+
+    if color_by is None:
+        fig.plot(x=lons,
+                 y=table.lats[indices],
+                 style=f'{style}/{size}c',
+                 fill=fill)
+        return fig
+
+    if color_by == 'eruption':
+        years = table.last_eruptions[indices]
+        with tempfile.NamedTemporaryFile(suffix='.cpt',delete=False) as f:
+            cpt_file = f.name
+        try:
+            pygmt.makecpt(cmap=cmap,series=[years.min(),max(years.max(),years.min() + 1)],
+                          output=cpt_file)
+            fig.plot(x=lons,
+                     y=table.lats[indices],
+                     style=f'{style}/{size}c',
+                     fill=years,
+                     cmap=cpt_file,
+                     pen='0.2p')
+            fig.colorbar(cmap=cpt_file,frame=['x+lLast eruption (year)'])
+        finally:
+            os.remove(cpt_file)
+        return fig
+
+    values = table.types[indices] if color_by == 'type' else table.settings[indices]
+    category_index, categories = pd.factorize(values)
+    colors = get_category_colors(len(categories))
+    cpt_file = write_category_cpt(categories,colors)
+    try:
+        fig.plot(x=lons,
+                 y=table.lats[indices],
+                 style=f'{style}/{size}c',
+                 fill=category_index,
+                 cmap=cpt_file,
+                 pen='0.2p')
+    finally:
+        os.remove(cpt_file)
+
+    if legend:
+        legend_file = write_category_legend(categories,colors,symbol=style,size=f'{size}c')
+        try:
+            fig.legend(spec=legend_file)
+        finally:
+            os.remove(legend_file)
 
     return fig
 
@@ -468,12 +797,396 @@ def get_map_dimensions(fig):
 
     return height,width,diag
 
+# Loaded resource tables, keyed by CSV path, with the mtime and size they were read at
+_resources = {}
+
+def _resource_path(fname):
+    if os.path.isfile(fname):
+        return os.path.abspath(fname)
+    # The datasets are checked in under Resources/, which only matches
+    # resource_folder on case insensitive file systems
+    for folder in [resource_folder, os.path.join(os.path.dirname(__file__),'../Resources')]:
+        path = os.path.join(folder,fname)
+        if os.path.isfile(path):
+            return os.path.abspath(path)
+    return os.path.abspath(os.path.join(resource_folder,fname))
+
+def _convert_resource(csv_path, binary_folder, stat):
+    """Parses a CSV once and writes each column as its own .npy file"""
+    print(f'Converting {os.path.basename(csv_path)} to binary...')
+    df = pd.read_csv(csv_path,encoding='utf-8-sig')
+    os.makedirs(binary_folder,exist_ok=True)
+
+    column_files = {}
+    for i, column in enumerate(df.columns):
+        values = df[column]
+        if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            array = values.to_numpy(dtype=np.float64)
+        else:
+            # Fixed width strings, unlike objects, can be memory mapped
+            array = values.fillna('').astype(str).to_numpy().astype(str)
+        fname = f'column_{i}.npy'
+        cu.atomic_write(os.path.join(binary_folder,fname),lambda f: np.save(f,array),mode='wb')
+        column_files[column] = fname
+
+    # The metadata is written last, so it only exists once every column does
+    meta = {'source' : csv_path,
+            'mtime_ns' : stat.st_mtime_ns,
+            'size' : stat.st_size,
+            'columns' : column_files}
+    cu.atomic_write_json(os.path.join(binary_folder,'meta.json'),meta)
+    return meta
+
+def load_resource(fname):
+    """
+    Loads a bundled CSV dataset (e.g. GVP_Volcano_List_Holocene.csv) as NumPy
+    columns. The first time a CSV is used it is converted to one .npy file per
+    column in the cache folder; after that the columns are memory mapped, and
+    within a process the result is kept, so the CSV is only parsed again if it
+    changes.
+
+    Parameters
+    ----------
+    fname : str
+        CSV path, or a file name in the resource folder.
+
+    Returns
+    -------
+    columns : dict of numpy.ndarray
+        One read only array per CSV column. Numeric columns are float64 and
+        everything else is fixed width strings, with '' for missing values.
+    """
+    csv_path = _resource_path(fname)
+    stat = os.stat(csv_path)
+
+    cached = _resources.get(csv_path)
+    if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+        return cached[1]
+
+    key = hashlib.sha1(csv_path.encode('utf-8')).hexdigest()
+    binary_folder = os.path.join(cu.cache_folder,'resources',key)
+    meta = None
+    try:
+        with open(os.path.join(binary_folder,'meta.json')) as f:
+            meta = json.load(f)
+        if meta['mtime_ns'] != stat.st_mtime_ns or meta['size'] != stat.st_size:
+            meta = None
+    except (OSError, ValueError, KeyError):
+        meta = None
+    if meta is None:
+        meta = _convert_resource(csv_path,binary_folder,stat)
+
+    columns = {column : np.load(os.path.join(binary_folder,column_file),mmap_mode='r')
+               for column, column_file in meta['columns'].items()}
+    _resources[csv_path] = ((stat.st_mtime_ns, stat.st_size), columns)
+
+    return columns
+
+class CityIndex:
+    """
+    Spatial index over a cities dataset. Cities are kept sorted by latitude so
+    a bounding box only has to look at the rows in its latitude band, and a
+    KD-tree over (lon, lat) answers radius queries. Distances are in degrees,
+    measured the same way as in plot_major_cities.
+    """
+    def __init__(self, lats, lons, names, populations):
+        lats = np.asarray(lats,dtype=np.float64)
+        order = np.argsort(lats,kind='stable')
+        self.lats = lats[order]
+        self.lons = np.asarray(lons,dtype=np.float64)[order]
+        self.names = np.asarray(names,dtype=object)[order]
+        self.populations = np.asarray(populations,dtype=np.float64)[order]
+        self.tree = cKDTree(np.column_stack([self.lons,self.lats]))
+
+    @classmethod
+    def from_columns(cls, columns):
+        """
+        Builds the index from cities columns (a DataFrame or a dict of arrays,
+        as from load_resource) with lat, lng, city_ascii (or city) and
+        population columns.
+        """
+        name_column = 'city_ascii' if 'city_ascii' in columns else 'city'
+        populations = np.asarray(columns['population'],dtype=np.float64)
+        return cls(np.asarray(columns['lat']),np.asarray(columns['lng']),
+                   np.asarray(columns[name_column]),populations)
+
+    def __len__(self):
+        return len(self.lats)
+
+    def in_bounds(self, bounds, minpopulation=0):
+        """
+        Parameters
+        ----------
+        bounds : list of ints or floats
+            [min_lon, max_lon, min_lat, max_lat]. A min_lon larger than max_lon
+            is taken to cross the dateline.
+        minpopulation : int, optional
+            Minimum population. The default is 0.
+
+        Returns
+        -------
+        indices : numpy.ndarray
+            Indices of the cities inside bounds, largest population first.
+        """
+        min_lon, max_lon, min_lat, max_lat = bounds
+        first = np.searchsorted(self.lats,min_lat,side='left')
+        last = np.searchsorted(self.lats,max_lat,side='right')
+        lons = self.lons[first:last]
+        if min_lon <= max_lon:
+            keep = (lons >= min_lon) & (lons <= max_lon)
+        else:
+            keep = (lons >= min_lon) | (lons <= max_lon)
+        keep &= self.populations[first:last] >= minpopulation
+
+        indices = np.flatnonzero(keep) + first
+        return indices[np.argsort(-self.populations[indices],kind='stable')]
+
+    def within_radius(self, lon, lat, radius):
+        """Returns the indices of the cities within radius degrees of (lon, lat)"""
+        return np.array(sorted(self.tree.query_ball_point([lon,lat],radius)),dtype=np.int64)
+
+    def close_pairs(self, indices, radius):
+        """
+        Parameters
+        ----------
+        indices : numpy.ndarray
+            Cities to check, e.g. from in_bounds.
+        radius : float
+            Distance in degrees.
+
+        Returns
+        -------
+        pairs : numpy.ndarray
+            (n, 2) array of the index pairs, out of indices, closer than radius.
+        """
+        indices = np.asarray(indices,dtype=np.int64)
+        if len(indices) < 2:
+            return np.empty((0,2),dtype=np.int64)
+        subset_tree = cKDTree(np.column_stack([self.lons[indices],self.lats[indices]]))
+        pairs = subset_tree.query_pairs(radius,output_type='ndarray')
+        return indices[pairs]
+
+# Loaded city indexes, keyed by file, so each is only built once per process
+_city_indexes = {}
+
+def get_city_index(cities_csv: str=None):
+    """
+    Parameters
+    ----------
+    cities_csv : str, optional
+        Cities CSV with lat, lng, city_ascii (or city) and population columns.
+        The default is worldcities.csv in the resource folder.
+
+    Returns
+    -------
+    city_index : CityIndex
+        Index over the cities, built on the first call for each file and
+        reused until the file changes.
+    """
+    if cities_csv is None:
+        cities_csv = 'worldcities.csv'
+    columns = load_resource(cities_csv)
+
+    # The index is rebuilt whenever load_resource has reloaded the columns
+    key = _resource_path(cities_csv)
+    cached = _city_indexes.get(key)
+    if cached is None or cached[0] is not columns:
+        _city_indexes[key] = (columns, CityIndex.from_columns(columns))
+
+    return _city_indexes[key][1]
+
+def map_project(lons, lats, region, projection: str, inverse: bool=False):
+    """
+    Converts points between geographic coordinates and their position on the
+    map in cm, using GMT mapproject with the given region and projection.
+
+    Parameters
+    ----------
+    lons : numpy.ndarray
+        Longitudes of the points, or x positions in cm with inverse.
+    lats : numpy.ndarray
+        Latitudes of the points, or y positions in cm with inverse.
+    region : list of ints or floats
+        [min_lon, max_lon, min_lat, max_lat]
+    projection : str
+        GMT specs for projection, ex. 'M-150.2/61.3/12c'.
+    inverse : bool, optional
+        If True, converts map positions in cm back to longitudes and latitudes.
+        The default is False.
+
+    Returns
+    -------
+    xs : numpy.ndarray
+        x positions in cm from the left edge of the map, or longitudes with
+        inverse.
+    ys : numpy.ndarray
+        y positions in cm from the bottom edge of the map, or latitudes with
+        inverse.
+    """
+    xs = np.asarray(lons,dtype=np.float64)
+    ys = np.asarray(lats,dtype=np.float64)
+    if len(xs) == 0:
+        return xs, ys
+
+    args = _map_project_args(region,projection)
+    if inverse:
+        args.append('-I')
+    with pygmt.clib.Session() as lib:
+        with lib.virtualfile_in(x=xs,y=ys,check_kind='vector') as vintbl, \
+                lib.virtualfile_out(kind='dataset') as vouttbl:
+            lib.call_module('mapproject',[vintbl,*args,f'->{vouttbl}'])
+            projected = lib.virtualfile_to_dataset(vfname=vouttbl,output_type='numpy')
+
+    return projected[:,0], projected[:,1]
+
+def get_map_size(region, projection: str):
+    """
+    Parameters
+    ----------
+    region : list of ints or floats
+        [min_lon, max_lon, min_lat, max_lat]
+    projection : str
+        GMT specs for projection.
+
+    Returns
+    -------
+    map_width : float
+        Width of the map in cm.
+    map_height : float
+        Height of the map in cm.
+    """
+    args = _map_project_args(region,projection)
+    with pygmt.clib.Session() as lib:
+        with lib.virtualfile_out(kind='dataset') as vouttbl:
+            lib.call_module('mapproject',[*args,'-W',f'->{vouttbl}'])
+            size = lib.virtualfile_to_dataset(vfname=vouttbl,output_type='numpy')
+
+    return float(size[0,0]), float(size[0,1])
+
+def _map_project_args(region, projection):
+    min_lon, max_lon, min_lat, max_lat = region
+    if min_lon > max_lon:
+        max_lon += 360
+    if max_lon <= min_lon or max_lat <= min_lat:
+        raise ValueError(f'Bounds {region} have no area')
+    if not projection:
+        raise ValueError('A projection is needed to place points on the map')
+    return [f'-R{min_lon}/{max_lon}/{min_lat}/{max_lat}',f'-J{projection}','-Dc']
+
+def place_labels(lons, lats, names, bounds, projection: str, fontsize=14,
+                 offset=0.02, dot_size=0.35, min_separation: float=0):
+    """
+    Greedily chooses which points to label so that no two labels or dots
+    overlap. Points are tried in the order given, so pass the most important
+    first. Each point tries a label above, below, right and left of its dot and
+    takes the first spot that is inside the map and clear of everything placed
+    so far, according to an occupancy grid over the map. Points with no free
+    spot are dropped.
+
+    Points are placed on the map with the given region and projection (see
+    map_project), so label boxes, sized from the font size (Helvetica-Bold,
+    about 0.6 em per character), are laid out in cm as they will be drawn.
+
+    Parameters
+    ----------
+    lons : numpy.ndarray
+        Longitudes of the points.
+    lats : numpy.ndarray
+        Latitudes of the points.
+    names : list of str
+        Label text.
+    bounds : list of ints or floats
+        [min_lon, max_lon, min_lat, max_lat]
+    projection : str
+        GMT specs for projection, the same one the map is drawn with.
+    fontsize : int or float, optional
+        Label font size in points. The default is 14.
+    offset : float, optional
+        Distance between dot and label, as a fraction of the map height.
+        The default is 0.02.
+    dot_size : float, optional
+        Dot size in cm. The default is 0.35.
+    min_separation : float, optional
+        Points closer than this many cm to an already labelled point are
+        dropped. The default is 0.
+
+    Returns
+    -------
+    keep : numpy.ndarray
+        Indices of the points that were labelled, in placement order.
+    label_lons : numpy.ndarray
+        Longitudes of the label centers.
+    label_lats : numpy.ndarray
+        Latitudes of the label centers.
+    """
+    map_width, map_height = get_map_size(bounds,projection)
+    xs, ys = map_project(lons,lats,bounds,projection)
+
+    char_height = fontsize * 2.54 / 72
+    pad = 0.1 * char_height
+    cell = char_height / 2
+    num_cols = int(np.ceil(map_width / cell)) + 1
+    num_rows = int(np.ceil(map_height / cell)) + 1
+    occupied = np.zeros((num_rows, num_cols), dtype=bool)
+
+    def cells(x0, x1, y0, y1):
+        return (slice(max(int(y0 // cell),0), int(y1 // cell) + 1),
+                slice(max(int(x0 // cell),0), int(x1 // cell) + 1))
+
+    gap = offset * map_height
+    half_dot = dot_size / 2
+    keep = []
+    label_xs = []
+    label_ys = []
+
+    for i, (x, y, name) in enumerate(zip(xs, ys, names)):
+        if min_separation > 0 and keep:
+            if np.hypot(xs[keep] - x, ys[keep] - y).min() < min_separation:
+                continue
+
+        dot_cells = cells(x - half_dot, x + half_dot, y - half_dot, y + half_dot)
+        if occupied[dot_cells].any():
+            continue
+
+        half_width = 0.6 * char_height * len(str(name)) / 2 + pad
+        half_height = char_height / 2 + pad
+        candidates = [(x, y + half_dot + gap + half_height),
+                      (x, y - half_dot - gap - half_height),
+                      (x + half_dot + gap + half_width, y),
+                      (x - half_dot - gap - half_width, y)]
+
+        for label_x, label_y in candidates:
+            x0, x1 = label_x - half_width, label_x + half_width
+            y0, y1 = label_y - half_height, label_y + half_height
+            if x0 < 0 or y0 < 0 or x1 > map_width or y1 > map_height:
+                continue
+            label_cells = cells(x0, x1, y0, y1)
+            if occupied[label_cells].any():
+                continue
+            occupied[label_cells] = True
+            occupied[dot_cells] = True
+            keep.append(i)
+            label_xs.append(label_x)
+            label_ys.append(label_y)
+            break
+
+    keep = np.array(keep,dtype=np.int64)
+    label_lons, label_lats = map_project(label_xs,label_ys,bounds,projection,
+                                         inverse=True)
+    label_lons = np.where(label_lons > 180, label_lons - 360, label_lons)
+
+    return keep, label_lons, label_lats
+
 def plot_major_cities(fig,bounds=None,minpopulation=100000,
                       fontsize=14,offset=0.02,size=0.35,symbol='c',
                       color='black',label_color='black',
                       close_threshhold = 0.005,
-                      hor_offset_multiplier=3.5):
+                      hor_offset_multiplier=None,cities_csv: str=None,
+                      projection: str=None,legend: bool=True):
     """
+    Plots the largest cities in the map that can be labelled without any
+    labels overlapping, see place_labels.
+
     Parameters
     ----------
     fig : pygmt.Figure
@@ -493,119 +1206,75 @@ def plot_major_cities(fig,bounds=None,minpopulation=100000,
         Color of city labels. The default is 'black'.
     close_threshhold: float, optional
         Distance, as a fraction of the length of the figure diagonal, below
-        which two very close cities will only plot the larger of the two.
+        which a city next to a larger, already plotted city is left out.
     hor_offset_multiplier: float, optional
-        For cities that are near the longitudinal boundaries, their label will
-        be shifted inward. This multiplier chooses how far in they will be shifted,
-        and will need to be adjusted depending on your font size and the length
-        of your longest city name that needs adjusting.
+        Deprecated and ignored, passing it raises a DeprecationWarning. Labels
+        near the map edge are moved to the side of the dot that keeps them on
+        the map.
+    cities_csv : str, optional
+        Cities CSV to use, see get_city_index. The default is worldcities.csv
+        in the resource folder.
+    projection : str
+        GMT specs for the projection fig was drawn with, ex. 'M-150.2/61.3/12c',
+        used to lay out the labels. Required.
+    legend : bool, optional
+        If True, each city gets its own legend entry, as before labels were
+        laid out together. If False, all dots are drawn in one call with no
+        legend entries, which is faster for many cities. The default is True.
 
     Returns
     -------
     fig : pygmt.Figure
         Figure with added cities.
     """
+    if projection is None:
+        raise ValueError('plot_major_cities needs the projection fig was drawn with')
+    if hor_offset_multiplier is not None:
+        warnings.warn('hor_offset_multiplier is no longer used, labels are placed by place_labels',
+                      DeprecationWarning,stacklevel=2)
     if bounds == None:
         bounds = get_bounds_from_figure(fig)
 
-    min_lon = bounds[0]
-    max_lon = bounds[1]
-    min_lat = bounds[2]
-    max_lat = bounds[3]
-
-    cities_csv = os.path.join(resource_folder,'worldcities.csv')
-    cities_df = pd.read_csv(cities_csv)
-
-    # Pulling cities that meet criteria
-    df_in_lat = cities_df[cities_df['lat'].between(min_lat,max_lat)]
-    df_in_bounds = df_in_lat[df_in_lat['lng'].between(min_lon,max_lon)]
-    df_meets_crit = df_in_bounds[df_in_bounds['population'] >= minpopulation]
-
-    city_list = []
-    for index, row in df_meets_crit.iterrows():
-        city = [row['lat'],row['lng'],row['city_ascii'],row['population']]
-        city_list.append(city)
-
-    height,width,diag = get_map_dimensions(fig)
-    threshhold_distance = diag * close_threshhold
-
-    num_cities = len(city_list)
-    last_city_index = num_cities
-    problem_pair_list = []
-
-    for i, city in enumerate(city_list):
-        for index in np.arange(i+1,last_city_index,1):
-            city2 = city_list[index]
-            lat1 = city[0]
-            lon1 = city[1]
-            lat2 = city2[0]
-            lon2 = city2[1]
-
-            distance = (((lat1-lat2) **2) + (lon1-lon2) **2) **0.5
-            if distance < threshhold_distance:
-                problem_pair = [i, index]
-                problem_pair_list.append(problem_pair)
-
-    if len(problem_pair_list) > 0:
-        if len(problem_pair_list) <= 5:
-            print('WARNING: These cities are too close:')
-            for pair in problem_pair_list:
-
-                prob1 = pair[0]
-                prob2 = pair[1]
-
-                print(f'{city_list[prob1][2]} and {city_list[prob2][2]}')
-            print('The larger of the two cities will be plotted. Decrease close_threshhold to change this behavior')
-        else:
-            print('Warning: more than 5 cities are too close')
-            print('The largest of these cities will be plotted. Decrease close_threshhold to change this behavior')
-
-        to_remove_list = []
-        for pair in problem_pair_list:
-            prob1 = pair[0]
-            prob2 = pair[1]
-
-            # If you're getting an error here with index out of bound, it's because
-            # your close_threshhold is too high and too many cities are being
-            # removed, which makes this script very confused.
-            if city_list[prob1][3] > city_list[prob2][3]:
-                to_remove_list.append(city_list[prob2])
-            else:
-                to_remove_list.append(city_list[prob1])
-
-        city_list = [e for e in city_list if e not in to_remove_list]
-
-    standard_offset_height = height * offset
-    standard_offset_width = width * offset * hor_offset_multiplier
-
-    for city in city_list:
-        fig.plot(x=city[1],
-                 y=city[0],
+    # Pulling cities that meet criteria, largest first
+    city_index = get_city_index(cities_csv)
+    candidates = city_index.in_bounds(bounds,minpopulation=minpopulation)
+
+    map_width, map_height = get_map_size(bounds,projection)
+    threshhold_distance = math.hypot(map_width,map_height) * close_threshhold
+
+    keep, label_lons, label_lats = place_labels(city_index.lons[candidates],
+                                                city_index.lats[candidates],
+                                                city_index.names[candidates],
+                                                bounds,
+                                                projection=projection,
+                                                fontsize=fontsize,
+                                                offset=offset,
+                                                dot_size=size,
+                                                min_separation=threshhold_distance)
+    if len(keep) < len(candidates):
+        print(f'{len(candidates) - len(keep)} cities left out to keep labels from overlapping')
+    if len(keep) == 0:
+        return fig
+
+    cities = candidates[keep]
+    if legend:
+        for city in cities:
+            fig.plot(x=city_index.lons[city],
+                     y=city_index.lats[city],
+                     style=f'{symbol}{size}',
+                     fill=color,
+                     label=city_index.names[city])
+    else:
+        fig.plot(x=city_index.lons[cities],
+                 y=city_index.lats[cities],
                  style=f'{symbol}{size}',
-                 fill=color,
-                 label=city[2])
+                 fill=color)
 
-        # Fixes labels near the map edge from going off map
-
-        if max_lat - city[0] <= standard_offset_height:
-            label_y_val = city[0] - standard_offset_height
-        else:
-            label_y_val = city[0] + standard_offset_height
-
-        if abs(max_lon - city[1]) <= standard_offset_width:
-            label_x_val = city[1] - standard_offset_width
-            label_y_val = city[0]
-        elif abs(min_lon - city[1]) <= standard_offset_width:
-            label_x_val = city[1] + standard_offset_width
-            label_y_val = city[0]
-        else:
-            label_x_val = city[1]
-
-        fig.text(x=label_x_val,
-                 y=label_y_val,
-                 text=city[2],
-                 font=f'{fontsize}p,Helvetica-Bold,{label_color}',
-                 fill='white@15')
+    fig.text(x=label_lons,
+             y=label_lats,
+             text=city_index.names[cities].tolist(),
+             font=f'{fontsize}p,Helvetica-Bold,{label_color}',
+             fill='white@15')
 
     return fig
 
@@ -812,6 +1481,80 @@ def azimuthal_direction(lon1, lat1, lon2, lat2):
 
     return azimuth_deg
 
+def iter_pairwise_blocks(lons, lats, lons2=None, lats2=None,
+                         chunk_size: int=1024, azimuth: bool=False):
+    """
+    Computes the distance (and optionally azimuth) from every point in the
+    first set to every point in the second, chunk_size rows at a time, so only
+    one block of the matrix is ever in memory.
+
+    Parameters
+    ----------
+    lons, lats : numpy.ndarray
+        Coordinates of the first set of points (matrix rows).
+    lons2, lats2 : numpy.ndarray, optional
+        Coordinates of the second set (matrix columns). The default is the
+        first set.
+    chunk_size : int, optional
+        Number of rows per block. The default is 1024.
+    azimuth : bool, optional
+        If True, the azimuths are computed as well. The default is False.
+
+    Yields
+    ------
+    row_start : int
+        Index of the first row in the block.
+    distances : numpy.ndarray
+        (rows, len(lons2)) block of distances in km.
+    azimuths : numpy.ndarray or None
+        Matching block of azimuths in degrees, if azimuth is True.
+    """
+    lons = np.asarray(lons,dtype=np.float64)
+    lats = np.asarray(lats,dtype=np.float64)
+    if lons2 is None:
+        lons2, lats2 = lons, lats
+    lons2 = np.asarray(lons2,dtype=np.float64)
+    lats2 = np.asarray(lats2,dtype=np.float64)
+    if chunk_size < 1:
+        raise ValueError(f'chunk_size must be at least 1, got {chunk_size}')
+
+    for row_start in range(0, len(lons), chunk_size):
+        row_lons = lons[row_start:row_start + chunk_size, None]
+        row_lats = lats[row_start:row_start + chunk_size, None]
+        distances = haversine_distances(row_lons, row_lats, lons2, lats2)
+        azimuths = azimuthal_directions(row_lons, row_lats, lons2, lats2) if azimuth else None
+        yield row_start, distances, azimuths
+
+def pairwise_distances(lons, lats, lons2=None, lats2=None,
+                       chunk_size: int=1024, azimuth: bool=False):
+    """
+    Full distance (and optionally azimuth) matrix between two sets of points,
+    e.g. every pair of N stations. Built in row blocks, see
+    iter_pairwise_blocks, so the temporaries stay small even when the matrix
+    is large.
+
+    Returns
+    -------
+    distances : numpy.ndarray
+        (len(lons), len(lons2)) matrix of distances in km.
+    azimuths : numpy.ndarray
+        Matching matrix of azimuths in degrees, only returned if azimuth is True.
+    """
+    num_cols = len(lons) if lons2 is None else len(lons2)
+    distances = np.empty((len(lons), num_cols))
+    azimuths = np.empty((len(lons), num_cols)) if azimuth else None
+
+    for row_start, block, azimuth_block in iter_pairwise_blocks(lons, lats, lons2, lats2,
+                                                                chunk_size=chunk_size,
+                                                                azimuth=azimuth):
+        distances[row_start:row_start + len(block)] = block
+        if azimuth:
+            azimuths[row_start:row_start + len(block)] = azimuth_block
+
+    if azimuth:
+        return distances, azimuths
+    return distances
+
 def draw_rectangle(fig, minlon, maxlon, minlat, maxlat,
                    linewidth=1,linecolor='black', transparency=0):
 
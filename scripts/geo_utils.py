@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 21:24:50 2026
+
+@author: tlee
+
+
+Vectorized great circle distances and azimuths. Only needs NumPy, so station
+pair searches work without GMT. general_mapping re-exports both functions.
+"""
+
+import numpy as np
+
+def haversine_distances(lon1, lat1, lon2, lat2):
+    """
+    NumPy version of general_mapping.haversine_distance. Inputs broadcast
+    against each other, so one point against many, or matching arrays of start
+    and end points, both work.
+
+    Parameters
+    ----------
+    lon1, lat1 : float or numpy.ndarray
+        Longitude and latitude of the starting point(s) in degrees.
+    lon2, lat2 : float or numpy.ndarray
+        Longitude and latitude of the ending point(s) in degrees.
+
+    Returns
+    -------
+    distance : numpy.ndarray
+        Great circle distance in km.
+    """
+    R = 6371.0
+    lat1_rad = np.radians(lat1)
+    lat2_rad = np.radians(lat2)
+    dlat = lat2_rad - lat1_rad
+    dlon = np.radians(np.subtract(lon2,lon1))
+
+    a = np.sin(dlat/2)**2 + np.cos(lat1_rad) * np.cos(lat2_rad) * np.sin(dlon/2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(np.clip(1-a,0,None)))
+
+    return R * c
+
+def azimuthal_directions(lon1, lat1, lon2, lat2):
+    """
+    NumPy version of general_mapping.azimuthal_direction, broadcasting like haversine_distances.
+
+    Returns
+    -------
+    azimuth : numpy.ndarray
+        Azimuth from point 1 to point 2 in degrees, clockwise from north, in
+        the range [0, 360).
+    """
+    lat1_rad = np.radians(lat1)
+    lat2_rad = np.radians(lat2)
+    dlon_rad = np.radians(np.subtract(lon2,lon1))
+
+    y = np.sin(dlon_rad) * np.cos(lat2_rad)
+    x = (np.cos(lat1_rad) * np.sin(lat2_rad) -
+         np.sin(lat1_rad) * np.cos(lat2_rad) * np.cos(dlon_rad))
+
+    return (np.degrees(np.arctan2(y, x)) + 360) % 360
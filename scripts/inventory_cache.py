@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 15:02:31 2026
+
+@author: tlee
+
+
+Local StationXML cache for FDSN station queries. Queries are normalized
+(network/station/location/channel patterns, time window, bounds, level) and
+stored with the time they were fetched. A cached query can also answer any
+narrower query, e.g. a smaller box or shorter time window, by filtering the
+cached inventory locally.
+"""
+
+import os
+import json
+import time
+import hashlib
+from fnmatch import fnmatch
+from obspy import UTCDateTime, read_inventory, Inventory
+from obspy.clients.fdsn import Client
+
+import scripts.cache_utils as cu
+
+default_ttl = 7 * 86400
+
+levels = ['network','station','channel','response']
+
+def get_inventory_folder():
+    """Returns the folder the cached inventories are stored in, creating it if needed"""
+    return cu.get_cache_folder('inventory')
+
+def _client_id(client):
+    """Name used to tell cached queries to different data centers apart"""
+    if type(client) == str:
+        return client.upper()
+    return client.base_url
+
+def _normalize_codes(codes, key=None):
+    if codes is None:
+        return '*'
+    codes = [code.strip() for code in str(codes).split(',')]
+    if key == 'location':
+        # A blank location code ('' or '--') means no location, not any location
+        codes = ['--' if code in ('','--') else code for code in codes]
+    codes = [code for code in codes if code]
+    if not codes:
+        return '*'
+    return ','.join(sorted(set(codes)))
+
+def _normalize_time(time_value):
+    if time_value is None:
+        return None
+    return str(UTCDateTime(time_value))
+
+def normalize_query(query):
+    """
+    Parameters
+    ----------
+    query : dict
+        Keyword arguments that would be passed to Client.get_stations.
+
+    Returns
+    -------
+    normalized : dict
+        Query with codes sorted, times as ISO strings, bounds as floats and
+        everything else under 'extra', so equal queries compare equal.
+    """
+    query = dict(query)
+    normalized = {}
+    for key in ['network','station','location','channel']:
+        normalized[key] = _normalize_codes(query.pop(key,None),key)
+    normalized['starttime'] = _normalize_time(query.pop('starttime',None))
+    normalized['endtime'] = _normalize_time(query.pop('endtime',None))
+
+    defaults = {'minlatitude' : -90.0, 'maxlatitude' : 90.0,
+                'minlongitude' : -180.0, 'maxlongitude' : 180.0}
+    for key, default in defaults.items():
+        value = query.pop(key,None)
+        normalized[key] = default if value is None else round(float(value),6)
+
+    normalized['level'] = query.pop('level','station')
+    if normalized['level'] not in levels:
+        raise ValueError(f"Unknown level {normalized['level']}")
+
+    normalized['extra'] = {key : str(value) for key, value in sorted(query.items())}
+
+    return normalized
+
+def _query_key(client_id, normalized):
+    key_string = json.dumps([client_id, normalized], sort_keys=True)
+    return hashlib.sha1(key_string.encode('utf-8')).hexdigest()
+
+def _codes_cover(cached_codes, requested_codes):
+    if cached_codes == '*' or cached_codes == requested_codes:
+        return True
+    # Every requested code must be matched by one of the cached patterns, which
+    # only holds for plain requested codes
+    cached_patterns = cached_codes.split(',')
+    for code in requested_codes.split(','):
+        if any(char in code for char in '*?'):
+            return False
+        if not any(fnmatch(code,pattern) for pattern in cached_patterns):
+            return False
+    return True
+
+def _covers(meta, client_id, normalized):
+    """If the cached query in meta returns everything normalized would"""
+    cached = meta['query']
+    if meta['client'] != client_id or cached['extra'] != normalized['extra']:
+        return False
+    # Network level answers are only reused for the exact same query
+    if normalized['level'] == 'network':
+        return False
+    if levels.index(cached['level']) < levels.index(normalized['level']):
+        return False
+    # Location and channel codes can only be filtered on if the cached
+    # inventory has its channels
+    if normalized['location'] != '*' or normalized['channel'] != '*':
+        if levels.index(cached['level']) < levels.index('channel'):
+            return False
+    for key in ['network','station','location','channel']:
+        if not _codes_cover(cached[key],normalized[key]):
+            return False
+    if (cached['minlatitude'] > normalized['minlatitude'] or
+            cached['maxlatitude'] < normalized['maxlatitude'] or
+            cached['minlongitude'] > normalized['minlongitude'] or
+            cached['maxlongitude'] < normalized['maxlongitude']):
+        return False
+
+    if cached['starttime'] is not None:
+        if normalized['starttime'] is None:
+            return False
+        if UTCDateTime(cached['starttime']) > UTCDateTime(normalized['starttime']):
+            return False
+    # An open ended query only knows about what existed when it was fetched
+    cached_end = cached['endtime'] if cached['endtime'] is not None else meta['fetched_at']
+    requested_end = normalized['endtime'] if normalized['endtime'] is not None else str(UTCDateTime())
+    if UTCDateTime(cached_end) < UTCDateTime(requested_end):
+        return False
+
+    return True
+
+def _select_codes(inv, key, codes):
+    if codes == '*':
+        return inv
+    selected = Inventory(networks=[], source=inv.source)
+    for code in codes.split(','):
+        if key == 'location' and code == '--':
+            code = ''
+        selected += inv.select(**{key : code})
+    return selected
+
+def filter_inventory(inv, normalized):
+    """
+    Parameters
+    ----------
+    inv : obspy.core.inventory.Inventory
+        Inventory from a wider cached query.
+    normalized : dict
+        Normalized query, see normalize_query.
+
+    Returns
+    -------
+    inv : obspy.core.inventory.Inventory
+        Inventory with only what the narrower query would have returned.
+    """
+    for key in ['network','station','location','channel']:
+        inv = _select_codes(inv,key,normalized[key])
+
+    starttime = normalized['starttime']
+    endtime = normalized['endtime']
+    inv = inv.select(starttime=UTCDateTime(starttime) if starttime else None,
+                     endtime=UTCDateTime(endtime) if endtime else None,
+                     minlatitude=normalized['minlatitude'],
+                     maxlatitude=normalized['maxlatitude'],
+                     minlongitude=normalized['minlongitude'],
+                     maxlongitude=normalized['maxlongitude'])
+    return inv
+
+def find_cached_inventory(client, query, ttl: float=None, superset: bool=True):
+    """
+    Parameters
+    ----------
+    client : str or obspy.clients.fdsn.Client
+        Data host name or client the query is for.
+    query : dict
+        Keyword arguments that would be passed to Client.get_stations.
+    ttl : float, optional
+        Maximum age of a cached query in seconds. The default is one week.
+    superset : bool, optional
+        If True, wider cached queries are filtered down to answer this one.
+        The default is True.
+
+    Returns
+    -------
+    inv : obspy.core.inventory.Inventory or None
+        Cached inventory, or None if nothing cached can answer the query.
+    """
+    if ttl is None:
+        ttl = default_ttl
+    client_id = _client_id(client)
+    normalized = normalize_query(query)
+    inventory_folder = get_inventory_folder()
+    now = time.time()
+
+    candidates = []
+    key = _query_key(client_id,normalized)
+    exact_meta = os.path.join(inventory_folder,f'{key}.json')
+    if os.path.isfile(exact_meta):
+        candidates.append(exact_meta)
+    if superset:
+        candidates += [os.path.join(inventory_folder,fname) for fname in os.listdir(inventory_folder)
+                       if fname.endswith('.json') and fname != f'{key}.json']
+
+    for meta_path in candidates:
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if now - meta['fetched_at_unix'] > ttl:
+            continue
+        if meta_path != exact_meta and not _covers(meta,client_id,normalized):
+            continue
+        xml_path = meta_path[:-5] + '.xml'
+        if not os.path.isfile(xml_path):
+            continue
+
+        inv = read_inventory(xml_path,format='STATIONXML')
+        if meta_path != exact_meta:
+            inv = filter_inventory(inv,normalized)
+        return inv
+
+    return None
+
+def store_inventory(client, query, inv):
+    """
+    Parameters
+    ----------
+    client : str or obspy.clients.fdsn.Client
+        Data host name or client the query was sent to.
+    query : dict
+        Keyword arguments that were passed to Client.get_stations.
+    inv : obspy.core.inventory.Inventory
+        Inventory returned for the query.
+    """
+    client_id = _client_id(client)
+    normalized = normalize_query(query)
+    key = _query_key(client_id,normalized)
+    inventory_folder = get_inventory_folder()
+
+    xml_path = os.path.join(inventory_folder,f'{key}.xml')
+    cu.atomic_write(xml_path,lambda tmp_path: inv.write(tmp_path,format='STATIONXML'))
+
+    now = time.time()
+    meta = {'client' : client_id,
+            'query' : normalized,
+            'fetched_at' : str(UTCDateTime(now)),
+            'fetched_at_unix' : now}
+    cu.atomic_write_json(os.path.join(inventory_folder,f'{key}.json'),meta)
+
+def get_stations(client, ttl: float=None, superset: bool=True, **query):
+    """
+    Cached version of Client.get_stations.
+
+    Parameters
+    ----------
+    client : str or obspy.clients.fdsn.Client
+        Data host name (e.g. "IRIS") or client. Passing a name avoids
+        creating a client at all when the query can be answered from the cache.
+    ttl : float, optional
+        Maximum age of a cached query in seconds. The default is one week.
+    superset : bool, optional
+        If True, wider cached queries are filtered down to answer this one.
+        The default is True.
+    **query :
+        Arguments passed to Client.get_stations.
+
+    Returns
+    -------
+    inv : obspy.core.inventory.Inventory
+        Station inventory.
+    """
+    inv = find_cached_inventory(client,query,ttl=ttl,superset=superset)
+    if inv is not None:
+        return inv
+
+    working_client = Client(client) if type(client) == str else client
+    inv = working_client.get_stations(**query)
+    store_inventory(client,query,inv)
+
+    return inv
+
+def clear_cache():
+    """Removes every cached inventory"""
+    inventory_folder = get_inventory_folder()
+    for fname in os.listdir(inventory_folder):
+        os.remove(os.path.join(inventory_folder,fname))
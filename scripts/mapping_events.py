@@ -5,10 +5,282 @@ Created on Mon Nov 13 08:35:58 2023
 @author: tlee4
 """
 
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
 import pygmt
+import numpy as np
+import pandas as pd
 from obspy.clients.fdsn import Client
+from obspy.clients.fdsn.header import FDSNNoDataException, URL_MAPPINGS
 from obspy import UTCDateTime
 import scripts.general_mapping as gm
+import scripts.event_cache as ec
+
+def catalog_to_arrays(catalog):
+    """
+    Converts an ObsPy catalog to NumPy columns in a single pass, looking up
+    each event's preferred origin and magnitude only once. Events without a
+    preferred origin or magnitude fall back to their first one.
+
+    Parameters
+    ----------
+    catalog : obspy.core.event.Catalog
+        Catalog to convert.
+
+    Returns
+    -------
+    columns : dict of numpy.ndarray
+        Event columns 'event_id' (see event_cache.normalize_event_id), 'time'
+        (int64 ns since the epoch), 'longitude', 'latitude', 'depth' (m) and
+        'magnitude'.
+    """
+    n_events = len(catalog)
+    event_ids = np.empty(n_events,dtype=object)
+    times = np.empty(n_events,dtype=np.int64)
+    lons = np.empty(n_events,dtype=np.float64)
+    lats = np.empty(n_events,dtype=np.float64)
+    depths = np.empty(n_events,dtype=np.float64)
+    mags = np.empty(n_events,dtype=np.float64)
+
+    for i, event in enumerate(catalog):
+        origin = event.preferred_origin() or event.origins[0]
+        magnitude = event.preferred_magnitude() or event.magnitudes[0]
+        event_ids[i] = ec.normalize_event_id(event.resource_id)
+        times[i] = origin.time.ns
+        lons[i] = origin.longitude
+        lats[i] = origin.latitude
+        depths[i] = np.nan if origin.depth is None else origin.depth
+        mags[i] = magnitude.mag
+
+    columns = {'event_id' : event_ids,
+               'time' : times,
+               'longitude' : lons,
+               'latitude' : lats,
+               'depth' : depths,
+               'magnitude' : mags}
+    return columns
+
+def decimal_years(times):
+    """
+    Parameters
+    ----------
+    times : numpy.ndarray
+        Times as int64 ns since the epoch (or datetime64).
+
+    Returns
+    -------
+    years : numpy.ndarray
+        Times as decimal years, e.g. 2024.5 for July 1, 2024.
+    """
+    times = np.asarray(times).astype('datetime64[ns]')
+    year_start = times.astype('datetime64[Y]')
+    year_end = year_start + np.timedelta64(1,'Y')
+    year_start_ns = year_start.astype('datetime64[ns]')
+    year_length = (year_end.astype('datetime64[ns]') - year_start_ns).astype(np.float64)
+    fraction = (times - year_start_ns).astype(np.float64) / year_length
+    return year_start.astype(np.int64) + 1970 + fraction
+
+def event_sizes(magnitudes, lin_scale: float=0.055, exp_scale: float=1.45):
+    """Symbol sizes for plot_events, lin_scale * (magnitude ^ exp_scale)"""
+    return lin_scale * (np.asarray(magnitudes,dtype=np.float64) ** exp_scale)
+
+def _parse_event_text(stream):
+    """
+    Parses an FDSN event service text response into event columns, reading
+    only the fields the maps use.
+    """
+    header = stream.readline().decode('utf-8').lstrip('#').strip().split('|')
+    if len(header) < 2:
+        return _empty_columns()
+    fields = {'EventID' : 'event_id', 'Time' : 'time', 'Latitude' : 'latitude',
+              'Longitude' : 'longitude', 'Depth/km' : 'depth', 'Magnitude' : 'magnitude'}
+    missing = [field for field in fields if field not in header]
+    if missing:
+        raise ValueError(f'Event service response is missing {missing}')
+
+    df = pd.read_csv(stream, sep='|', header=None, names=header,
+                     usecols=list(fields), comment='#',
+                     dtype={'EventID' : str, 'Time' : str, 'Latitude' : np.float64,
+                            'Longitude' : np.float64, 'Depth/km' : np.float64,
+                            'Magnitude' : np.float64})
+    df = df.dropna(subset=['Latitude','Longitude','Magnitude'])
+
+    times = pd.to_datetime(df['Time'], utc=True).dt.tz_convert(None)
+    columns = {'event_id' : np.array([ec.normalize_event_id(event_id) for event_id in df['EventID']],
+                                     dtype=object),
+               'time' : times.to_numpy().astype('datetime64[ns]').astype(np.int64),
+               'longitude' : df['Longitude'].to_numpy(),
+               'latitude' : df['Latitude'].to_numpy(),
+               'depth' : df['Depth/km'].to_numpy() * 1000,
+               'magnitude' : df['Magnitude'].to_numpy()}
+    return columns
+
+def _empty_columns():
+    return {'event_id' : np.empty(0,dtype=object),
+            'time' : np.empty(0,dtype=np.int64),
+            'longitude' : np.empty(0,dtype=np.float64),
+            'latitude' : np.empty(0,dtype=np.float64),
+            'depth' : np.empty(0,dtype=np.float64),
+            'magnitude' : np.empty(0,dtype=np.float64)}
+
+def fetch_events_text(starttime, endtime, minlon: float, maxlon: float,
+                      minlat: float, maxlat: float, minmag: float,
+                      client: str='USGS', timeout: float=300):
+    """
+    Requests earthquakes from an FDSN event service in its plain text format
+    and parses them straight into NumPy columns, without building ObsPy Event
+    objects. Uses far less memory than QuakeML for long regional catalogs.
+    Windows with more events than the service will return in one request are
+    split in half until each part fits.
+
+    Parameters
+    ----------
+    starttime : str or obspy.UTCDateTime
+        Start time for earthquake query.
+    endtime : str or obspy.UTCDateTime
+        End time for earthquake query.
+    minlon : float
+        Minimum longitude.
+    maxlon : float
+        Maximum longitude.
+    minlat : float
+        Minimum latitude.
+    maxlat : float
+        Maximum latitude.
+    minmag : float
+        Minimum magnitude.
+    client : str, optional
+        Event service name, see obspy.clients.fdsn.header.URL_MAPPINGS, or a
+        base URL. The default is 'USGS'.
+    timeout : float, optional
+        Request timeout in seconds. The default is 300.
+
+    Returns
+    -------
+    columns : dict of numpy.ndarray
+        Same columns as catalog_to_arrays, sorted by time.
+    """
+    base_url = URL_MAPPINGS.get(client.upper(),client)
+    starttime = UTCDateTime(starttime)
+    endtime = UTCDateTime(endtime)
+
+    params = {'format' : 'text',
+              'starttime' : starttime.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+              'endtime' : endtime.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+              'minlongitude' : minlon,
+              'maxlongitude' : maxlon,
+              'minlatitude' : minlat,
+              'maxlatitude' : maxlat,
+              'minmagnitude' : minmag,
+              'orderby' : 'time-asc'}
+    url = f'{base_url}/fdsnws/event/1/query?{urllib.parse.urlencode(params)}'
+
+    try:
+        with urllib.request.urlopen(url,timeout=timeout) as response:
+            if response.status == 204:
+                return _empty_columns()
+            columns = _parse_event_text(response)
+    except urllib.error.HTTPError as e:
+        if e.code == 204:
+            return _empty_columns()
+        message = e.read().decode('utf-8',errors='replace')
+        if e.code in (400, 413) and 'limit' in message.lower() and endtime - starttime > 1:
+            midtime = starttime + (endtime - starttime) / 2
+            print(f'Too many events between {starttime} and {endtime}, splitting the request')
+            first = fetch_events_text(starttime,midtime,minlon,maxlon,minlat,maxlat,
+                                      minmag,client=client,timeout=timeout)
+            second = fetch_events_text(midtime,endtime,minlon,maxlon,minlat,maxlat,
+                                       minmag,client=client,timeout=timeout)
+            # An event exactly on the split time is returned by both halves
+            keep = ~np.isin(second['event_id'],first['event_id'])
+            return {key : np.concatenate([first[key],second[key][keep]]) for key in first}
+        raise ValueError(f'Event request failed with HTTP {e.code}: {message.strip()}')
+
+    order = np.argsort(columns['time'],kind='stable')
+    return {key : values[order] for key, values in columns.items()}
+
+def get_events_cached(starttime, endtime, minlon: float, maxlon: float,
+                      minlat: float, maxlat: float, minmag: float,
+                      client: str='USGS', recent_lag: float=3600,
+                      fetch_format: str='quakeml'):
+    """
+    Gets earthquakes through the local event store, only requesting the time
+    slices that haven't been fetched for this box and magnitude before.
+
+    Parameters
+    ----------
+    starttime : str or obspy.UTCDateTime
+        Start time for earthquake query.
+    endtime : str or obspy.UTCDateTime
+        End time for earthquake query.
+    minlon : float
+        Minimum longitude.
+    maxlon : float
+        Maximum longitude.
+    minlat : float
+        Minimum latitude.
+    maxlat : float
+        Maximum latitude.
+    minmag : float
+        Minimum magnitude.
+    client : str, optional
+        Event service to query. The default is 'USGS'.
+    recent_lag : float, optional
+        Events in the last recent_lag seconds are still being added and revised,
+        so that part of a window is never marked as fetched and is requested
+        again next time. The default is 3600.
+    fetch_format : str, optional
+        'quakeml' to fetch through ObsPy, or 'text' to use fetch_events_text.
+        The default is 'quakeml'.
+
+    Returns
+    -------
+    columns : dict of numpy.ndarray
+        Event columns 'event_id', 'time' (ns since the epoch), 'longitude',
+        'latitude', 'depth' and 'magnitude', sorted by time.
+    """
+    if fetch_format not in ['quakeml','text']:
+        raise ValueError(f'Unknown fetch_format {fetch_format}')
+    bounds = [minlon, maxlon, minlat, maxlat]
+    start_ns = UTCDateTime(starttime).ns
+    end_ns = UTCDateTime(endtime).ns
+    settled_ns = UTCDateTime(time.time() - recent_lag).ns
+
+    conn = ec.connect()
+    try:
+        windows = ec.missing_windows(conn,client,bounds,minmag,start_ns,end_ns)
+        if windows and fetch_format == 'quakeml':
+            cl = Client(client)
+        for window_start, window_end in windows:
+            print(f'Requesting events from {UTCDateTime(ns=window_start)} to {UTCDateTime(ns=window_end)}')
+            if fetch_format == 'text':
+                columns = fetch_events_text(UTCDateTime(ns=window_start),
+                                            UTCDateTime(ns=window_end),
+                                            minlon,maxlon,minlat,maxlat,minmag,
+                                            client=client)
+            else:
+                try:
+                    catalog = cl.get_events(starttime=UTCDateTime(ns=window_start),
+                                            endtime=UTCDateTime(ns=window_end),
+                                            minlongitude=minlon,
+                                            maxlongitude=maxlon,
+                                            minlatitude=minlat,
+                                            maxlatitude=maxlat,
+                                            minmagnitude=minmag)
+                except FDSNNoDataException:
+                    catalog = []
+                columns = catalog_to_arrays(catalog)
+            # Only mark as fetched up to where the catalog has settled
+            ec.store_events(conn,client,columns,bounds,minmag,window_start,
+                            min(window_end,max(window_start,settled_ns)))
+
+        columns = ec.query_events(conn,client,bounds,minmag,start_ns,end_ns)
+    finally:
+        conn.close()
+
+    return columns
 
 def plot_events(starttime: str,
                 endtime: str,
@@ -23,6 +295,8 @@ def plot_events(starttime: str,
                 color_by_date: bool=False,
                 debug: bool=False,
                 fig=None,
+                use_cache: bool=False,
+                fetch_format: str='quakeml',
                 **kwargs):
     """
     Plots earthquakes on a PyGMT figure. The formula for the scaling of the
@@ -58,6 +332,15 @@ def plot_events(starttime: str,
         Print detailed catalog information. The default is False.
     fig : pygmt.Figure, optional
         Existing figure to plot on. The default is None.
+    use_cache : bool, optional
+        If True, events come from the local event store and only the time
+        slices not fetched before are requested, see get_events_cached.
+        The default is False.
+    fetch_format : str, optional
+        'quakeml' to request the catalog through ObsPy, or 'text' to request
+        the service's text format and parse it straight into arrays (see
+        fetch_events_text), which is much lighter for large catalogs.
+        The default is 'quakeml'.
     **kwargs :
         Arguments to be passed to the base map (see general_mapping.plot_base_map).
 
@@ -66,62 +349,42 @@ def plot_events(starttime: str,
     fig : pygmt.Figure
         The figure with plotted earthquakes.
     """
-    import pygmt
-    import numpy as np
-    from datetime import datetime
-
     if fig is None:
         fig = gm.plot_base_map(**kwargs)
 
-    cl = Client('USGS')
-    catalog = cl.get_events(starttime=UTCDateTime(starttime),
-                  endtime=UTCDateTime(endtime),
-                  minlongitude=minlon,
-                  maxlongitude=maxlon,
-                  minlatitude=minlat,
-                  maxlatitude=maxlat,
-                  minmagnitude=minmag)
+    if use_cache:
+        columns = get_events_cached(starttime,endtime,minlon,maxlon,
+                                    minlat,maxlat,minmag,
+                                    fetch_format=fetch_format)
+    elif fetch_format == 'text':
+        columns = fetch_events_text(starttime,endtime,minlon,maxlon,
+                                    minlat,maxlat,minmag)
+    else:
+        cl = Client('USGS')
+        catalog = cl.get_events(starttime=UTCDateTime(starttime),
+                      endtime=UTCDateTime(endtime),
+                      minlongitude=minlon,
+                      maxlongitude=maxlon,
+                      minlatitude=minlat,
+                      maxlatitude=maxlat,
+                      minmagnitude=minmag)
 
-    if debug:
-        print(catalog.__str__(print_all=True))
-    print(f'{len(catalog)} events found')
+        if debug:
+            print(catalog.__str__(print_all=True))
+        columns = catalog_to_arrays(catalog)
+    print(f'{len(columns["time"])} events found')
 
-    x = []
-    y = []
-    sizes = []
-    dates = []
+    x = columns['longitude']
+    y = columns['latitude']
+    sizes = event_sizes(columns['magnitude'],lin_scale=lin_scale,exp_scale=exp_scale)
 
-    for i, event in enumerate(catalog):
-        x.append(event.preferred_origin().longitude)
-        y.append(event.preferred_origin().latitude)
-        sizes.append(lin_scale * (event.preferred_magnitude().mag ** exp_scale))
-
-        if color_by_date:
-            # Get datetime object and convert to timestamp (days since epoch)
-            dt = event.preferred_origin().time.datetime
-            # Convert to days since Unix epoch for PyGMT
-            timestamp = dt.timestamp() / 86400  # seconds to days
-            dates.append(timestamp)
-
-    if color_by_date and len(dates) > 0:
-        # Convert dates to decimal years for cleaner colorbar labels
-        dates_years = []
-        for i, event in enumerate(catalog):
-            dt = event.preferred_origin().time.datetime
-            # Convert to decimal year (e.g., 2024.5 for July 1, 2024)
-            year = dt.year
-            start_of_year = datetime(year, 1, 1)
-            days_in_year = 366 if year % 4 == 0 and (year % 100 != 0 or year % 400 == 0) else 365
-            day_of_year = (dt - start_of_year).days + (dt - start_of_year).seconds / 86400
-            decimal_year = year + day_of_year / days_in_year
-            dates_years.append(decimal_year)
-
-        # Convert to numpy array for colormap
-        dates_array = np.array(dates_years)
+    if color_by_date and len(x) > 0:
+        # Decimal years give cleaner colorbar labels
+        dates_years = decimal_years(columns['time'])
 
         # Create colormap range
-        min_year = dates_array.min()
-        max_year = dates_array.max()
+        min_year = dates_years.min()
+        max_year = dates_years.max()
 
         # Create a NEW CPT specifically for the earthquake dates
         # This prevents conflicts with the topography CPT
@@ -6,20 +6,238 @@ Created on Thu Feb 22 14:09:01 2024
 """
 
 import os
+import json
+import sqlite3
 import pandas as pd
 from glob import glob
 import numpy as np
 import shutil
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 from geopy import distance
 
+import scripts.cache_utils as cu
 
-def find_files_in_bounds(directory,bounds,filetype=None):
+
+pfiles_columns = ['Time','Station_Name','Period?','Longitude','Latitude','Height','E_Uncer','N_Uncer','H_Uncer',
+                  'E-N_Corr,','E-H_Corr','N-H_Corr']
+
+def _read_gps_file(file, cols=None, **kwargs):
+    """Parses a whitespace separated GPS file. Every text read in this module goes through here."""
+    if cols is None:
+        cols = pfiles_columns
+    return pd.read_csv(file,sep=r'\s+',names=cols,**kwargs)
+
+def _file_in_bounds(file, bounds, cols=None, chunksize=5000):
+    """
+    Reads a GPS file a chunk of rows at a time, only parsing the coordinate
+    columns, and stops at the first chunk with an epoch inside bounds.
+    """
+    if cols is None:
+        cols = pfiles_columns
+    min_lon, max_lon, min_lat, max_lat = bounds
+
+    reader = _read_gps_file(file,cols,usecols=['Longitude','Latitude'],chunksize=chunksize)
+    with reader:
+        for chunk in reader:
+            lons = (chunk['Longitude'].to_numpy() + 180) % 360 - 180
+            lats = chunk['Latitude'].to_numpy()
+            in_bounds = ((lons >= min_lon) & (lons <= max_lon) &
+                         (lats >= min_lat) & (lats <= max_lat))
+            if in_bounds.any():
+                return True
+    return False
+
+def _parse_gps_record(line, cols):
+    """Splits one whitespace separated record, or returns None if it doesn't look like one"""
+    fields = line.split()
+    if len(fields) != len(cols):
+        return None
+    record = {}
+    try:
+        for column, field in zip(cols, fields):
+            record[column] = field if column == 'Station_Name' else float(field)
+    except ValueError:
+        return None
+    return record
+
+def read_first_last_records(file, cols=None, block_size: int=4096):
+    """
+    Reads only the first and last records of a GPS file: the first line from
+    the start, and the last line by seeking back from the end of the file a
+    block at a time. The cost doesn't depend on the length of the file. If
+    either line doesn't parse as a record, the whole file is read instead.
+
+    Parameters
+    ----------
+    file : str
+        Path to the GPS file. Currently can only read .pfiles.
+    cols : list of str, optional
+        Column names. The default is pfiles_columns.
+    block_size : int, optional
+        Bytes read at a time from the end. The default is 4096.
+
+    Returns
+    -------
+    first : dict
+        First record, keyed by column. Station_Name is a string and every
+        other column a float.
+    last : dict
+        Last record, in the same form.
+    """
+    if cols is None:
+        cols = pfiles_columns
+
+    with open(file,'rb') as f:
+        first_line = b''
+        for line in f:
+            if line.strip():
+                first_line = line
+                break
+
+        f.seek(0,os.SEEK_END)
+        position = f.tell()
+        tail = b''
+        # Read backwards until the tail holds a full line after the last newline
+        while position > 0:
+            step = min(block_size,position)
+            position -= step
+            f.seek(position)
+            tail = f.read(step) + tail
+            if tail.rstrip().count(b'\n') >= 1:
+                break
+        lines = tail.rstrip().split(b'\n')
+        last_line = lines[-1] if lines else b''
+
+    first = _parse_gps_record(first_line.decode('utf-8',errors='replace'),cols)
+    last = _parse_gps_record(last_line.decode('utf-8',errors='replace'),cols)
+    if first is not None and last is not None:
+        return first, last
+
+    print(f'Irregular format in {os.path.basename(file)}, reading the whole file')
+    stat_df = _read_gps_file(file,cols)
+    first = stat_df.iloc[0].to_dict()
+    last = stat_df.iloc[-1].to_dict()
+    return first, last
+
+gps_index_name = '.gps_index.sqlite'
+
+gps_index_columns = ['path','mtime_ns','size','station','num_epochs',
+                     'first_time','last_time','first_lon','first_lat','first_height',
+                     'last_lon','last_lat','last_height',
+                     'min_lon','max_lon','min_lat','max_lat']
+
+def _summarize_gps_file(file):
+    """First and last epoch, positions and bounding box of one GPS file"""
+    stat = os.stat(file)
+    stat_df = _read_gps_file(file,usecols=['Time','Station_Name','Longitude','Latitude','Height'])
+    lons = stat_df['Longitude'].to_numpy()
+    wrapped_lons = (lons + 180) % 360 - 180
+    lats = stat_df['Latitude'].to_numpy()
+    heights = stat_df['Height'].to_numpy()
+    times = stat_df['Time'].to_numpy()
+    return (os.path.abspath(file), stat.st_mtime_ns, stat.st_size,
+            str(stat_df['Station_Name'].iloc[0]), len(stat_df),
+            float(times[0]), float(times[-1]),
+            float(lons[0]), float(lats[0]), float(heights[0]),
+            float(lons[-1]), float(lats[-1]), float(heights[-1]),
+            float(wrapped_lons.min()), float(wrapped_lons.max()),
+            float(lats.min()), float(lats.max()))
+
+def _connect_gps_index(index_path):
+    conn = sqlite3.connect(index_path,timeout=60)
+    conn.execute("""CREATE TABLE IF NOT EXISTS stations (
+                        path TEXT PRIMARY KEY,
+                        mtime_ns INTEGER NOT NULL,
+                        size INTEGER NOT NULL,
+                        station TEXT,
+                        num_epochs INTEGER,
+                        first_time REAL, last_time REAL,
+                        first_lon REAL, first_lat REAL, first_height REAL,
+                        last_lon REAL, last_lat REAL, last_height REAL,
+                        min_lon REAL, max_lon REAL, min_lat REAL, max_lat REAL)""")
+    return conn
+
+def get_gps_index(filelist, index_path: str=None, n_workers: int=1):
+    """
+    Returns the header summary of every file in filelist from a sidecar SQLite
+    index, reading only files that are new or have changed (by mtime and size)
+    since they were last indexed. Entries for files that no longer exist are
+    removed.
+
+    Parameters
+    ----------
+    filelist : list of str
+        GPS files to summarize. Currently can only read .pfiles.
+    index_path : str, optional
+        Index database. The default is .gps_index.sqlite next to the first file.
+    n_workers : int, optional
+        Number of processes to read changed files with. None uses the number
+        of CPUs, in which case the calling script needs the usual
+        if __name__ == '__main__': guard. The default is 1.
+
+    Returns
+    -------
+    index_df : pandas.DataFrame
+        One row per file, in the order of filelist, with the columns in
+        gps_index_columns. First and last positions are as written in the
+        file, while the bounding box longitudes are in [-180, 180).
+    """
+    if len(filelist) == 0:
+        return pd.DataFrame(columns=gps_index_columns)
+    if index_path is None:
+        index_path = os.path.join(os.path.dirname(os.path.abspath(filelist[0])),gps_index_name)
+
+    paths = [os.path.abspath(file) for file in filelist]
+    conn = _connect_gps_index(index_path)
+    try:
+        indexed = {path : (mtime_ns, size) for path, mtime_ns, size in
+                   conn.execute('SELECT path, mtime_ns, size FROM stations')}
+
+        stale = []
+        for path in paths:
+            stat = os.stat(path)
+            if indexed.get(path) != (stat.st_mtime_ns, stat.st_size):
+                stale.append(path)
+        missing = [path for path in indexed if not os.path.isfile(path)]
+
+        if stale:
+            print(f'Indexing {len(stale)} GPS files...')
+            if n_workers is None:
+                n_workers = os.cpu_count() or 1
+            n_workers = max(1,min(n_workers,len(stale)))
+            if n_workers == 1:
+                rows = [_summarize_gps_file(path) for path in stale]
+            else:
+                with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                    rows = list(executor.map(_summarize_gps_file,stale))
+        else:
+            rows = []
+
+        with conn:
+            conn.executemany('DELETE FROM stations WHERE path = ?',[(path,) for path in missing])
+            conn.executemany(f"INSERT OR REPLACE INTO stations ({', '.join(gps_index_columns)}) "
+                             f"VALUES ({', '.join('?' * len(gps_index_columns))})",rows)
+
+        index_df = pd.read_sql_query(f"SELECT {', '.join(gps_index_columns)} FROM stations",conn)
+    finally:
+        conn.close()
+
+    index_df = index_df.set_index('path').loc[paths].reset_index()
+    return index_df
+
+def find_files_in_bounds(directory,bounds,filetype=None,n_workers: int=1,
+                         chunksize: int=5000,use_index: bool=False,
+                         index_path: str=None):
     """
     If given a file directory containing GPS files and lat/lon boundaries in the
     form [min_lon,max_lon,min_lat,max_lat], will read in the GPS files and figure
     out which ones are in the boundaries.
     
+    Each file is only read until its first epoch inside the bounds. Files can
+    be checked in parallel across a pool of processes with n_workers, in which
+    case the calling script needs the usual if __name__ == '__main__': guard.
     
     Parameters
     ----------
@@ -29,6 +247,19 @@ def find_files_in_bounds(directory,bounds,filetype=None):
         Boundaries to search for stations, in the form [min_lon,max_lon,min_lat,max_lat].
     filetype : str, optional
         File extension of the GPS files. The default is None.
+    n_workers : int, optional
+        Number of processes to read files with. None uses the number of CPUs.
+        The default is 1, which reads the files one after another in this
+        process.
+    chunksize : int, optional
+        Number of rows read at a time from each file. The default is 5000.
+    use_index : bool, optional
+        If True, stations are checked against their bounding boxes in the GPS
+        index (see get_gps_index), and only files whose box straddles the
+        bounds are read. The default is False.
+    index_path : str, optional
+        Index database to use with use_index. The default is
+        .gps_index.sqlite in directory.
 
     Returns
     -------
@@ -36,11 +267,8 @@ def find_files_in_bounds(directory,bounds,filetype=None):
         List of filepaths to files that are inside the desired bounds.
 
     """
-    min_lon = bounds[0]
-    max_lon = bounds[1]
-    min_lat = bounds[2]
-    max_lat = bounds[3]
-
+    if len(bounds) != 4:
+        raise ValueError(f'Expected 4 items in bounds, got {len(bounds)}')
     
     dir_path = os.path.expanduser(directory)
     if not os.path.isdir(dir_path):
@@ -52,30 +280,215 @@ def find_files_in_bounds(directory,bounds,filetype=None):
     else:
         print('Make sure your file type includes the . in the extension name')
         filelist = glob(dir_path + f'/*{filetype}')
+    filelist = [file for file in filelist if os.path.isfile(file)]
         
-    if filetype == '.pfiles':
-        cols = ['Time','Station_Name','Period?','Longitude','Latitude','Height','E_Uncer','N_Uncer','H_Uncer',
-                'E-N_Corr,','E-H_Corr','N-H_Corr']
-        
-    outside_stat_list = []
-    inside_stat_list = []
-    
-    for i,file in enumerate(filelist):
-        stat_df = pd.read_csv(file,delim_whitespace=True,names=cols)
-        stat_df['Longitude'] = (stat_df['Longitude'] + 180) % 360 - 180
-        
-        stat_df.drop(stat_df[stat_df.Longitude > max_lon].index, inplace=True)
-        stat_df.drop(stat_df[stat_df.Longitude < min_lon].index, inplace=True)
-        stat_df.drop(stat_df[stat_df.Latitude < min_lat].index, inplace=True)
-        stat_df.drop(stat_df[stat_df.Latitude > max_lat].index, inplace=True)
-        
-        if stat_df.empty:
-            outside_stat_list.append(file)
-        else:
-            inside_stat_list.append(file)
+    cols = pfiles_columns
+    min_lon, max_lon, min_lat, max_lat = bounds
+
+    in_bounds = [None] * len(filelist)
+    if use_index:
+        if index_path is None:
+            index_path = os.path.join(dir_path,gps_index_name)
+        index_df = get_gps_index(filelist,index_path=index_path,n_workers=n_workers)
+        box_inside = ((index_df['min_lon'] >= min_lon) & (index_df['max_lon'] <= max_lon) &
+                      (index_df['min_lat'] >= min_lat) & (index_df['max_lat'] <= max_lat)).to_numpy()
+        box_outside = ((index_df['max_lon'] < min_lon) | (index_df['min_lon'] > max_lon) |
+                       (index_df['max_lat'] < min_lat) | (index_df['min_lat'] > max_lat)).to_numpy()
+        for i in range(len(filelist)):
+            if box_inside[i]:
+                in_bounds[i] = True
+            elif box_outside[i]:
+                in_bounds[i] = False
+
+    # Only files the index couldn't decide are read
+    to_read = [i for i, inside in enumerate(in_bounds) if inside is None]
+    files_to_read = [filelist[i] for i in to_read]
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = max(1,min(n_workers,len(files_to_read)))
+
+    if n_workers == 1:
+        results = [_file_in_bounds(file,bounds,cols,chunksize) for file in files_to_read]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_file_in_bounds,files_to_read,
+                                        repeat(bounds),repeat(cols),repeat(chunksize),
+                                        chunksize=max(1,len(files_to_read) // (n_workers * 4))))
+    for i, inside in zip(to_read,results):
+        in_bounds[i] = inside
+
+    inside_stat_list = [file for file, inside in zip(filelist,in_bounds) if inside]
             
     return inside_stat_list
 
+gps_store_name = '.gps_store'
+
+class GPSStore:
+    """
+    Columnar store of a set of GPS time series, made by build_gps_store. Every
+    numeric column of every station is concatenated into one memory mapped
+    .npy file, and a station offset table gives each station's rows, so
+    reading a station is a slice with no text parsing.
+    """
+    def __init__(self, store_path):
+        self.store_path = store_path
+        with open(os.path.join(store_path,'meta.json')) as f:
+            self.meta = json.load(f)
+        self.stations = self.meta['stations']
+        self.sources = [source[0] for source in self.meta['sources']]
+        self.offsets = np.load(os.path.join(store_path,'offsets.npy'))
+        self.columns = {column : np.load(os.path.join(store_path,fname),mmap_mode='r')
+                        for column, fname in self.meta['columns'].items()}
+        self._rows = {station : i for i, station in enumerate(self.stations)}
+        self._files = {source : i for i, source in enumerate(self.sources)}
+
+    def __len__(self):
+        return len(self.stations)
+
+    def is_current(self, filelist=None):
+        """If the source files (or filelist) are exactly those the store was built from, unchanged"""
+        sources = [[os.path.abspath(file)] for file in filelist] if filelist is not None else self.meta['sources']
+        if len(sources) != len(self.meta['sources']):
+            return False
+        for source, built in zip(sources,self.meta['sources']):
+            if not os.path.isfile(source[0]):
+                return False
+            stat = os.stat(source[0])
+            if [source[0], stat.st_mtime_ns, stat.st_size] != built:
+                return False
+        return True
+
+    def resolve(self, station_or_file):
+        """Returns the row of a station, given its name or its source file"""
+        if station_or_file in self._rows:
+            return self._rows[station_or_file]
+        path = os.path.abspath(station_or_file)
+        if path in self._files:
+            return self._files[path]
+        raise ValueError(f'{station_or_file} is not in the GPS store')
+
+    def station_arrays(self, station_or_file):
+        """
+        Returns
+        -------
+        arrays : dict of numpy.ndarray
+            Read only views of every numeric column for the station.
+        """
+        return self._station_slice(self.resolve(station_or_file))
+
+    def _station_slice(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return {column : values[start:end] for column, values in self.columns.items()}
+
+    def station_df(self, station_or_file, cols=None):
+        """
+        Returns the station's time series as a DataFrame laid out like the
+        source file, with the column names in cols (default pfiles_columns).
+        """
+        if cols is None:
+            cols = pfiles_columns
+        i = self.resolve(station_or_file)
+        arrays = self._station_slice(i)
+        data = {}
+        for column, name in zip(pfiles_columns,cols):
+            if column == 'Station_Name':
+                data[name] = [self.stations[i]] * (self.offsets[i + 1] - self.offsets[i])
+            else:
+                data[name] = np.array(arrays[column])
+        return pd.DataFrame(data)
+
+def build_gps_store(filelist, store_path: str=None, rebuild: bool=False):
+    """
+    Converts GPS text files into a GPSStore, parsing each file once. If a
+    store built from exactly these files, unchanged, already exists, it is
+    reused.
+
+    Parameters
+    ----------
+    filelist : list of str
+        GPS files to include. Currently can only read .pfiles.
+    store_path : str, optional
+        Folder to write the store to. The default is .gps_store next to the
+        first file.
+    rebuild : bool, optional
+        If True, the store is rebuilt even if it is current. The default is False.
+
+    Returns
+    -------
+    store : GPSStore
+        The store.
+    """
+    if len(filelist) == 0:
+        raise ValueError('No GPS files given')
+    paths = [os.path.abspath(file) for file in filelist]
+    if store_path is None:
+        store_path = os.path.join(os.path.dirname(paths[0]),gps_store_name)
+
+    if not rebuild and os.path.isfile(os.path.join(store_path,'meta.json')):
+        store = load_gps_store(store_path)
+        if store.is_current(paths):
+            return store
+
+    print(f'Building GPS store from {len(paths)} files...')
+    numeric_columns = [column for column in pfiles_columns if column != 'Station_Name']
+    parts = {column : [] for column in numeric_columns}
+    stations = []
+    sources = []
+    offsets = [0]
+    for path in paths:
+        stat = os.stat(path)
+        stat_df = _read_gps_file(path)
+        stations.append(str(stat_df['Station_Name'].iloc[0]))
+        sources.append([path, stat.st_mtime_ns, stat.st_size])
+        offsets.append(offsets[-1] + len(stat_df))
+        for column in numeric_columns:
+            parts[column].append(stat_df[column].to_numpy(dtype=np.float64))
+
+    os.makedirs(store_path,exist_ok=True)
+    def save(fname, array):
+        cu.atomic_write(os.path.join(store_path,fname),lambda f: np.save(f,array),mode='wb')
+
+    column_files = {}
+    for i, column in enumerate(numeric_columns):
+        column_files[column] = f'column_{i}.npy'
+        save(column_files[column],np.concatenate(parts[column]))
+    save('offsets.npy',np.array(offsets,dtype=np.int64))
+
+    meta = {'stations' : stations,
+            'sources' : sources,
+            'columns' : column_files}
+    cu.atomic_write_json(os.path.join(store_path,'meta.json'),meta)
+
+    return load_gps_store(store_path)
+
+# Opened stores, keyed by path and the mtime of their metadata
+_gps_stores = {}
+
+def load_gps_store(store_path):
+    """
+    Parameters
+    ----------
+    store_path : str
+        Folder of a store made by build_gps_store.
+
+    Returns
+    -------
+    store : GPSStore
+        The store, opened once per process and again only if it is rebuilt.
+    """
+    store_path = os.path.abspath(store_path)
+    key = (store_path, os.stat(os.path.join(store_path,'meta.json')).st_mtime_ns)
+    if key not in _gps_stores:
+        _gps_stores[key] = GPSStore(store_path)
+    return _gps_stores[key]
+
+def _station_data(file, store=None, cols=None):
+    """A station's time series, from the store if one is given, otherwise by parsing its file"""
+    if store is not None:
+        return store.station_df(file,cols)
+    return _read_gps_file(file,cols)
+
 def set_aside_inside_stat_list(inside_stat_file_list,folder_name=None):
     """
     Parameters
@@ -96,7 +509,8 @@ def set_aside_inside_stat_list(inside_stat_file_list,folder_name=None):
     for file in inside_stat_file_list:
         shutil.copy(file,set_aside_directory)
         
-def make_gps_station_df(filelist):
+def make_gps_station_df(filelist,use_index: bool=False,index_path: str=None,
+                        store=None,n_workers: int=1):
     """
     Makes a DataFrame containing the initial positions of the GPS stations,
     primarily for plotting purposes.
@@ -105,6 +519,18 @@ def make_gps_station_df(filelist):
     ----------
     filelist : list
         List of filepaths to GPS files.
+    use_index : bool, optional
+        If True, positions come from the GPS index (see get_gps_index) instead
+        of reading every file. The default is False.
+    index_path : str, optional
+        Index database to use with use_index.
+    store : GPSStore, optional
+        Store to take the time series from instead of parsing the files, see
+        build_gps_store. filelist can then also give station names, or be
+        None for every station in the store. The default is None.
+    n_workers : int, optional
+        Number of processes get_gps_index reads changed files with when
+        use_index is True. The default is 1.
 
     Returns
     -------
@@ -112,6 +538,23 @@ def make_gps_station_df(filelist):
         DataFrame containing GPS station info.
 
     """
+    if store is not None:
+        if filelist is None:
+            filelist = store.sources
+        rows = [store.resolve(file) for file in filelist]
+        first = store.offsets[rows]
+        return pd.DataFrame({'Station' : [store.stations[i] for i in rows],
+                             'Longitude' : store.columns['Longitude'][first],
+                             'Latitude' : store.columns['Latitude'][first],
+                             'Height' : store.columns['Height'][first]})
+
+    if use_index:
+        index_df = get_gps_index(filelist,index_path=index_path,n_workers=n_workers)
+        return pd.DataFrame({'Station' : index_df['station'],
+                             'Longitude' : index_df['first_lon'],
+                             'Latitude' : index_df['first_lat'],
+                             'Height' : index_df['first_height']})
+
     file_name = os.path.split(filelist[0])[1]
     
     lon_list = []
@@ -124,11 +567,11 @@ def make_gps_station_df(filelist):
                 'E-N_Corr,','E-H_Corr','N-H_Corr']
         
         for i,file in enumerate(filelist):
-            stat_df = pd.read_csv(file,delim_whitespace=True,names=cols)
-            stat_list.append(stat_df.iloc[0,1])
-            lon_list.append(stat_df.iloc[0,3])
-            lat_list.append(stat_df.iloc[0,4])
-            height_list.append(stat_df.iloc[0,5])
+            first, last = read_first_last_records(file,cols)
+            stat_list.append(first['Station_Name'])
+            lon_list.append(first['Longitude'])
+            lat_list.append(first['Latitude'])
+            height_list.append(first['Height'])
             
     stat_df = pd.DataFrame({'Station' : stat_list,
                             'Longitude' : lon_list,
@@ -139,7 +582,9 @@ def make_gps_station_df(filelist):
 
 
 def make_gps_station_displacement_df_degrandpre(filelist,starttime,endtime,
-                                                ref_station='AV15'):
+                                                ref_station='AV15',store=None):
+    if filelist is None and store is not None:
+        filelist = store.sources
     for file in filelist:
         if ref_station in file:
             ref_file = file
@@ -147,7 +592,7 @@ def make_gps_station_displacement_df_degrandpre(filelist,starttime,endtime,
     cols = ['Time','Station_Name','Period','Longitude','Latitude','Height','E_Uncer','N_Uncer','H_Uncer',
                 'E-N_Corr,','E-H_Corr','N-H_Corr']
         
-    ref_df = pd.read_csv(ref_file,delim_whitespace=True,names=cols)
+    ref_df = _station_data(ref_file,store,cols)
     ref_df = ref_df.drop(columns=['Period'])
     
     ref_lon = ref_df['Longitude'].tolist()
@@ -174,7 +619,7 @@ def make_gps_station_displacement_df_degrandpre(filelist,starttime,endtime,
             cols = ['Time','Station_Name','Period','Longitude','Latitude','Height','E_Uncer','N_Uncer','H_Uncer',
                         'E-N_Corr,','E-H_Corr','N-H_Corr']
                 
-            stat_df = pd.read_csv(file,delim_whitespace=True,names=cols)
+            stat_df = _station_data(file,store,cols)
             stat_df = stat_df.drop(columns=['Period'])
             station = stat_df.iloc[0,1]
             print(station)
@@ -235,7 +680,8 @@ def plot_displacement_vectors_degrandpre(fig,disps,scaling_factor=10):
     
     return fig
     
-def make_gps_station_displacement_df(filelist):
+def make_gps_station_displacement_df(filelist,use_index: bool=False,index_path: str=None,
+                                     store=None,n_workers: int=1):
     """
     Makes a DataFrame containing GPS initial positions and their total 
     displacement over the entire time span given in the GPS file. Useful for 
@@ -248,6 +694,18 @@ def make_gps_station_displacement_df(filelist):
     ----------
     filelist : list
         List of filepaths to GPS files of interest.
+    use_index : bool, optional
+        If True, first and last positions come from the GPS index (see
+        get_gps_index) instead of reading every file. The default is False.
+    index_path : str, optional
+        Index database to use with use_index.
+    store : GPSStore, optional
+        Store to take the time series from instead of parsing the files, see
+        build_gps_store. filelist can then also give station names, or be
+        None for every station in the store. The default is None.
+    n_workers : int, optional
+        Number of processes get_gps_index reads changed files with when
+        use_index is True. The default is 1.
 
     Returns
     -------
@@ -257,6 +715,31 @@ def make_gps_station_displacement_df(filelist):
         absolute deformation, but not local deformation. Ex. stations on a
         volcanic island in a subduction zone will have their absolute motion
     """
+    if store is not None:
+        if filelist is None:
+            filelist = store.sources
+        rows = np.array([store.resolve(file) for file in filelist],dtype=np.int64)
+        first = store.offsets[rows]
+        last = store.offsets[rows + 1] - 1
+        lons = store.columns['Longitude']
+        lats = store.columns['Latitude']
+        heights = store.columns['Height']
+        return pd.DataFrame({'Station' : [store.stations[i] for i in rows],
+                             'Longitude' : lons[first],
+                             'Latitude' : lats[first],
+                             'E_Disp' : lons[last] - lons[first],
+                             'N_Disp' : lats[last] - lats[first],
+                             'H_Disp' : heights[last] - heights[first]})
+
+    if use_index:
+        index_df = get_gps_index(filelist,index_path=index_path,n_workers=n_workers)
+        return pd.DataFrame({'Station' : index_df['station'],
+                             'Longitude' : index_df['first_lon'],
+                             'Latitude' : index_df['first_lat'],
+                             'E_Disp' : index_df['last_lon'] - index_df['first_lon'],
+                             'N_Disp' : index_df['last_lat'] - index_df['first_lat'],
+                             'H_Disp' : index_df['last_height'] - index_df['first_height']})
+
     file_name = os.path.split(filelist[0])[1]
     
     lon_list = []
@@ -271,13 +754,14 @@ def make_gps_station_displacement_df(filelist):
                 'E-N_Corr,','E-H_Corr','N-H_Corr']
         
         for i,file in enumerate(filelist):
-            stat_df = pd.read_csv(file,delim_whitespace=True,names=cols)
-            stat_list.append(stat_df.iloc[0,1])
-            lon_list.append(stat_df.iloc[0,3])
-            lat_list.append(stat_df.iloc[0,4])
-            e_disp_list.append(stat_df.iloc[-1,3] - stat_df.iloc[0,3])
-            n_disp_list.append(stat_df.iloc[-1,4] - stat_df.iloc[0,4])
-            h_disp_list.append(stat_df.iloc[-1,5] - stat_df.iloc[0,5])
+            # Only the first and last epochs are needed
+            first, last = read_first_last_records(file,cols)
+            stat_list.append(first['Station_Name'])
+            lon_list.append(first['Longitude'])
+            lat_list.append(first['Latitude'])
+            e_disp_list.append(last['Longitude'] - first['Longitude'])
+            n_disp_list.append(last['Latitude'] - first['Latitude'])
+            h_disp_list.append(last['Height'] - first['Height'])
             
     # Do same as above but with different file format
             
@@ -290,9 +774,92 @@ def make_gps_station_displacement_df(filelist):
     
     return stat_df
 
+# WGS84 ellipsoid, for converting degrees to distances on the ground
+wgs84_a = 6378.137
+wgs84_f = 1 / 298.257223563
+wgs84_e2 = wgs84_f * (2 - wgs84_f)
+
+def _meridian_arc(lats):
+    """Distance along the meridian from the equator to each latitude, in km (WGS84)"""
+    n = wgs84_f / (2 - wgs84_f)
+    phi = np.radians(lats)
+    return (wgs84_a / (1 + n)) * ((1 + n**2 / 4 + n**4 / 64) * phi
+                                  - 1.5 * (n - n**3 / 8) * np.sin(2 * phi)
+                                  + (15 / 16) * (n**2 - n**4 / 4) * np.sin(4 * phi)
+                                  - (35 / 48) * n**3 * np.sin(6 * phi)
+                                  + (315 / 512) * n**4 * np.sin(8 * phi))
+
+def _parallel_arc(lats, dlons):
+    """Distance along the parallel at each latitude for a longitude difference, in km (WGS84)"""
+    phi = np.radians(lats)
+    prime_vertical = wgs84_a / np.sqrt(1 - wgs84_e2 * np.sin(phi)**2)
+    dlons = (np.asarray(dlons) + 180) % 360 - 180
+    return prime_vertical * np.cos(phi) * np.abs(np.radians(dlons))
+
+def relative_displacement(stat_times, stat_lon, stat_lat, stat_height,
+                          ref_lon_poly, ref_lat_poly, use_geopy: bool=False):
+    """
+    Displacement of a station over time relative to the trend of a reference
+    station. At each epoch, the north-south and east-west distances from the
+    reference trend position to the station are found, and the change from
+    the first epoch is returned.
+
+    By default the whole time series is handled at once: the reference trend
+    is evaluated over every epoch together, north-south distances come from
+    the WGS84 meridian arc and east-west distances from N cos(lat) dlon along
+    the parallel. For stations tens of km apart this agrees with geodesic
+    distances to within a few micrometres of displacement.
+
+    Parameters
+    ----------
+    stat_times : array-like
+        Epoch times.
+    stat_lon, stat_lat, stat_height : array-like
+        Station positions at each epoch.
+    ref_lon_poly, ref_lat_poly : numpy.poly1d
+        Reference station longitude and latitude trends over time.
+    use_geopy : bool, optional
+        If True, uses two geopy geodesic distances per epoch instead, which is
+        much slower. The default is False.
+
+    Returns
+    -------
+    lon_disp, lat_disp, height_disp : numpy.ndarray
+        East, north and vertical displacement, in the units and sign
+        convention of make_gps_relative_displacement_df_dict.
+    """
+    stat_times = np.asarray(stat_times,dtype=np.float64)
+    stat_lon = np.asarray(stat_lon,dtype=np.float64)
+    stat_lat = np.asarray(stat_lat,dtype=np.float64)
+    stat_height = np.asarray(stat_height,dtype=np.float64)
+
+    ref_lon_at_time = ref_lon_poly(stat_times)
+    ref_lat_at_time = ref_lat_poly(stat_times)
+
+    if use_geopy:
+        lat_diff = np.empty(len(stat_times))
+        lon_diff = np.empty(len(stat_times))
+        for i in range(len(stat_times)):
+            # Fix lon and calculate lat diff
+            lat_diff[i] = distance.distance([ref_lat_at_time[i],ref_lon_at_time[i]],
+                                            [stat_lat[i],ref_lon_at_time[i]]).km
+            # Fix lat and calculate lon diff
+            lon_diff[i] = distance.distance([ref_lat_at_time[i],ref_lon_at_time[i]],
+                                            [ref_lat_at_time[i],stat_lon[i]]).km
+    else:
+        lat_diff = np.abs(_meridian_arc(stat_lat) - _meridian_arc(ref_lat_at_time))
+        lon_diff = _parallel_arc(ref_lat_at_time,stat_lon - ref_lon_at_time)
+
+    lon_disp = (lon_diff - lon_diff[0]) * -100000
+    lat_disp = (lat_diff - lat_diff[0]) * -100000
+    height_disp = (stat_height - stat_height[0]) * -100
+
+    return lon_disp, lat_disp, height_disp
+
 def make_gps_relative_displacement_df_dict(filelist,ref_station,
                                            plot_lats=False,plot_lons=False,
-                                           plot_elevs=False,plot_ref=False):
+                                           plot_elevs=False,plot_ref=False,
+                                           use_geopy: bool=False,store=None):
     """
     Parameters
     ----------
@@ -312,6 +879,14 @@ def make_gps_relative_displacement_df_dict(filelist,ref_station,
     plot_ref : bool, optional
         Will plot the absolute GPS positions over time for the reference station
         in question. The default is False.
+    use_geopy : bool, optional
+        If True, distances are computed with geopy one epoch at a time, as
+        they used to be, instead of in one pass. See relative_displacement.
+        The default is False.
+    store : GPSStore, optional
+        Store to take the time series from instead of parsing the files, see
+        build_gps_store. filelist can then also give station names, or be
+        None for every station in the store. The default is None.
 
     Returns
     -------
@@ -321,6 +896,8 @@ def make_gps_relative_displacement_df_dict(filelist,ref_station,
         displacement of each station over time, in millimeters, relative to 
         the reference station.
     """
+    if filelist is None and store is not None:
+        filelist = store.sources
     for file in filelist:
         if ref_station in file:
             ref_file = file
@@ -328,7 +905,7 @@ def make_gps_relative_displacement_df_dict(filelist,ref_station,
     cols = ['Time','Station_Name','Period','Longitude','Latitude','Height','E_Uncer','N_Uncer','H_Uncer',
                 'E-N_Corr,','E-H_Corr','N-H_Corr']
         
-    ref_df = pd.read_csv(ref_file,delim_whitespace=True,names=cols)
+    ref_df = _station_data(ref_file,store,cols)
     ref_df = ref_df.drop(columns=['Period'])
     
     ref_lon = ref_df['Longitude'].tolist()
@@ -372,7 +949,7 @@ def make_gps_relative_displacement_df_dict(filelist,ref_station,
             cols = ['Time','Station_Name','Period','Longitude','Latitude','Height','E_Uncer','N_Uncer','H_Uncer',
                         'E-N_Corr,','E-H_Corr','N-H_Corr']
                 
-            stat_df = pd.read_csv(file,delim_whitespace=True,names=cols)
+            stat_df = _station_data(file,store,cols)
             stat_df = stat_df.drop(columns=['Period'])
             
             stat_name = stat_df['Station_Name'].tolist()[0]
@@ -381,44 +958,10 @@ def make_gps_relative_displacement_df_dict(filelist,ref_station,
             stat_height = stat_df['Height'].tolist()
             stat_times = stat_df['Time'].tolist()
             
-            lon_disp = []
-            lat_disp = []
-            height_disp = []
-            
-            for i,time in enumerate(stat_times):
-                ref_lon_at_time = ref_lon_poly(time)
-                ref_lat_at_time = ref_lat_poly(time)
-                ref_height_at_time = ref_height_poly(time)
-                if i == 0:
-                    
-                    # Fix lon and calculate lat diff
-                    initial_lat_diff = distance.distance([ref_lat_at_time,ref_lon_at_time],
-                                                         [stat_lat[i],ref_lon_at_time]).km
-                    # FIx lat and calculate lon diff
-                    initial_lon_diff = distance.distance([ref_lat_at_time,ref_lon_at_time],
-                                                         [ref_lat_at_time,stat_lon[i]]).km
-                    lon_disp.append(0)
-                    lat_disp.append(0)
-                    
-                    initial_height = stat_height[i]
-                    height_disp.append(0)
-                else:
-                    current_lon_diff = distance.distance([ref_lat_at_time,ref_lon_at_time],
-                                                         [ref_lat_at_time,stat_lon[i]]).km
-                    lon_displacement = current_lon_diff - initial_lon_diff
-                    lon_disp.append(lon_displacement)
-                    
-                    current_lat_diff = distance.distance([ref_lat_at_time,ref_lon_at_time],
-                                                         [stat_lat[i],ref_lon_at_time]).km
-                    lat_displacement = current_lat_diff - initial_lat_diff
-                    lat_disp.append(lat_displacement)
-                    
-                    height_displacement = stat_height[i] - initial_height
-                    height_disp.append(height_displacement)
-                    
-            lon_disp = [x * -100000 for x in lon_disp]
-            lat_disp = [x * -100000 for x in lat_disp]
-            height_disp = [x * -100 for x in height_disp]
+            lon_disp, lat_disp, height_disp = relative_displacement(stat_times,stat_lon,
+                                                                    stat_lat,stat_height,
+                                                                    ref_lon_poly,ref_lat_poly,
+                                                                    use_geopy=use_geopy)
         
             if plot_lons:
                 plt.plot(stat_times,lon_disp)
@@ -5,16 +5,34 @@ Created on Tue Nov  7 15:05:26 2023
 @author: tlee
 """
 
+import os
+import time
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from obspy.clients.fdsn import Client
+from obspy.clients.fdsn.header import FDSNNoDataException, FDSNBadRequestException, URL_MAPPINGS
+from obspy import UTCDateTime
 import pygmt
 
 if __name__ == '__main__':
     import general_mapping as gm
+    import relief_cache as rc
+    import inventory_cache as ic
+    import station_utils as su
 else:
     import scripts.general_mapping as gm
+    import scripts.relief_cache as rc
+    import scripts.inventory_cache as ic
+    import scripts.station_utils as su
 
 
-def find_stations(network, starttime,endtime,station='*',client="IRIS"):
+def find_stations(network, starttime,endtime,station='*',client="IRIS",
+                  use_cache: bool=False,cache_ttl: float=None):
     """
     Parameters
     ----------
@@ -28,6 +46,11 @@ def find_stations(network, starttime,endtime,station='*',client="IRIS"):
         Glob compatible station selection. The default is '*'.
     client : string, optional
         Data host. If unsure use default. The default is "IRIS".
+    use_cache : bool, optional
+        If True, the query is answered from the local inventory cache when
+        possible. See scripts.inventory_cache. The default is False.
+    cache_ttl : float, optional
+        Maximum age of cached inventories in seconds. The default is one week.
 
     Returns
     -------
@@ -35,6 +58,13 @@ def find_stations(network, starttime,endtime,station='*',client="IRIS"):
         ObsPy inventory object containing the selected stations.
 
     """
+    if use_cache:
+        return ic.get_stations(client,ttl=cache_ttl,
+                               starttime=starttime,
+                               endtime=endtime,
+                               network=network,
+                               station=station,
+                               level="channel")
     working_client = Client(client)
     station_inv = working_client.get_stations(starttime=starttime,
                                               endtime=endtime,
@@ -43,7 +73,27 @@ def find_stations(network, starttime,endtime,station='*',client="IRIS"):
                                               level="channel",)
     return station_inv
 
-def find_multi_network(deployment_list,bounds,client="IRIS"):
+def _get_stations_with_retry(get_client, query, retries=3, backoff=1.0):
+    """
+    Calls get_stations, retrying with exponential backoff on errors that might
+    go away (timeouts, server errors). Missing data and bad requests are raised
+    straight away.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return get_client().get_stations(**query)
+        except (FDSNNoDataException, FDSNBadRequestException):
+            raise
+        except Exception as e:
+            if attempt == retries:
+                raise
+            wait = backoff * (2 ** attempt)
+            print(f"Request for {query['network']} failed ({e}), retrying in {wait:.1f} s")
+            time.sleep(wait)
+
+def find_multi_network(deployment_list,bounds,client="IRIS",concurrent: bool=False,
+                       max_workers: int=4,retries: int=3,backoff: float=1.0,
+                       use_cache: bool=False,cache_ttl: float=None):
     """
     Parameters
     ----------
@@ -55,11 +105,29 @@ def find_multi_network(deployment_list,bounds,client="IRIS"):
         Region to search for stations, in order [minlon, maxlon, minlat, maxlat]
     client : string, optional
         Data host. If unsure use default. The default is "IRIS".
+    concurrent : bool, optional
+        If True, requests all deployments at once from a thread pool instead of
+        one after another. The default is False.
+    max_workers : int, optional
+        Maximum number of requests in flight when concurrent is True.
+        The default is 4.
+    retries : int, optional
+        Number of times to retry a failed request. The default is 3.
+    backoff : float, optional
+        Seconds to wait before the first retry, doubled on each following
+        retry. The default is 1.0.
+    use_cache : bool, optional
+        If True, deployments are answered from the local inventory cache when
+        possible and new responses are added to it. See
+        scripts.inventory_cache. The default is False.
+    cache_ttl : float, optional
+        Maximum age of cached inventories in seconds. The default is one week.
 
     Returns
     -------
     station_inv : obspy.core.inventory.Inventory
-        ObsPy inventory object containing the stations.
+        ObsPy inventory object containing the stations, merged in the order of
+        deployment_list.
     """
     print('======BUILDING INVENTORY======')
 
@@ -71,9 +139,8 @@ def find_multi_network(deployment_list,bounds,client="IRIS"):
     minlat = bounds[2]
     maxlat = bounds[3]
 
-    print('Requesting inventories...')
-    working_client = Client(client)
-    for i, deployment in enumerate(deployment_list):
+    queries = []
+    for deployment in deployment_list:
         network = deployment[0]
         starttime = deployment[1]
         endtime = deployment[2]
@@ -83,33 +150,59 @@ def find_multi_network(deployment_list,bounds,client="IRIS"):
         elif len(deployment) == 4:
             stations = deployment[3]
         else:
-            raise ValueError("Expected 3 or 4 arguments for network {network}, got {len(deployment})")
-
-
-        if i < 1:
-            station_inv = working_client.get_stations(starttime=starttime,
-                                                      endtime=endtime,
-                                                      network=network,
-                                                      station=stations,
-                                                      level="channel",
-                                                      minlatitude=minlat,
-                                                      maxlatitude=maxlat,
-                                                      minlongitude=minlon,
-                                                      maxlongitude=maxlon)
-            print('Obtained inventory for deployment 1')
-        else:
-            secondary_inv = working_client.get_stations(starttime=starttime,
-                                                        endtime=endtime,
-                                                        network=network,
-                                                        station=stations,
-                                                        level="channel",
-                                                        minlatitude=minlat,
-                                                        maxlatitude=maxlat,
-                                                        minlongitude=minlon,
-                                                        maxlongitude=maxlon)
-            station_inv += secondary_inv
+            raise ValueError(f"Expected 3 or 4 arguments for network {network}, got {len(deployment)}")
+
+        queries.append({'starttime' : starttime,
+                        'endtime' : endtime,
+                        'network' : network,
+                        'station' : stations,
+                        'level' : "channel",
+                        'minlatitude' : minlat,
+                        'maxlatitude' : maxlat,
+                        'minlongitude' : minlon,
+                        'maxlongitude' : maxlon})
+
+    inventories = [None] * len(queries)
+    if use_cache:
+        for i, query in enumerate(queries):
+            inventories[i] = ic.find_cached_inventory(client,query,ttl=cache_ttl)
+            if inventories[i] is not None:
+                print(f'Using cached inventory for deployment {i+1}')
+    pending = [i for i, inv in enumerate(inventories) if inv is None]
+
+    if pending:
+        print('Requesting inventories...')
+    if concurrent and pending:
+        # Creating a Client queries the service, so each thread makes one and
+        # reuses it rather than making one per request
+        thread_data = threading.local()
+        def get_client():
+            if not hasattr(thread_data,'client'):
+                thread_data.client = Client(client)
+            return thread_data.client
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(_get_stations_with_retry,get_client,queries[i],
+                                       retries,backoff) : i for i in pending}
+            for future in as_completed(futures):
+                i = futures[future]
+                inventories[i] = future.result()
+                print(f'Obtained inventory for deployment {i+1}')
+    elif pending:
+        working_client = Client(client)
+        for i in pending:
+            inventories[i] = _get_stations_with_retry(lambda: working_client,queries[i],
+                                                      retries,backoff)
             print(f'Obtained inventory for deployment {i+1}')
 
+    if use_cache:
+        for i in pending:
+            ic.store_inventory(client,queries[i],inventories[i])
+
+    station_inv = inventories[0]
+    for secondary_inv in inventories[1:]:
+        station_inv += secondary_inv
+
     station_total = getStationCount(station_inv)
 
     print(f'{station_total} stations found in {len(station_inv)} networks.')
@@ -117,6 +210,136 @@ def find_multi_network(deployment_list,bounds,client="IRIS"):
 
     return station_inv
 
+StationRecord = namedtuple('StationRecord',['network','station','latitude','longitude',
+                                             'elevation','start_date','end_date','channels'])
+
+def _local_tag(element):
+    """Element tag without the StationXML namespace"""
+    return element.tag.rsplit('}',1)[-1]
+
+def _child_float(element, name):
+    for child in element:
+        if _local_tag(child) == name:
+            return float(child.text)
+    return float('nan')
+
+def iter_stationxml(source):
+    """
+    Reads a StationXML document incrementally, yielding each station as soon
+    as its closing tag is read. Channel and response subtrees are thrown away
+    once their code has been taken, and finished stations are removed from the
+    tree, so memory stays flat however large the document is.
+
+    Parameters
+    ----------
+    source : str or file-like
+        Path to a StationXML file or a binary stream, such as an HTTP response.
+
+    Yields
+    ------
+    record : StationRecord
+        Network code, station code, latitude, longitude, elevation, start and
+        end date (UTCDateTime or None) and a tuple of channel codes, which is
+        empty for station level documents.
+    """
+    network_code = None
+    network_element = None
+    channels = []
+
+    for event, element in ET.iterparse(source,events=('start','end')):
+        tag = _local_tag(element)
+        if event == 'start':
+            if tag == 'Network':
+                network_code = element.get('code')
+                network_element = element
+            elif tag == 'Station':
+                channels = []
+            continue
+
+        if tag == 'Channel':
+            channels.append(element.get('code'))
+            element.clear()
+        elif tag == 'Response':
+            element.clear()
+        elif tag == 'Station':
+            start_date = element.get('startDate')
+            end_date = element.get('endDate')
+            yield StationRecord(network=network_code,
+                                station=element.get('code'),
+                                latitude=_child_float(element,'Latitude'),
+                                longitude=_child_float(element,'Longitude'),
+                                elevation=_child_float(element,'Elevation'),
+                                start_date=UTCDateTime(start_date) if start_date else None,
+                                end_date=UTCDateTime(end_date) if end_date else None,
+                                channels=tuple(channels))
+            element.clear()
+            if network_element is not None:
+                network_element.remove(element)
+        elif tag == 'Network':
+            element.clear()
+            network_element = None
+
+def stream_stations(network, starttime, endtime, station='*', client="IRIS",
+                    bounds=None, level="channel", timeout: float=120):
+    """
+    Requests stations from an FDSN station service and yields them while the
+    response is still downloading, without building an ObsPy Inventory.
+
+    Parameters
+    ----------
+    network : string
+        Network name.
+    starttime : string
+        Starttime formattted as yyyy-mm-ddT00.00.00.000. Can exclude T.
+    endtime : string
+        Endtime formatted as yyyy-mm-ddT00.00.00.000. Can exclude T.
+    station : string, optional
+        Glob compatible station selection. The default is '*'.
+    client : string, optional
+        Data host name, see obspy.clients.fdsn.header.URL_MAPPINGS, or a base
+        URL. The default is "IRIS".
+    bounds : list of ints or floats, optional
+        Region to search for stations, in order [minlon, maxlon, minlat, maxlat].
+        The default is None, for no limit.
+    level : string, optional
+        "station" or "channel". Use "station" if channel codes aren't needed.
+        The default is "channel".
+    timeout : float, optional
+        Request timeout in seconds. The default is 120.
+
+    Yields
+    ------
+    record : StationRecord
+        See iter_stationxml.
+    """
+    if level not in ['station','channel']:
+        raise ValueError(f'Level must be "station" or "channel", got {level}')
+
+    base_url = URL_MAPPINGS.get(client.upper(),client)
+    params = {'network' : network,
+              'station' : station,
+              'starttime' : str(UTCDateTime(starttime)),
+              'endtime' : str(UTCDateTime(endtime)),
+              'level' : level,
+              'format' : 'xml'}
+    if bounds is not None:
+        if len(bounds) != 4:
+            raise ValueError(f'Expected 4 items in bounds, got {len(bounds)}')
+        params.update({'minlongitude' : bounds[0], 'maxlongitude' : bounds[1],
+                       'minlatitude' : bounds[2], 'maxlatitude' : bounds[3]})
+    url = f'{base_url}/fdsnws/station/1/query?{urllib.parse.urlencode(params)}'
+
+    try:
+        with urllib.request.urlopen(url,timeout=timeout) as response:
+            if response.status == 204:
+                return
+            yield from iter_stationxml(response)
+    except urllib.error.HTTPError as e:
+        if e.code in (204, 404):
+            return
+        message = e.read().decode('utf-8',errors='replace')
+        raise ValueError(f'Station request failed with HTTP {e.code}: {message.strip()}')
+
 def getStationCount(inventory):
     """Returns total number of stations in inventory, across all networks"""
     count = 0
@@ -141,14 +364,10 @@ def get_coordinates_from_network(network):
         List of elevations.
 
     """
-    lat_list = []
-    lon_list = []
-    elev_list = []
-
-    for station in network:
-        lat_list.append(station.latitude)
-        lon_list.append(station.longitude)
-        elev_list.append(station.elevation)
+    station_arrays = su.inventory_to_arrays(network)
+    lat_list = station_arrays['latitude'].tolist()
+    lon_list = station_arrays['longitude'].tolist()
+    elev_list = station_arrays['elevation'].tolist()
 
     return lat_list, lon_list, elev_list
 
@@ -170,15 +389,10 @@ def get_coordinate_list(inventory):
 
     """
 
-    lat_list = []
-    lon_list = []
-    elev_list = []
-
-    for network in inventory:
-        lats, lons, elevs = get_coordinates_from_network(network)
-        lat_list += lats
-        lon_list += lons
-        elev_list += elevs
+    station_arrays = su.inventory_to_arrays(inventory)
+    lat_list = station_arrays['latitude'].tolist()
+    lon_list = station_arrays['longitude'].tolist()
+    elev_list = station_arrays['elevation'].tolist()
 
     return lat_list, lon_list, elev_list
 
@@ -215,12 +429,29 @@ def plot_bounding_box(fig, bounds):
     return fig
 
 
+station_colors = ["cyan","yellow","green","blue","purple","orange","red"]
+
+def get_network_colors(num_networks):
+    """
+    Parameters
+    ----------
+    num_networks : int
+        Number of networks to color.
+
+    Returns
+    -------
+    colors : list of str
+        GMT colors, starting with station_colors and continuing with evenly
+        spread hues when there are more networks than named colors.
+    """
+    return gm.get_category_colors(num_networks,palette=station_colors)
+
 def plot_stations(inventory,fig=None,projection="Q15c+du",figure_name="figure!",
                   resolution='03s',region=None,
                   cmap="./Resources/colormaps/colombia.cpt",
                   box_bounds=None,margin=0.1,
                   plot_holo_vol=False,outside_stats_small=False,
-                  bathymetry=True,colorbar_tick=1000):
+                  bathymetry=True,colorbar_tick=1000,legend: bool=True):
     """
     Parameters
     ----------
@@ -251,6 +482,13 @@ def plot_stations(inventory,fig=None,projection="Q15c+du",figure_name="figure!",
         outside the bounding box smaller.
     bathymetry : bool
         If False, will replace oceans with solid color. Default is false.
+    legend : bool, optional
+        If True, draws a legend with one entry per network. On a figure created
+        here, stations are drawn in one call and the legend is written
+        directly. On a figure passed in as fig, each network is drawn with its
+        own label instead, so the legend also keeps every other labelled entry
+        already on fig. Set to False to build the legend yourself. The default
+        is True.
 
     Returns
     -------
@@ -266,7 +504,9 @@ def plot_stations(inventory,fig=None,projection="Q15c+du",figure_name="figure!",
     print('======CREATING STATION PLOT======')
     print('Pulling station coordinates from inventory...')
     if len(inventory) != 0:
-        lats,lons,elevs = get_coordinate_list(inventory)
+        station_arrays = su.inventory_to_arrays(inventory)
+        lats = station_arrays['latitude']
+        lons = station_arrays['longitude']
 
     print('Calculating map bounds with margin...')
     if region == None:
@@ -274,11 +514,12 @@ def plot_stations(inventory,fig=None,projection="Q15c+du",figure_name="figure!",
     else:
         bounds = gm.get_margin_from_bounds(region,margin=margin)
 
+    created_fig = fig is None
     if fig == None:
         try:
             print('Loading relief grid...')
-            grid = pygmt.datasets.load_earth_relief(resolution=resolution, region=bounds)
-            shade = pygmt.grdgradient(grid=grid, azimuth='0/90', normalize='t1')
+            grid = rc.load_relief(resolution=resolution, region=bounds)
+            shade = rc.load_shade(grid, azimuth='0/90', normalize='t1')
 
             print('Creating base map...')
             fig = pygmt.Figure()
@@ -308,18 +549,33 @@ def plot_stations(inventory,fig=None,projection="Q15c+du",figure_name="figure!",
 
 
 
-    colors = ["cyan","yellow","green","blue","purple","orange","red"]
-
     print('Plotting stations...')
     if len(inventory) != 0:
-        for i, network in enumerate(inventory):
-            lats,lons,elevs = get_coordinates_from_network(network)
-            fig.plot(x=lons,
-                     y=lats,
-                     style="t0.4c",
-                     fill=colors[i],
-                     label=network.code,
-                     pen="0.2p")
+        network_codes = station_arrays['network_codes']
+        colors = get_network_colors(len(network_codes))
+        if legend and not created_fig:
+            # Labelled entries already on fig only reach the legend through
+            # GMT's automatic legend, so networks are labelled the same way
+            network_index = station_arrays['network_index']
+            for i, network_code in enumerate(network_codes):
+                fig.plot(x=lons[network_index == i],
+                         y=lats[network_index == i],
+                         style="t0.4c",
+                         fill=colors[i],
+                         label=network_code,
+                         pen="0.2p")
+        else:
+            cpt_file = gm.write_category_cpt(network_codes,colors)
+            try:
+                # One call for every station, colored through a categorical CPT
+                fig.plot(x=lons,
+                         y=lats,
+                         style="t0.4c",
+                         fill=station_arrays['network_index'],
+                         cmap=cpt_file,
+                         pen="0.2p")
+            finally:
+                os.remove(cpt_file)
 
     if box_bounds != None:
         if len(bounds) != 4:
@@ -340,6 +596,15 @@ def plot_stations(inventory,fig=None,projection="Q15c+du",figure_name="figure!",
     if plot_holo_vol == True:
         fig = gm.plot_holocene_volcanoes(fig)
 
-    fig.legend()
+    if legend:
+        if len(inventory) != 0 and created_fig:
+            legend_file = gm.write_category_legend(network_codes,colors,
+                                                   symbol='t',size='0.4c',pen='0.2p')
+            try:
+                fig.legend(spec=legend_file)
+            finally:
+                os.remove(legend_file)
+        else:
+            fig.legend()
 
     return fig
@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 09:12:40 2026
+
+@author: tlee
+
+
+On-disk cache for the relief grids used by the base map functions. Each request
+is snapped outward to a coarse grid of edges (see snap_region) and stored as one
+netCDF grid, called a tile here. A later request is served by slicing any
+cached tile that contains it, so nearby maps and maps inside an earlier one
+share a download. Tiles are not mosaicked: a map that overlaps cached tiles
+without fitting inside one of them fetches its own. Each tile has a small JSON
+sidecar describing it, so several processes can share one cache folder without
+a central index.
+
+Hillshade grids made from cached relief are memoized too, in memory and
+optionally on disk alongside the relief tiles.
+"""
+
+import os
+import json
+import math
+import time
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import xarray as xr
+import pygmt
+
+import scripts.cache_utils as cu
+
+max_cache_bytes = 4 * 1024 ** 3
+max_shade_entries = 8
+persist_shades = False
+
+_shade_memory = OrderedDict()
+
+# Snapping step in degrees for each resolution. Finer grids snap to smaller
+# steps so the padding added around a request stays a reasonable size on disk.
+tile_edges = {'01d' : 10, '30m' : 10, '20m' : 10, '15m' : 10, '10m' : 5,
+              '06m' : 5, '05m' : 5, '04m' : 5, '03m' : 2, '02m' : 2,
+              '01m' : 1, '30s' : 1, '15s' : 1, '03s' : 0.5, '01s' : 0.25}
+
+def set_cache_options(folder: str=None, max_bytes: int=None,
+                      shade_entries: int=None, persist_shade: bool=None):
+    """
+    Parameters
+    ----------
+    folder : str, optional
+        Folder to keep the cached tiles in, shared with the other caches, see
+        cache_utils.set_cache_folder.
+    max_bytes : int, optional
+        Byte budget for the relief tiles. Least recently used tiles are
+        removed once the cache grows past this. The default is 4 GB.
+    shade_entries : int, optional
+        Number of hillshade grids to keep in memory. The default is 8.
+    persist_shade : bool, optional
+        If True, hillshade grids are also written to the cache folder and count
+        towards max_bytes. The default is False.
+    """
+    global max_cache_bytes, max_shade_entries, persist_shades
+    if folder is not None:
+        cu.set_cache_folder(folder)
+    if max_bytes is not None:
+        max_cache_bytes = int(max_bytes)
+    if shade_entries is not None:
+        max_shade_entries = int(shade_entries)
+        while len(_shade_memory) > max_shade_entries:
+            _shade_memory.popitem(last=False)
+    if persist_shade is not None:
+        persist_shades = bool(persist_shade)
+
+def get_relief_folder():
+    """Returns the folder the relief tiles are stored in, creating it if needed"""
+    return cu.get_cache_folder('relief')
+
+def snap_region(region, resolution):
+    """
+    Parameters
+    ----------
+    region : list of ints or floats
+        Region in format [minlon, maxlon, minlat, maxlat]
+    resolution : str
+        Resolution of the relief grid, used to pick the snapping step.
+
+    Returns
+    -------
+    snapped_region : list of floats
+        Region expanded outward to the nearest multiples of the snapping
+        step, so requests for nearby regions give the same tile.
+    """
+    if len(region) != 4:
+        raise ValueError(f'Expected 4 items in region, got {len(region)}')
+    edge = tile_edges.get(resolution,1)
+
+    min_lon = math.floor(region[0] / edge) * edge
+    max_lon = math.ceil(region[1] / edge) * edge
+    min_lat = max(math.floor(region[2] / edge) * edge, -90)
+    max_lat = min(math.ceil(region[3] / edge) * edge, 90)
+
+    snapped_region = [float(min_lon), float(max_lon), float(min_lat), float(max_lat)]
+
+    return snapped_region
+
+def _tile_key(data_source, resolution, region, registration):
+    """Content address for a tile, built from everything that defines its data"""
+    key_string = json.dumps([data_source, resolution, [round(val,6) for val in region],
+                             registration])
+    return hashlib.sha1(key_string.encode('utf-8')).hexdigest()
+
+def _list_tiles(relief_folder):
+    """Returns (meta_path, meta) for every tile currently in the cache"""
+    tiles = []
+    for fname in os.listdir(relief_folder):
+        if not fname.endswith('.json'):
+            continue
+        meta_path = os.path.join(relief_folder,fname)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue
+        tiles.append((meta_path, meta))
+    return tiles
+
+def _region_contains(outer, inner):
+    return (outer[0] <= inner[0] and outer[1] >= inner[1] and
+            outer[2] <= inner[2] and outer[3] >= inner[3])
+
+def _find_tile(relief_folder, data_source, resolution, region, registration):
+    """
+    Looks for a cached tile able to serve the region, first by the content
+    address of the snapped region, then by any cached tile that covers it.
+    """
+    snapped = snap_region(region,resolution)
+    key = _tile_key(data_source,resolution,snapped,registration)
+    meta_path = os.path.join(relief_folder,f'{key}.json')
+    if os.path.isfile(meta_path) and os.path.isfile(os.path.join(relief_folder,f'{key}.nc')):
+        return key
+
+    for meta_path, meta in _list_tiles(relief_folder):
+        if (meta.get('kind','relief') == 'relief'
+                and meta['data_source'] == data_source and meta['resolution'] == resolution
+                and meta['registration'] == registration
+                and _region_contains(meta['region'],region)):
+            key = os.path.basename(meta_path)[:-5]
+            if os.path.isfile(os.path.join(relief_folder,f'{key}.nc')):
+                return key
+
+    return None
+
+def _store_tile(relief_folder, grid, data_source, resolution, region, registration):
+    key = _tile_key(data_source,resolution,region,registration)
+    nc_path = os.path.join(relief_folder,f'{key}.nc')
+    cu.atomic_write(nc_path,grid.to_netcdf)
+
+    meta = {'kind' : 'relief',
+            'data_source' : data_source,
+            'resolution' : resolution,
+            'registration' : registration,
+            'region' : region,
+            'bytes' : os.path.getsize(nc_path),
+            'gmt_registration' : int(grid.gmt.registration),
+            'gmt_gtype' : int(grid.gmt.gtype)}
+    cu.atomic_write_json(os.path.join(relief_folder,f'{key}.json'),meta)
+
+    return key, meta
+
+def _load_tile(relief_folder, key):
+    with open(os.path.join(relief_folder,f'{key}.json')) as f:
+        meta = json.load(f)
+    grid = xr.load_dataarray(os.path.join(relief_folder,f'{key}.nc'))
+
+    # Touching the sidecar records the access time used for LRU eviction
+    now = time.time()
+    os.utime(os.path.join(relief_folder,f'{key}.json'),(now,now))
+
+    return grid, meta
+
+def _slice_grid(grid, region, pixel_registered=False):
+    """
+    Cuts a grid down to the smallest set of nodes that still covers region.
+    """
+    lons = grid['lon'].values
+    lats = grid['lat'].values
+    dlon = abs(lons[1] - lons[0]) if len(lons) > 1 else 0
+    dlat = abs(lats[1] - lats[0]) if len(lats) > 1 else 0
+    lon_pad = dlon / 2 if pixel_registered else 0
+    lat_pad = dlat / 2 if pixel_registered else 0
+    tol = 1e-9
+
+    lon0 = max(np.searchsorted(lons, region[0] + lon_pad + tol, side='right') - 1, 0)
+    lon1 = min(np.searchsorted(lons, region[1] - lon_pad - tol, side='left'), len(lons) - 1)
+
+    # Grids may be stored north-up or south-up
+    if lats[0] <= lats[-1]:
+        lat0 = max(np.searchsorted(lats, region[2] + lat_pad + tol, side='right') - 1, 0)
+        lat1 = min(np.searchsorted(lats, region[3] - lat_pad - tol, side='left'), len(lats) - 1)
+        lat_slice = slice(lat0, lat1 + 1)
+    else:
+        reversed_lats = lats[::-1]
+        lat0 = max(np.searchsorted(reversed_lats, region[2] + lat_pad + tol, side='right') - 1, 0)
+        lat1 = min(np.searchsorted(reversed_lats, region[3] - lat_pad - tol, side='left'), len(lats) - 1)
+        lat_slice = slice(len(lats) - 1 - lat1, len(lats) - lat0)
+
+    return grid.isel(lon=slice(lon0, lon1 + 1), lat=lat_slice)
+
+def load_relief(resolution='01m', region=None, data_source: str='igpp',
+                registration: str=None, use_cache: bool=True):
+    """
+    Drop-in replacement for pygmt.datasets.load_earth_relief that goes through
+    the on-disk relief cache. The region is sliced out of a cached tile that
+    contains it, or else a snapped region around it is fetched and cached.
+
+    Parameters
+    ----------
+    resolution : string, optional
+        Resolution of topo data. The default is '01m'. See
+        pygmt.datasets.load_earth_relief for options.
+    region : list of ints or floats
+        Region to load in format [minlon, maxlon, minlat, maxlat]
+    data_source : str, optional
+        Relief data source, see pygmt.datasets.load_earth_relief. The default
+        is 'igpp'.
+    registration : str, optional
+        'gridline' or 'pixel'. The default is None, which uses the GMT default
+        for that resolution.
+    use_cache : bool, optional
+        If False, loads straight from pygmt without touching the cache.
+        The default is True.
+
+    Returns
+    -------
+    grid : xarray.DataArray
+        Relief grid covering region.
+    """
+    if not use_cache or region is None:
+        return pygmt.datasets.load_earth_relief(resolution=resolution,region=region,
+                                                registration=registration,
+                                                data_source=data_source)
+
+    region = [float(val) for val in region]
+    relief_folder = get_relief_folder()
+
+    tile = None
+    key = _find_tile(relief_folder,data_source,resolution,region,registration)
+    if key is not None:
+        try:
+            tile, meta = _load_tile(relief_folder,key)
+        except FileNotFoundError:
+            # Evicted by another process since it was found
+            tile = None
+    if tile is None:
+        snapped = snap_region(region,resolution)
+        tile = pygmt.datasets.load_earth_relief(resolution=resolution,region=snapped,
+                                                registration=registration,
+                                                data_source=data_source)
+        key, meta = _store_tile(relief_folder,tile,data_source,resolution,snapped,registration)
+        evict(keep=[key])
+
+    grid = _slice_grid(tile,region,pixel_registered=meta['gmt_registration'] == 1)
+
+    # The GMT accessor can't recover these from a sliced grid, so set them
+    # explicitly or GMT will treat the grid as cartesian and gridline registered.
+    grid.gmt.registration = meta['gmt_registration']
+    grid.gmt.gtype = meta['gmt_gtype']
+
+    # Lets load_shade key on where the grid came from instead of its values
+    grid.attrs['relief_data_source'] = data_source
+    grid.attrs['relief_resolution'] = resolution
+
+    return grid
+
+def _grid_identity(grid):
+    """
+    Identity of a grid for the shade cache. Grids from load_relief are
+    identified by source, resolution and node extent, anything else falls back
+    to hashing the values.
+    """
+    lons = grid['lon'].values
+    lats = grid['lat'].values
+    extent = [round(float(val),8) for val in (lons.min(), lons.max(), lats.min(), lats.max())]
+    if 'relief_data_source' in grid.attrs and 'relief_resolution' in grid.attrs:
+        return [grid.attrs['relief_data_source'], grid.attrs['relief_resolution'],
+                extent, list(grid.shape)]
+    values_hash = hashlib.sha1(np.ascontiguousarray(grid.values).tobytes()).hexdigest()
+    return ['values', values_hash, extent, list(grid.shape)]
+
+def load_shade(grid, azimuth='0/90', normalize='t1', persist: bool=None):
+    """
+    Memoized pygmt.grdgradient, used for hillshading relief grids.
+
+    Parameters
+    ----------
+    grid : xarray.DataArray
+        Relief grid, ideally from load_relief.
+    azimuth : str, optional
+        Azimuth(s) of illumination passed to grdgradient. The default is '0/90'.
+    normalize : str, optional
+        Normalization passed to grdgradient. The default is 't1'.
+    persist : bool, optional
+        If True, also keep the result in the on-disk cache. The default is None,
+        which uses the module wide persist_shades setting.
+
+    Returns
+    -------
+    shade : xarray.DataArray
+        Intensity grid for the shading argument of grdimage.
+    """
+    if persist is None:
+        persist = persist_shades
+
+    key_string = json.dumps(['shade', _grid_identity(grid), str(azimuth), str(normalize)])
+    key = hashlib.sha1(key_string.encode('utf-8')).hexdigest()
+
+    if key in _shade_memory:
+        _shade_memory.move_to_end(key)
+        return _shade_memory[key]
+
+    shade = None
+    if persist:
+        relief_folder = get_relief_folder()
+        try:
+            shade, meta = _load_tile(relief_folder,key)
+            shade.gmt.registration = meta['gmt_registration']
+            shade.gmt.gtype = meta['gmt_gtype']
+        except FileNotFoundError:
+            shade = None
+
+    if shade is None:
+        shade = pygmt.grdgradient(grid=grid, azimuth=azimuth, normalize=normalize)
+        if persist:
+            nc_path = os.path.join(relief_folder,f'{key}.nc')
+            cu.atomic_write(nc_path,shade.to_netcdf)
+            meta = {'kind' : 'shade',
+                    'azimuth' : str(azimuth),
+                    'normalize' : str(normalize),
+                    'bytes' : os.path.getsize(nc_path),
+                    'gmt_registration' : int(grid.gmt.registration),
+                    'gmt_gtype' : int(grid.gmt.gtype)}
+            cu.atomic_write_json(os.path.join(relief_folder,f'{key}.json'),meta)
+            evict(keep=[key])
+
+    _shade_memory[key] = shade
+    while len(_shade_memory) > max_shade_entries:
+        _shade_memory.popitem(last=False)
+
+    return shade
+
+def get_cache_size():
+    """Returns the total size of the cached relief tiles, in bytes"""
+    relief_folder = get_relief_folder()
+    return sum(meta.get('bytes',0) for meta_path, meta in _list_tiles(relief_folder))
+
+def evict(max_bytes: int=None, keep=None):
+    """
+    Removes least recently used tiles until the cache fits in max_bytes.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Byte budget. The default is the module wide max_cache_bytes.
+    keep : list of str, optional
+        Tile keys that should never be removed, e.g. a tile that was just
+        written and is about to be read.
+
+    Returns
+    -------
+    removed : int
+        Number of tiles removed.
+    """
+    if max_bytes is None:
+        max_bytes = max_cache_bytes
+    if keep is None:
+        keep = []
+
+    relief_folder = get_relief_folder()
+    tiles = []
+    for meta_path, meta in _list_tiles(relief_folder):
+        try:
+            last_access = os.path.getmtime(meta_path)
+        except OSError:
+            continue
+        tiles.append((last_access, meta_path, meta))
+    tiles.sort(key=lambda tile: tile[0])
+
+    total_bytes = sum(tile[2].get('bytes',0) for tile in tiles)
+    removed = 0
+    for last_access, meta_path, meta in tiles:
+        if total_bytes <= max_bytes:
+            break
+        key = os.path.basename(meta_path)[:-5]
+        if key in keep:
+            continue
+        for path in (meta_path, os.path.join(relief_folder,f'{key}.nc')):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total_bytes -= meta.get('bytes',0)
+        removed += 1
+
+    return removed
+
+def clear_cache():
+    """Removes every cached relief tile and hillshade"""
+    _shade_memory.clear()
+    return evict(max_bytes=0)
@@ -16,6 +16,148 @@ from datetime import datetime, timezone
 from matplotlib.patches import Rectangle, PathPatch
 from matplotlib.text import TextPath
 
+import scripts.geo_utils as gu
+
+
+def _nat_int():
+    return np.iinfo(np.int64).min
+
+def inventory_to_arrays(inventory):
+    """
+    Flattens an inventory into one table of NumPy arrays, with one entry per
+    station, in a single pass over its stations and channels. Nothing is
+    cached, so callers that need the table more than once should keep it.
+
+    Parameters
+    ----------
+    inventory : obspy.core.inventory.Inventory or obspy.core.network.Network
+        ObsPy station inventory, or a single network from one.
+
+    Returns
+    -------
+    station_arrays : dict
+        'network' : network code of each station.
+        'station' : station code of each station.
+        'network_codes' : list of the distinct network codes, in the order
+        they first appear.
+        'network_index' : int array giving each station's position in
+        network_codes.
+        'latitude', 'longitude', 'elevation' : float arrays.
+        'start_time', 'end_time' : datetime64[ns] arrays, NaT where the
+        inventory gives no date.
+        'channel_count' : int array with the number of channels of each station.
+        'channel_codes' : tuple of channel codes for each station.
+    """
+    if isinstance(inventory, obspy.core.inventory.Network):
+        networks = [inventory]
+    else:
+        networks = inventory.networks
+
+    nat = _nat_int()
+    network_codes = []
+    network_lookup = {}
+    network_index = []
+    network_column = []
+    station_column = []
+    latitudes = []
+    longitudes = []
+    elevations = []
+    start_times = []
+    end_times = []
+    channel_counts = []
+    channel_codes = []
+
+    for network in networks:
+        if network.code not in network_lookup:
+            network_lookup[network.code] = len(network_codes)
+            network_codes.append(network.code)
+        index = network_lookup[network.code]
+        for station in network.stations:
+            network_index.append(index)
+            network_column.append(network.code)
+            station_column.append(station.code)
+            latitudes.append(station.latitude)
+            longitudes.append(station.longitude)
+            elevations.append(station.elevation)
+            start_times.append(station.start_date.ns if station.start_date else nat)
+            end_times.append(station.end_date.ns if station.end_date else nat)
+            codes = tuple(channel.code for channel in station.channels)
+            channel_counts.append(len(codes))
+            channel_codes.append(codes)
+
+    num_stations = len(station_column)
+    station_arrays = {'network' : np.array(network_column,dtype=object),
+                      'station' : np.array(station_column,dtype=object),
+                      'network_codes' : network_codes,
+                      'network_index' : np.array(network_index,dtype=np.int64),
+                      'latitude' : np.array(latitudes,dtype=np.float64),
+                      'longitude' : np.array(longitudes,dtype=np.float64),
+                      'elevation' : np.array(elevations,dtype=np.float64),
+                      'start_time' : np.array(start_times,dtype=np.int64).view('datetime64[ns]'),
+                      'end_time' : np.array(end_times,dtype=np.int64).view('datetime64[ns]'),
+                      'channel_count' : np.array(channel_counts,dtype=np.int64),
+                      'channel_codes' : np.empty(num_stations,dtype=object)}
+    station_arrays['channel_codes'][:] = channel_codes
+
+    return station_arrays
+
+def station_records_to_arrays(records):
+    """
+    Builds the same table as inventory_to_arrays from station records, such as
+    those yielded by mapping_stations.iter_stationxml, without an Inventory.
+
+    Parameters
+    ----------
+    records : iterable of mapping_stations.StationRecord
+        Station records.
+
+    Returns
+    -------
+    station_arrays : dict
+        See inventory_to_arrays.
+    """
+    nat = _nat_int()
+    network_codes = []
+    network_lookup = {}
+    columns = {key : [] for key in ['network_index','network','station','latitude',
+                                    'longitude','elevation','start_time','end_time',
+                                    'channel_count','channel_codes']}
+
+    for record in records:
+        if record.network not in network_lookup:
+            network_lookup[record.network] = len(network_codes)
+            network_codes.append(record.network)
+        columns['network_index'].append(network_lookup[record.network])
+        columns['network'].append(record.network)
+        columns['station'].append(record.station)
+        columns['latitude'].append(record.latitude)
+        columns['longitude'].append(record.longitude)
+        columns['elevation'].append(record.elevation)
+        columns['start_time'].append(record.start_date.ns if record.start_date else nat)
+        columns['end_time'].append(record.end_date.ns if record.end_date else nat)
+        columns['channel_count'].append(len(record.channels))
+        columns['channel_codes'].append(record.channels)
+
+    channel_codes = np.empty(len(columns['station']),dtype=object)
+    channel_codes[:] = columns['channel_codes']
+    station_arrays = {'network' : np.array(columns['network'],dtype=object),
+                      'station' : np.array(columns['station'],dtype=object),
+                      'network_codes' : network_codes,
+                      'network_index' : np.array(columns['network_index'],dtype=np.int64),
+                      'latitude' : np.array(columns['latitude'],dtype=np.float64),
+                      'longitude' : np.array(columns['longitude'],dtype=np.float64),
+                      'elevation' : np.array(columns['elevation'],dtype=np.float64),
+                      'start_time' : np.array(columns['start_time'],dtype=np.int64).view('datetime64[ns]'),
+                      'end_time' : np.array(columns['end_time'],dtype=np.int64).view('datetime64[ns]'),
+                      'channel_count' : np.array(columns['channel_count'],dtype=np.int64),
+                      'channel_codes' : channel_codes}
+
+    return station_arrays
+
+def _to_utcdatetimes(times, fill=None):
+    """Converts datetime64[ns] values back to UTCDateTimes, using fill for NaT"""
+    nat = _nat_int()
+    return [fill if t == nat else UTCDateTime(ns=t) for t in times.view(np.int64).tolist()]
 
 def get_station_df(inventory):
     """
@@ -31,44 +173,19 @@ def get_station_df(inventory):
         station_utils.get_station_csv
 
     """
-    networks = []
-    stations = []
-    start_dates = []
-    end_dates = []
-    latitudes = []
-    longitudes = []
-    channels = []
-
+    station_arrays = inventory_to_arrays(inventory)
 
-    for network in inventory:
-        for station in network:
-            networks.append(network.code)
-            stations.append(station.code)
-            start_dates.append(station.start_date)
-            
-            end_date = station.end_date
-            if end_date:
-                end_dates.append(end_date)
-            else:
-                end_dates.append(UTCDateTime(datetime.now(timezone.utc)))
-                
-            latitudes.append(station.latitude)
-            longitudes.append(station.longitude)
-            
-            if len(station.channels) == 1:
-                channels.append(station.channels[0].code)
-            else:
-                code_list = []
-                for channel_index in range(len(station.channels)):
-                    code = station.channels[channel_index].code
-                    code_list.append(code)
-                channels.append(code_list)
-                    
+    # Stations still running are given the current time as their end date
+    now = UTCDateTime(datetime.now(timezone.utc))
+    channels = [codes[0] if len(codes) == 1 else list(codes)
+                for codes in station_arrays['channel_codes']]
 
-
-    stat_dict = {'Network' : networks, 'Station' : stations,
-                 'Latitudes' : latitudes, 'Longitudes' : longitudes,
-                 'Start Date' : start_dates, 'End Date' : end_dates,
+    stat_dict = {'Network' : station_arrays['network'].tolist(),
+                 'Station' : station_arrays['station'].tolist(),
+                 'Latitudes' : station_arrays['latitude'],
+                 'Longitudes' : station_arrays['longitude'],
+                 'Start Date' : _to_utcdatetimes(station_arrays['start_time']),
+                 'End Date' : _to_utcdatetimes(station_arrays['end_time'],fill=now),
                  'Channels' : channels}
 
     stat_df = pd.DataFrame(stat_dict)
@@ -90,41 +207,339 @@ def get_station_csv(inventory,filename='Stations.csv'):
     None.
 
     """
-    networks = []
-    stations = []
-    start_dates = []
-    end_dates = []
-    latitudes = []
-    longitudes = []
-    channels = []
+    stat_df = get_station_df(inventory)
+    stat_df.to_csv(filename)
+    
+    
+def _month_ordinals(dates):
+    """Converts a column of dates to months since year 0 (year * 12 + month - 1)"""
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        dates = pd.DatetimeIndex(dates)
+        return np.asarray(dates.year * 12 + dates.month - 1,dtype=np.int64)
+    try:
+        return np.fromiter((date.year * 12 + date.month - 1 for date in dates),
+                           dtype=np.int64,count=len(dates))
+    except AttributeError:
+        # Dates read back from a CSV are strings
+        dates = pd.DatetimeIndex(pd.to_datetime(pd.Series(dates).astype(str),utc=True))
+        return np.asarray(dates.year * 12 + dates.month - 1,dtype=np.int64)
 
+def station_counts_by_month(df,startdate,enddate):
+    """
+    Counts the stations per network, and overall, that were operating in
+    each month, where a station counts for every month from its start month
+    to its end month inclusive. Dates are converted to month numbers once and
+    the counts are built with a difference array and a cumulative sum, so the
+    cost doesn't grow with months * stations.
 
-    for network in inventory:
-        for station in network:
-            networks.append(network.code)
-            stations.append(station.code)
-            start_dates.append(station.start_date)
-            
-            end_date = station.end_date
-            if end_date:
-                end_dates.append(end_date)
-            else:
-                end_dates.append(UTCDateTime(datetime.now(timezone.utc)))
-                
-            latitudes.append(station.latitude)
-            longitudes.append(station.longitude)
-            channels.append(station.channels)
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Data Frame with 'Network', 'Start Date' and 'End Date' columns, as made
+        by station_utils.get_station_df.
+    startdate : obspy.core.utcdatetime.UTCDateTime
+        Start date. Counting starts in January of this year.
+    enddate : obspy.core.utcdatetime.UTCDateTime
+        End date. Counting runs through the month of this date.
 
+    Returns
+    -------
+    df_station_count : pandas.DataFrame
+        DataFrame with 'Year' and 'Month' columns, one column per network and
+        a 'Total Stations' column.
+    """
+    first_month = startdate.year * 12
+    last_month = enddate.year * 12 + enddate.month - 1
+    num_months = max(last_month - first_month + 1, 0)
 
-    stat_dict = {'Network' : networks, 'Station' : stations,
-                 'Latitudes' : latitudes, 'Longitudes' : longitudes,
-                 'Start Date' : start_dates, 'End Date' : end_dates,
-                 'Channels' : channels}
+    network_index, network_codes = pd.factorize(df['Network'])
+    network_codes = list(network_codes)
+
+    start_months = _month_ordinals(df['Start Date']) - first_month
+    end_months = _month_ordinals(df['End Date']) - first_month
+
+    # Clip the operating periods to the counted months, dropping any that
+    # fall completely outside of them
+    start_months = np.maximum(start_months,0)
+    end_months = np.minimum(end_months,num_months - 1)
+    valid = start_months <= end_months
+
+    diff = np.zeros((len(network_codes), num_months + 1),dtype=np.int64)
+    np.add.at(diff,(network_index[valid],start_months[valid]),1)
+    np.add.at(diff,(network_index[valid],end_months[valid] + 1),-1)
+    counts = np.cumsum(diff,axis=1)[:, :num_months]
+
+    months = first_month + np.arange(num_months)
+    count_dict = {'Year' : months // 12,
+                  'Month' : months % 12 + 1}
+    for i, network in enumerate(network_codes):
+        count_dict[network] = counts[i]
+    count_dict['Total Stations'] = counts.sum(axis=0)
+
+    df_station_count = pd.DataFrame(count_dict)
+
+    return df_station_count
+
+def _dates_to_ns(dates):
+    """Converts a column of dates to int64 ns since the epoch"""
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        return np.asarray(pd.to_datetime(dates).astype('datetime64[ns]')).astype(np.int64)
+    dates = list(dates)
+    if all(type(date) == UTCDateTime for date in dates):
+        return np.fromiter((date.ns for date in dates),dtype=np.int64,count=len(dates))
+    return np.array([UTCDateTime(str(date)).ns for date in dates],dtype=np.int64)
+
+class AvailabilityIndex:
+    """
+    Index over station operating periods for answering "how many stations per
+    network were up" at any time or over any bins. The start and end times of
+    each network are kept as sorted arrays, so a query is a pair of binary
+    searches, O(log n), no matter how many stations there are.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Data Frame with 'Network', 'Start Date' and 'End Date' columns, as made
+        by station_utils.get_station_df. Dates can be UTCDateTimes, datetimes
+        or strings.
+    """
+    def __init__(self,df):
+        if type(df) != pd.DataFrame:
+            raise TypeError('Expected pandas.DataFrame object as input')
+
+        network_index, network_codes = pd.factorize(df['Network'])
+        self.networks = list(network_codes)
+
+        starts = _dates_to_ns(df['Start Date'])
+        ends = _dates_to_ns(df['End Date'])
+
+        self.starts = {}
+        self.ends = {}
+        for i, network in enumerate(self.networks):
+            in_network = network_index == i
+            self.starts[network] = np.sort(starts[in_network])
+            self.ends[network] = np.sort(ends[in_network])
+        self.all_starts = np.sort(starts)
+        self.all_ends = np.sort(ends)
+
+    @staticmethod
+    def _times_to_ns(times):
+        times = np.atleast_1d(np.asarray(times))
+        if np.issubdtype(times.dtype,np.datetime64):
+            return times.astype('datetime64[ns]').astype(np.int64)
+        if np.issubdtype(times.dtype,np.integer):
+            return times.astype(np.int64)
+        return np.array([UTCDateTime(time).ns for time in times],dtype=np.int64)
+
+    def count_at(self,times):
+        """
+        Parameters
+        ----------
+        times : list or array of times
+            UTCDateTimes, strings, datetime64 or int64 ns since the epoch.
+
+        Returns
+        -------
+        df_count : pandas.DataFrame
+            Number of stations per network, and in total, operating at each
+            time (start <= time <= end).
+        """
+        times = self._times_to_ns(times)
+
+        count_dict = {'Time' : times.astype('datetime64[ns]')}
+        for network in self.networks:
+            count_dict[network] = (np.searchsorted(self.starts[network],times,side='right') -
+                                   np.searchsorted(self.ends[network],times,side='left'))
+        count_dict['Total Stations'] = (np.searchsorted(self.all_starts,times,side='right') -
+                                        np.searchsorted(self.all_ends,times,side='left'))
+
+        return pd.DataFrame(count_dict)
+
+    def count_overlapping(self,bin_edges):
+        """
+        Parameters
+        ----------
+        bin_edges : list or array of times
+            Edges of consecutive bins, n + 1 edges for n bins. UTCDateTimes,
+            strings, datetime64 or int64 ns since the epoch.
+
+        Returns
+        -------
+        df_count : pandas.DataFrame
+            Number of stations per network, and in total, operating at any
+            point in each bin [edge_i, edge_i+1).
+        """
+        edges = self._times_to_ns(bin_edges)
+        if len(edges) < 2:
+            raise ValueError('Need at least 2 bin edges')
+        bin_starts = edges[:-1]
+        bin_ends = edges[1:]
+
+        # A station overlaps a bin if it starts before the bin ends and ends
+        # at or after the bin starts. Stations ending before the bin starts
+        # also started before it ends, so a difference of counts is enough.
+        count_dict = {'Bin Start' : bin_starts.astype('datetime64[ns]'),
+                      'Bin End' : bin_ends.astype('datetime64[ns]')}
+        for network in self.networks:
+            count_dict[network] = (np.searchsorted(self.starts[network],bin_ends,side='left') -
+                                   np.searchsorted(self.ends[network],bin_starts,side='left'))
+        count_dict['Total Stations'] = (np.searchsorted(self.all_starts,bin_ends,side='left') -
+                                        np.searchsorted(self.all_ends,bin_starts,side='left'))
+
+        return pd.DataFrame(count_dict)
+
+    def binned(self,startdate,enddate,freq='D'):
+        """
+        Parameters
+        ----------
+        startdate : obspy.core.utcdatetime.UTCDateTime or string
+            Start of the first bin.
+        enddate : obspy.core.utcdatetime.UTCDateTime or string
+            Time the last bin must reach.
+        freq : str, optional
+            Pandas frequency string for the bins, e.g. 'D' for days, 'W' for
+            weeks or 'MS' for calendar months. The default is 'D'.
+
+        Returns
+        -------
+        df_count : pandas.DataFrame
+            See count_overlapping.
+        """
+        start = pd.Timestamp(UTCDateTime(startdate).datetime)
+        end = pd.Timestamp(UTCDateTime(enddate).datetime)
+        edges = pd.date_range(start,end,freq=freq)
+        if len(edges) == 0 or edges[0] != start:
+            edges = pd.DatetimeIndex([start]).append(edges)
+        if edges[-1] < end:
+            edges = edges.append(pd.date_range(edges[-1],periods=2,freq=freq)[1:])
+        if len(edges) < 2:
+            edges = edges.append(pd.date_range(edges[-1],periods=2,freq=freq)[1:])
+
+        return self.count_overlapping(edges.to_numpy().astype('datetime64[ns]'))
+
+def _pair_station_columns(stations):
+    """Station ids, coordinates and operating periods (ns) from an inventory or station DataFrame"""
+    now = UTCDateTime(datetime.now(timezone.utc)).ns
+    if type(stations) == pd.DataFrame:
+        ids = (stations['Network'].astype(str) + '.' + stations['Station'].astype(str)).to_numpy()
+        lats = stations['Latitudes'].to_numpy(dtype=np.float64)
+        lons = stations['Longitudes'].to_numpy(dtype=np.float64)
+        starts = _dates_to_ns(stations['Start Date'])
+        ends = _dates_to_ns(stations['End Date'])
+    else:
+        station_arrays = inventory_to_arrays(stations)
+        ids = np.array([f'{network}.{station}' for network, station in
+                        zip(station_arrays['network'],station_arrays['station'])],dtype=object)
+        lats = station_arrays['latitude']
+        lons = station_arrays['longitude']
+        nat = _nat_int()
+        starts = station_arrays['start_time'].view(np.int64).copy()
+        ends = station_arrays['end_time'].view(np.int64).copy()
+        starts[starts == nat] = nat + 1
+        ends[ends == nat] = now
+    return ids, lats, lons, starts, ends
+
+def iter_station_pairs(stations, min_distance: float=0, max_distance: float=None,
+                       min_overlap_days: float=0, chunk_size: int=512):
+    """
+    Finds the station pairs that are within a distance range of each other and
+    were operating at the same time, e.g. for planning ambient noise
+    correlations, without comparing every pair in Python. Stations are put in
+    a KD-tree as points on the unit sphere, so only pairs closer than
+    max_distance are looked at, and the overlap of their operating periods is
+    then checked for a whole chunk of stations at once.
+
+    Parameters
+    ----------
+    stations : obspy.core.inventory.Inventory or pandas.DataFrame
+        Inventory, or a DataFrame as made by get_station_df (e.g. read back
+        from Stations_To_Correlate.csv).
+    min_distance : float, optional
+        Minimum inter-station distance in km. The default is 0.
+    max_distance : float, optional
+        Maximum inter-station distance in km. The default is None, for no limit.
+    min_overlap_days : float, optional
+        Minimum time both stations were operating, in days. The default is 0,
+        which still requires the operating periods to overlap.
+    chunk_size : int, optional
+        Number of stations whose neighbours are gathered at once. The default
+        is 512.
+
+    Yields
+    ------
+    pair : tuple
+        (sta1, sta2, distance, azimuth, overlap_days), with stations as
+        'NET.STA', distance in km and azimuth in degrees from sta1 to sta2.
+        Each pair is given once.
+    """
+    from scipy.spatial import cKDTree
+
+    ids, lats, lons, starts, ends = _pair_station_columns(stations)
+    num_stations = len(ids)
+    if num_stations < 2:
+        return
+
+    lat_rad = np.radians(lats)
+    lon_rad = np.radians(lons)
+    xyz = np.column_stack([np.cos(lat_rad) * np.cos(lon_rad),
+                           np.cos(lat_rad) * np.sin(lon_rad),
+                           np.sin(lat_rad)])
+    tree = cKDTree(xyz)
+
+    # Straight line distance through the unit sphere for the maximum distance,
+    # with a little slack so the exact distance check below decides the edges
+    if max_distance is None or max_distance / 6371.0 >= np.pi:
+        radius = 2.0 + 1e-9
+    else:
+        radius = 2 * np.sin(max_distance / 6371.0 / 2) + 1e-9
+    min_overlap_ns = min_overlap_days * 86400e9
+
+    for chunk_start in range(0, num_stations, chunk_size):
+        chunk = np.arange(chunk_start, min(chunk_start + chunk_size, num_stations))
+        neighbours = tree.query_ball_point(xyz[chunk], radius)
+
+        counts = np.fromiter((len(n) for n in neighbours),dtype=np.int64,count=len(chunk))
+        if counts.sum() == 0:
+            continue
+        first = np.repeat(chunk, counts)
+        second = np.concatenate([np.asarray(n,dtype=np.int64) for n in neighbours])
+
+        # Each pair once, then only pairs that ran at the same time
+        keep = second > first
+        first = first[keep]
+        second = second[keep]
+        overlap = (np.minimum(ends[first], ends[second]) -
+                   np.maximum(starts[first], starts[second]))
+        keep = (overlap > 0) & (overlap >= min_overlap_ns)
+        first = first[keep]
+        second = second[keep]
+        overlap = overlap[keep]
+
+        distances = gu.haversine_distances(lons[first], lats[first], lons[second], lats[second])
+        keep = distances >= min_distance
+        if max_distance is not None:
+            keep &= distances <= max_distance
+        first = first[keep]
+        second = second[keep]
+        azimuths = gu.azimuthal_directions(lons[first], lats[first], lons[second], lats[second])
+
+        for pair in zip(ids[first].tolist(), ids[second].tolist(),
+                        distances[keep].tolist(), azimuths.tolist(),
+                        (overlap[keep] / 86400e9).tolist()):
+            yield pair
+
+def get_station_pairs_df(stations, min_distance: float=0, max_distance: float=None,
+                         min_overlap_days: float=0):
+    """
+    Collects iter_station_pairs into a DataFrame with 'Station 1', 'Station 2',
+    'Distance (km)', 'Azimuth' and 'Overlap (days)' columns.
+    """
+    pairs = iter_station_pairs(stations,min_distance=min_distance,
+                               max_distance=max_distance,
+                               min_overlap_days=min_overlap_days)
+    return pd.DataFrame(pairs,columns=['Station 1','Station 2','Distance (km)',
+                                       'Azimuth','Overlap (days)'])
 
-    stat_df = pd.DataFrame(stat_dict)
-    stat_df.to_csv(filename)
-    
-    
 def station_availability_from_df(df,startdate,enddate=None):
     """
     Finds the number of stations available over time given a Data Frame created
@@ -172,94 +587,12 @@ def station_availability_from_df(df,startdate,enddate=None):
         enddate = UTCDateTime(datetime.now(timezone.utc))
     else:
         raise TypeError('End date must be a UTCDateTime object or string, or None to use current time')
-        
-    num_years = enddate.year - startdate.year
-    start_month = startdate.month
-    start_year = startdate.year
-  
-    time_bins = []
-    
-    years_list = []
-    months_list = []
-
-    for relative_year in range(num_years):
-        year = startdate.year + relative_year
-        for month in range(1, 13, 1):
-            time_bin = (year, month)
-            time_bins.append(time_bin)
-            years_list.append(year)
-            months_list.append(month)
-         
-    # Create a list of networks
-    network_list = df.Network.unique()
-    
-    # Create a dictionary with time bins as keys and counter dict for that bin
-    # as the values
-    monthly_network_count = {}
-    for time_bin in time_bins:
-        monthly_network_count[time_bin] = None
-            
-    datetime_bin_list = []
-    for i, time_bin in enumerate(time_bins):
-        
-        # Reset the network counter so all networks are at 0
-        network_count = {}
-        for network in network_list:
-            network_count[network] = [0]
-        network_count['Total Stations'] = [0]
-        
-        year = time_bin[0]
-        month = time_bin[1]
 
-        # Create the months as UTCDateTime objects so that they can be plotted
-        # Later with actual time stamps
-        """
-        if month < 10:
-            time_string = str(year) + ',' + '0' + str(month) + ',01,00:00:00'
-        else:
-            time_string = str(year) + ',' + str(month) + ',01,00:00:00' 
-        """
-        datetime_bin_list.append(datetime(year, month, 1, 0, 0))
-       
-        # Determine the station count for each network and put it into a dict        
-        for index in range(len(df)):
-            startyear = df['Start Date'][index].year
-            startmonth = df['Start Date'][index].month
-            endyear = df['End Date'][index].year
-            endmonth = df['End Date'][index].month
-            network = df['Network'][index]
-            
-            if (year - startyear) < 0:
-                _inbin_ = False
-            elif (year - startyear) == 0 and (month - startmonth) <0:
-                _inbin_ = False
-            elif (year - endyear) > 0:
-                _inbin_ = False
-            elif (year - endyear) == 0 and (month - endmonth) > 0 :
-                _inbin_ = False
-            else:
-                _inbin_ = True
-                
-            if _inbin_ == True:
-                network_count[network][0]+=1
-                network_count['Total Stations'][0]+= 1
-            if _inbin_ == False:
-                pass
-        # Putting it into a DataFrame to export as CSV and easier plotting
-        if i == 0:
-            df_station_count = pd.DataFrame.from_dict(network_count)
-        else:
-            df_station_row = pd.DataFrame.from_dict(network_count)
-            _combine_ = [df_station_count, df_station_row]
-            df_station_count = pd.concat(_combine_,ignore_index=True)
-    
-    df_station_count.insert(0,"Year",years_list)
-    df_station_count.insert(1,"Month",months_list)
-    
-    count_list = []
-    for months_since_start in range(len(df_station_count)):
-        total_stations = df_station_count['Total Stations'][months_since_start]
-        count_list.append(total_stations)
+    df_station_count = station_counts_by_month(df,startdate,enddate)
+
+    datetime_bin_list = [datetime(year, month, 1, 0, 0) for year, month in
+                         zip(df_station_count['Year'],df_station_count['Month'])]
+    count_list = df_station_count['Total Stations'].tolist()
         
     # Plotting the stations available over time    
     fig, ax = plt.subplots(dpi=200)
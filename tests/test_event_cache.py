@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 20:41:09 2026
+
+@author: tlee
+
+
+Tests for the event ids used as keys in scripts.event_cache.
+"""
+
+import numpy as np
+
+import scripts.event_cache as ec
+
+
+def make_columns(event_id):
+    return {'event_id' : np.array([event_id],dtype=object),
+            'time' : np.array([1_600_000_000_000_000_000],dtype=np.int64),
+            'longitude' : np.array([-150.0]),
+            'latitude' : np.array([61.0]),
+            'depth' : np.array([10000.0]),
+            'magnitude' : np.array([3.2])}
+
+
+def test_normalize_event_id():
+    quakeml_id = 'quakeml:earthquake.usgs.gov/fdsnws/event/1/query?eventid=ak020abcd&format=quakeml'
+    assert ec.normalize_event_id(quakeml_id) == 'ak020abcd'
+    assert ec.normalize_event_id('smi:nz.org.geonet/2016p858000') == '2016p858000'
+    assert ec.normalize_event_id('ak020abcd') == 'ak020abcd'
+
+
+def test_formats_store_one_event(tmp_path):
+    conn = ec.connect(str(tmp_path / 'catalog.sqlite'))
+    bounds = [-151, -149, 60, 62]
+    try:
+        ec.store_events(conn,'USGS',make_columns('ak020abcd'),bounds,2,0,1)
+        ec.store_events(conn,'USGS',make_columns('quakeml:earthquake.usgs.gov/fdsnws/event/1/query?eventid=ak020abcd&format=quakeml'),
+                        bounds,2,0,1)
+        columns = ec.query_events(conn,'USGS',bounds,2,0,2_000_000_000_000_000_000)
+    finally:
+        conn.close()
+    assert columns['event_id'].tolist() == ['ak020abcd']
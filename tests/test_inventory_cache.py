@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 19:12:40 2026
+
+@author: tlee
+
+
+Tests for the superset rules of scripts.inventory_cache.
+"""
+
+import pytest
+from obspy import UTCDateTime
+from obspy.core.inventory import Inventory, Network, Station, Channel
+
+import scripts.cache_utils as cu
+import scripts.inventory_cache as ic
+
+
+@pytest.fixture(autouse=True)
+def cache_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(cu,'cache_folder',str(tmp_path))
+
+
+def make_inventory(with_channels):
+    stations = []
+    for i, (lat, codes) in enumerate([(61.2, ['HHZ','HHE']), (61.3, ['HNZ']), (61.4, ['BDF'])]):
+        channels = [Channel(code,'',lat,-150.0,0,0,start_date=UTCDateTime(2010,1,1))
+                    for code in codes] if with_channels else []
+        stations.append(Station(f'S{i}',lat,-150.0,0,channels=channels,
+                                start_date=UTCDateTime(2010,1,1)))
+    return Inventory(networks=[Network('AK',stations=stations)],source='test')
+
+
+wide_query = {'network' : 'AK,NP', 'starttime' : '2015-01-01', 'endtime' : '2020-01-01',
+              'minlatitude' : 60.0, 'maxlatitude' : 62.0,
+              'minlongitude' : -152.0, 'maxlongitude' : -148.0}
+narrow_query = {'network' : 'AK', 'channel' : '*Z', 'starttime' : '2016-01-01',
+                'endtime' : '2019-01-01', 'minlatitude' : 61.0,
+                'maxlatitude' : 61.8, 'minlongitude' : -151.0, 'maxlongitude' : -149.0}
+
+
+def test_station_level_cache_does_not_answer_channel_query():
+    ic.store_inventory('IRIS',dict(wide_query,level='station'),make_inventory(False))
+    assert ic.find_cached_inventory('IRIS',dict(narrow_query,level='station')) is None
+
+
+def test_channel_level_cache_answers_channel_query():
+    ic.store_inventory('IRIS',dict(wide_query,level='channel'),make_inventory(True))
+    inv = ic.find_cached_inventory('IRIS',dict(narrow_query,level='channel'))
+    assert inv is not None
+    assert sorted(station.code for station in inv[0]) == ['S0','S1']
+
+
+def test_network_level_only_exact_match():
+    ic.store_inventory('IRIS',dict(wide_query,level='channel'),make_inventory(True))
+    assert ic.find_cached_inventory('IRIS',{'network' : 'AK','level' : 'network'}) is None
+
+
+def test_blank_location_is_not_wildcard():
+    assert ic.normalize_query({'location' : ''})['location'] == '--'
+    assert ic.normalize_query({'location' : '--'})['location'] == '--'
+    assert ic.normalize_query({})['location'] == '*'
+
+    ic.store_inventory('IRIS',dict(wide_query,location='--',level='channel'),make_inventory(True))
+    assert ic.find_cached_inventory('IRIS',dict(wide_query,level='channel')) is None
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 20:58:33 2026
+
+@author: tlee
+
+
+Tests for the station tables in scripts.station_utils.
+"""
+
+from obspy import UTCDateTime
+from obspy.core.inventory import Inventory, Network, Station, Channel
+
+import scripts.station_utils as su
+
+
+def make_inventory():
+    stations = [Station(f'S{i}',61.0 + i * 0.1,-150.0,0,start_date=UTCDateTime(2010,1,1))
+                for i in range(2)]
+    return Inventory(networks=[Network('AK',stations=stations)],source='test')
+
+
+def test_inventory_to_arrays_sees_in_place_edits():
+    inv = make_inventory()
+    su.inventory_to_arrays(inv)
+
+    inv[0][0].latitude = 62.0
+    inv[0].stations[1] = Station('S9',60.0,-151.0,0)
+    inv[0][0].channels.append(Channel('HHZ','',62.0,-150.0,0,0))
+
+    station_arrays = su.inventory_to_arrays(inv)
+    assert station_arrays['station'].tolist() == ['S0','S9']
+    assert station_arrays['latitude'].tolist() == [62.0,60.0]
+    assert station_arrays['channel_count'].tolist() == [1,0]
+
+
+def test_iter_station_pairs_without_gmt():
+    inv = make_inventory()
+    pairs = list(su.iter_station_pairs(inv))
+    assert len(pairs) == 1
+    sta1, sta2, distance, azimuth, overlap_days = pairs[0]
+    assert (sta1, sta2) == ('AK.S0','AK.S1')
+    assert abs(distance - 11.12) < 0.01
+    assert abs(azimuth) < 1e-6